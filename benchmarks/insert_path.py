@@ -0,0 +1,65 @@
+"""
+Time per request for writing a transaction and building the response body,
+reading the document back and encoding through a dict (before) against
+building the model locally and serializing it straight to bytes (after).
+
+    python -m benchmarks.insert_path
+"""
+
+import asyncio
+import datetime
+import json
+import time
+
+from fastapi.encoders import jsonable_encoder
+
+from benchmarks.stand_ins import mongo_client
+from repositories.transaction_repository import TransactionRepository
+
+REQUESTS = 5000
+
+
+def _transaction() -> dict:
+    return {
+        "user_id": "user1234",
+        "amount": 50.0,
+        "currency": "USD",
+        "timestamp": datetime.datetime.utcnow(),
+        "type": "DEPOSIT",
+        "is_suspicious": False,
+        "suspicious_reasons": [],
+    }
+
+
+async def _before(repo: TransactionRepository) -> bytes:
+    inserted = await repo._collection.insert_one(_transaction())
+    transaction = await repo.get_transaction(inserted.inserted_id)
+    return json.dumps(jsonable_encoder(transaction.to_dict_json())).encode()
+
+
+async def _after(repo: TransactionRepository) -> bytes:
+    transaction = await repo.insert_transaction(_transaction())
+    return transaction.to_json_bytes()
+
+
+async def _time(path) -> float:
+    repo = TransactionRepository(db=mongo_client()["bench"])
+    started = time.perf_counter()
+    for _ in range(REQUESTS):
+        await path(repo)
+    return (time.perf_counter() - started) / REQUESTS
+
+
+async def main():
+    before = await _time(_before)
+    after = await _time(_after)
+    print(f"insert + read back + dict encode: {before * 1e6:8.1f}us per request")
+    print(f"insert + local build + to bytes:  {after * 1e6:8.1f}us per request")
+    print(
+        "Against a real server the read back is also a full network round trip "
+        "per request that no longer happens."
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
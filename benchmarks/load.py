@@ -0,0 +1,355 @@
+"""
+Load test for POST /transactions and GET /transactions/suspicious/{user_id}
+against local stand-ins for MongoDB and Redis, so it runs offline.
+
+A synthetic stream is sent to the app by concurrent clients, first as
+ingest requests and then as queries for users picked with the same skew.
+The app is called in process through ASGI and/or served by uvicorn over
+HTTP. Each phase reports latency percentiles, throughput and the Mongo and
+Redis operations per request.
+
+    python -m benchmarks.load --requests 5000 --concurrency 32
+    python -m benchmarks.load --save benchmarks/baselines/load.json
+    python -m benchmarks.load --compare benchmarks/baselines/load.json
+
+The stand-ins are far faster than real servers, so the numbers show the
+cost of the app itself. Compare runs on the same machine only.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import platform
+import socket
+import threading
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Iterable, List, Optional, Tuple
+
+import uvicorn
+
+from benchmarks.stand_ins import InMemoryRedis, counting_mongo_operations, mongo_client
+from benchmarks.synthetic import SyntheticStream
+from connections import connections
+from main import remodemo_app
+from services.transaction.suspicious_transactions_cache import (
+    suspicious_transactions_cache,
+)
+
+# (method, path, body)
+Request = Tuple[str, str, Optional[bytes]]
+# Sends a request and returns the status code
+Send = Callable[[str, str, Optional[bytes]], Awaitable[int]]
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def summarise(
+    latencies: List[float],
+    errors: int,
+    seconds: float,
+    mongo_calls: Counter,
+    redis_calls: Counter,
+) -> dict:
+    latencies = sorted(latencies)
+    requests = len(latencies)
+
+    def per_request(calls: Counter) -> dict:
+        return {
+            name: round(count / requests, 3) for name, count in sorted(calls.items())
+        }
+
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": round(requests / seconds, 1) if seconds else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "mongo_ops_per_request": per_request(mongo_calls) if requests else {},
+        "redis_ops_per_request": per_request(redis_calls) if requests else {},
+    }
+
+
+async def _asgi_request(app, method: str, path: str, body: Optional[bytes]) -> int:
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 0),
+        "server": ("127.0.0.1", 80),
+    }
+    sent = False
+    status = 500
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body or b"", "more_body": False}
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+@asynccontextmanager
+async def in_process(app):
+    """
+    Calls the app directly, without sockets or HTTP parsing.
+    """
+    async with app.router.lifespan_context(app):
+
+        async def connect() -> Send:
+            return lambda method, path, body: _asgi_request(app, method, path, body)
+
+        yield connect
+
+
+class _HttpConnection:
+    """
+    A keep-alive HTTP/1.1 connection, just enough for the endpoints under
+    test (their responses always have a Content-Length).
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+    async def request(self, method: str, path: str, body: Optional[bytes]) -> int:
+        body = body or b""
+        self.writer.write(
+            (
+                f"{method} {path} HTTP/1.1\r\n"
+                f"Host: {self.host}:{self.port}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n"
+            ).encode()
+            + body
+        )
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.lower() == "content-length":
+                length = int(value)
+            elif name.lower() == "transfer-encoding":
+                raise ValueError("Chunked responses aren't supported")
+        await self.reader.readexactly(length)
+        return status
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@asynccontextmanager
+async def over_uvicorn(app):
+    """
+    Serves the app with uvicorn on a background thread, each client gets its
+    own keep-alive connection.
+    """
+    port = _free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("uvicorn failed to start")
+        await asyncio.sleep(0.01)
+
+    opened: List[_HttpConnection] = []
+
+    async def connect() -> Send:
+        connection = _HttpConnection("127.0.0.1", port)
+        await connection.open()
+        opened.append(connection)
+        return connection.request
+
+    try:
+        yield connect
+    finally:
+        for connection in opened:
+            await connection.close()
+        server.should_exit = True
+        await asyncio.to_thread(thread.join)
+
+
+async def drive(
+    connect: Callable[[], Awaitable[Send]],
+    requests: Iterable[Request],
+    concurrency: int,
+) -> Tuple[List[float], int, float]:
+    """
+    Sends every request from `concurrency` clients at once, each sending its
+    next request as soon as the last one returns.
+    """
+    requests = iter(requests)
+    latencies: List[float] = []
+    errors = 0
+
+    async def client(send: Send):
+        nonlocal errors
+        for method, path, body in requests:
+            started = time.perf_counter()
+            status = await send(method, path, body)
+            latencies.append(time.perf_counter() - started)
+            if status >= 400:
+                errors += 1
+
+    clients = [await connect() for _ in range(concurrency)]
+    started = time.perf_counter()
+    await asyncio.gather(*[client(send) for send in clients])
+    return latencies, errors, time.perf_counter() - started
+
+
+async def run(mode: str, args: argparse.Namespace) -> dict:
+    stream = SyntheticStream(users=args.users, skew=args.skew, seed=args.seed)
+    ingest = [
+        ("POST", "/transactions", json.dumps(t).encode())
+        for t in stream.transactions(args.requests)
+    ]
+    query_path = "/transactions/suspicious/{}" + (
+        f"?limit={args.limit}" if args.limit else ""
+    )
+    queries = [
+        ("GET", query_path.format(stream.user_id()), None) for _ in range(args.queries)
+    ]
+
+    # Fresh stand-ins every run, set on the shared connections so the app and
+    # anything falling back to them use the same ones
+    redis = InMemoryRedis()
+    connections.db = mongo_client()["bench"]
+    connections.redis = redis
+    suspicious_transactions_cache.clear()
+
+    app = remodemo_app()
+    transport = in_process if mode == "inprocess" else over_uvicorn
+    results = {}
+    async with transport(app) as connect:
+        for phase, requests in [("ingest", ingest), ("query", queries)]:
+            mongo_calls = Counter()
+            redis.calls.clear()
+            with counting_mongo_operations(mongo_calls):
+                latencies, errors, seconds = await drive(
+                    connect, requests, args.concurrency
+                )
+            results[phase] = summarise(
+                latencies, errors, seconds, mongo_calls, Counter(redis.calls)
+            )
+    return results
+
+
+def compare(baseline: dict, report: dict):
+    for mode, phases in report["results"].items():
+        for phase, summary in phases.items():
+            before = baseline.get("results", {}).get(mode, {}).get(phase)
+            if before is None:
+                continue
+            changes = []
+            for key in ["p50_ms", "p95_ms", "p99_ms", "throughput_rps"]:
+                if before[key]:
+                    change = (summary[key] - before[key]) / before[key] * 100
+                    changes.append(f"{key} {change:+.1f}%")
+            print(f"{mode:>9} {phase:>6} vs baseline: {', '.join(changes)}")
+
+
+def _print(mode: str, phase: str, summary: dict):
+    print(
+        f"{mode:>9} {phase:>6}: {summary['requests']} requests "
+        f"({summary['errors']} errors), {summary['throughput_rps']} req/s, "
+        f"p50 {summary['p50_ms']}ms p95 {summary['p95_ms']}ms "
+        f"p99 {summary['p99_ms']}ms"
+    )
+    print(f"{'':>17} mongo/request {summary['mongo_ops_per_request']}")
+    print(f"{'':>17} redis/request {summary['redis_ops_per_request']}")
+
+
+async def main(args: argparse.Namespace):
+    modes = ["inprocess", "uvicorn"] if args.mode == "both" else [args.mode]
+    report = {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("save", "compare")
+        },
+        "results": {},
+    }
+    for mode in modes:
+        report["results"][mode] = await run(mode, args)
+        for phase, summary in report["results"][mode].items():
+            _print(mode, phase, summary)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved to {args.save}")
+    return report
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--mode", choices=["inprocess", "uvicorn", "both"], default="both"
+    )
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument(
+        "--skew", type=float, default=1.1, help="0 picks users uniformly"
+    )
+    parser.add_argument(
+        "--limit", type=int, default=None, help="page size for the queries"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
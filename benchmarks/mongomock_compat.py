@@ -0,0 +1,57 @@
+"""
+Patches for mongomock, which the benchmarks' stand-ins and the tests both
+run on, where it differs from MongoDB and pymongo.
+"""
+
+import inspect
+
+from mongomock.collection import BulkOperationBuilder, Collection
+
+
+def allow_bulk_write_sort():
+    """
+    pymongo from 4.11 passes `sort` to the bulk builder for UpdateOne and
+    ReplaceOne, which mongomock predates. It's always None for the writes
+    made here so it's dropped. Nothing changes on the locked versions.
+    """
+    for name in ["add_update", "add_replace"]:
+        method = getattr(BulkOperationBuilder, name)
+        if "sort" in inspect.signature(method).parameters:
+            continue
+
+        def without_sort(self, *args, sort=None, _method=method, **kwargs):
+            return _method(self, *args, **kwargs)
+
+        setattr(BulkOperationBuilder, name, without_sort)
+
+
+def keep_partial_indexes():
+    """
+    mongomock's create_indexes drops the partialFilterExpression of an
+    IndexModel, so a partial unique index would be unique over every
+    document. Each index goes through create_index, which keeps it, and a
+    partial unique index skips the check of the documents already there,
+    which doesn't apply the filter. Inserts afterwards do apply it.
+    """
+    if getattr(Collection.create_indexes, "keeps_partial", False):
+        return
+
+    def create_indexes(self, indexes, session=None):
+        names = []
+        for index in indexes:
+            keys = index.document["key"].items()
+            options = {k: v for k, v in index.document.items() if k != "key"}
+            name = options["name"]
+            names.append(name)
+            if options.get("unique") and "partialFilterExpression" in options:
+                if name not in self._store.indexes:
+                    self.create_index(
+                        keys, session=session, **{**options, "unique": False}
+                    )
+                    self._store.indexes[name]["unique"] = True
+            else:
+                self.create_index(keys, session=session, **options)
+        return names
+
+    create_indexes.keeps_partial = True
+    Collection.create_indexes = create_indexes
@@ -0,0 +1,78 @@
+"""
+Rows per second for the pattern scanner on a window of transactions from
+many users: loading the documents into the array-backed columns, then
+each pattern's pass over them, which loops in Python a row at a time.
+
+    python -m benchmarks.pattern_scan [--rows 1000000] [--users 100000]
+        [--minutes 60]
+
+The documents are built in memory in the shape the window read returns
+them, reading them from MongoDB isn't included.
+"""
+
+import argparse
+import datetime
+import random
+import time
+
+from bson import ObjectId
+
+from services.rules.pattern_scanner import (
+    TransactionColumns,
+    burst_rows,
+    structuring_rows,
+)
+
+TYPES = ["DEPOSIT", "WITHDRAWAL", "TRANSFER", "OTHER"]
+
+
+def _documents(rows: int, users: int, minutes: int):
+    rand = random.Random(1)
+    start = datetime.datetime(2024, 1, 1)
+    milliseconds = minutes * 60_000
+    return [
+        {
+            "_id": ObjectId(),
+            "user_id": f"user{rand.randrange(users)}",
+            "amount": round(rand.lognormvariate(0, 1.5) * 500, 2),
+            "currency": "USD",
+            "type": rand.choice(TYPES),
+            "timestamp": start
+            + datetime.timedelta(milliseconds=rand.randrange(milliseconds)),
+            "suspicious_reasons": [],
+        }
+        for _ in range(rows)
+    ]
+
+
+def _rate(rows: int, seconds: float) -> str:
+    return f"{rows / seconds:12,.0f} rows/s {seconds:8.3f}s"
+
+
+def main(rows: int, users: int, minutes: int):
+    documents = _documents(rows, users, minutes)
+
+    started = time.perf_counter()
+    columns = TransactionColumns()
+    for d in documents:
+        columns.append(d)
+    print(f"{'load':>12}: {_rate(rows, time.perf_counter() - started)}")
+
+    passes = {
+        "structuring": lambda: structuring_rows(columns, 10_000, False, 0.1, 3),
+        "bursts": lambda: burst_rows(columns, minutes, 10, 5.0),
+    }
+    for name, scan in passes.items():
+        started = time.perf_counter()
+        found = scan()
+        seconds = time.perf_counter() - started
+        print(f"{name:>12}: {_rate(rows, seconds)} {len(found):>9,} flagged")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--minutes", type=int, default=60)
+    args = parser.parse_args()
+    main(args.rows, args.users, args.minutes)
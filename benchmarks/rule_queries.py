@@ -0,0 +1,76 @@
+"""
+Counts the Mongo reads made per transaction by ProcessRules with and without
+the in process window counters.
+
+    python -m benchmarks.rule_queries
+"""
+
+import asyncio
+import datetime
+import random
+from collections import Counter
+from unittest import mock
+
+import config
+from benchmarks.stand_ins import mongo_client
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from services.transaction.new_transaction import NewTransaction
+
+USERS = 50
+TRANSACTIONS = 2000
+READS = ["find", "find_one", "count_documents", "aggregate"]
+
+
+def _payloads():
+    rand = random.Random(1)
+    now = datetime.datetime.utcnow()
+    return [
+        NewTransactionPayload(
+            user_id=f"user{rand.randrange(USERS)}",
+            amount=rand.choice([20, 50, 90, 500, 12000]),
+            currency="USD",
+            timestamp=now - datetime.timedelta(seconds=TRANSACTIONS - i),
+            type=rand.choice(["DEPOSIT", "WITHDRAWAL", "TRANSFER", "OTHER"]),
+        )
+        for i in range(TRANSACTIONS)
+    ]
+
+
+async def _run(counters_enabled: bool) -> Counter:
+    config.get_settings().RULE_WINDOW_COUNTERS_ENABLED = counters_enabled
+    db = mongo_client()["bench"]
+    collection_class = type(db["transaction"])
+    calls = Counter()
+
+    def counting(name):
+        original = getattr(collection_class, name)
+
+        def wrapper(self, *args, **kwargs):
+            calls[name] += 1
+            return original(self, *args, **kwargs)
+
+        return wrapper
+
+    with mock.patch("connections.connections.redis") as _redis, mock.patch.multiple(
+        collection_class, **{name: counting(name) for name in READS}
+    ):
+        # Flags are never cached so every lookup reaches the window check
+        _redis.mget.return_value = [None, None]
+        for payload in _payloads():
+            await NewTransaction(transaction=payload, database=db)()
+    return calls
+
+
+async def main():
+    for enabled in [False, True]:
+        calls = await _run(counters_enabled=enabled)
+        reads = sum(calls.values())
+        print(
+            f"window counters {'on ' if enabled else 'off'}: "
+            f"{reads} reads, {reads / TRANSACTIONS:.2f} per transaction "
+            f"({dict(calls)})"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
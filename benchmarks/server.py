@@ -0,0 +1,160 @@
+"""
+Compares the development entrypoint (python main.py: one process with the
+reloader) against python -m commands.serve, each started as its own process
+tree serving benchmarks.stand_in_app.
+
+For each it reports the seconds from starting the command to the first
+answered request, then throughput and latency for POST /transactions and
+GET /transactions/suspicious/{user_id} from concurrent keep-alive clients.
+
+    python -m benchmarks.server [--workers 4] [--requests 4000]
+        [--concurrency 64]
+
+Every worker has its own stand-ins, so this measures the serving stack and
+how it spreads over CPUs rather than MongoDB or Redis.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import List
+
+from benchmarks.load import _free_port, _HttpConnection, drive, summarise
+from benchmarks.synthetic import SyntheticStream
+from collections import Counter
+
+APP = "benchmarks.stand_in_app:app"
+
+
+def _commands(port: int, workers: int) -> dict:
+    return {
+        # What main.py runs
+        "development": [
+            sys.executable,
+            "-c",
+            "import uvicorn; uvicorn.run("
+            f"{APP!r}, host='127.0.0.1', port={port}, log_level='warning', "
+            "reload=True)",
+        ],
+        "production": [
+            sys.executable,
+            "-m",
+            "commands.serve",
+            "--app",
+            APP,
+            "--host",
+            "127.0.0.1",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+        ],
+    }
+
+
+async def _started(port: int, process: subprocess.Popen, timeout: float) -> float:
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if process.poll() is not None:
+            raise RuntimeError("The server exited while starting")
+        try:
+            connection = _HttpConnection("127.0.0.1", port)
+            await connection.open()
+        except OSError:
+            await asyncio.sleep(0.02)
+            continue
+        try:
+            if await connection.request("GET", "/metrics", None) == 200:
+                return time.perf_counter() - started
+        except (OSError, asyncio.IncompleteReadError, IndexError):
+            pass
+        finally:
+            await connection.close()
+        await asyncio.sleep(0.02)
+    raise RuntimeError("The server didn't start in time")
+
+
+async def run(mode: str, args: argparse.Namespace) -> dict:
+    stream = SyntheticStream(users=args.users, seed=args.seed)
+    ingest = [
+        ("POST", "/transactions", json.dumps(t).encode())
+        for t in stream.transactions(args.requests)
+    ]
+    queries = [
+        ("GET", f"/transactions/suspicious/{stream.user_id()}", None)
+        for _ in range(args.requests)
+    ]
+
+    port = _free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        _commands(port, args.workers)[mode],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        env={**os.environ, "CONNECTIONS_WARM_UP": "false"},
+        start_new_session=True,
+    )
+    opened: List[_HttpConnection] = []
+    try:
+        await _started(port, process, timeout=60)
+        results = {"startup_seconds": round(time.perf_counter() - started, 3)}
+
+        async def connect():
+            connection = _HttpConnection("127.0.0.1", port)
+            await connection.open()
+            opened.append(connection)
+            return connection.request
+
+        for phase, requests in [("ingest", ingest), ("query", queries)]:
+            latencies, errors, seconds = await drive(
+                connect, requests, args.concurrency
+            )
+            results[phase] = summarise(latencies, errors, seconds, Counter(), Counter())
+            for key in ["mongo_ops_per_request", "redis_ops_per_request"]:
+                del results[phase][key]
+        return results
+    finally:
+        for connection in opened:
+            await connection.close()
+        # The whole tree, the reloader and uvicorn's supervisor have children
+        os.killpg(process.pid, signal.SIGINT)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+
+
+async def main(args: argparse.Namespace):
+    report = {}
+    for mode in ["development", "production"]:
+        report[mode] = await run(mode, args)
+        print(f"{mode:>11}: started in {report[mode]['startup_seconds']}s")
+        for phase in ["ingest", "query"]:
+            summary = report[mode][phase]
+            print(
+                f"{'':>11}  {phase:>6}: {summary['throughput_rps']} req/s "
+                f"({summary['errors']} errors), p50 {summary['p50_ms']}ms "
+                f"p99 {summary['p99_ms']}ms"
+            )
+    return report
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--workers", type=int, default=0, help="for production, 0 is one per CPU"
+    )
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
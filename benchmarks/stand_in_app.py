@@ -0,0 +1,13 @@
+"""
+The app against in memory stand-ins for MongoDB and Redis, for serving in
+separate processes from benchmarks.server. Each worker has its own.
+"""
+
+from benchmarks.stand_ins import InMemoryRedis, mongo_client
+from connections import connections
+from main import remodemo_app
+
+connections.db = mongo_client()["bench"]
+connections.redis = InMemoryRedis()
+
+app = remodemo_app()
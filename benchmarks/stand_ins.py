@@ -0,0 +1,121 @@
+"""
+Local stand-ins for MongoDB and Redis so the benchmarks run offline, with
+counts of the operations made against them.
+"""
+
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+
+from benchmarks.mongomock_compat import allow_bulk_write_sort, keep_partial_indexes
+
+MONGO_OPERATIONS = [
+    "insert_one",
+    "insert_many",
+    "find",
+    "find_one",
+    "count_documents",
+    "aggregate",
+    "update_one",
+    "update_many",
+    "bulk_write",
+    "delete_many",
+]
+
+
+class InMemoryRedis:
+    """
+    The subset of redis.asyncio.Redis the app uses, kept in a dict. Every
+    command is counted in `calls`.
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+        # key -> (value, expires at or None)
+        self._store: Dict[str, Tuple[bytes, Optional[float]]] = {}
+
+    def _get(self, key):
+        entry = self._store.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            del self._store[key]
+            return None
+        return entry[0]
+
+    @staticmethod
+    def _encode(value) -> bytes:
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    async def ping(self):
+        self.calls["ping"] += 1
+        return True
+
+    async def get(self, key):
+        self.calls["get"] += 1
+        return self._get(key)
+
+    async def mget(self, *keys):
+        self.calls["mget"] += 1
+        return [self._get(key) for key in keys]
+
+    async def set(self, key, value, ex=None, nx=False):
+        self.calls["set"] += 1
+        if nx and self._get(key) is not None:
+            return None
+        expires = time.monotonic() + ex if ex is not None else None
+        self._store[key] = (self._encode(value), expires)
+        return True
+
+    async def incr(self, key):
+        self.calls["incr"] += 1
+        entry = self._store.get(key)
+        value = int(self._get(key) or 0) + 1
+        self._store[key] = (self._encode(value), entry[1] if entry else None)
+        return value
+
+    async def delete(self, *keys):
+        self.calls["delete"] += 1
+        return sum(self._store.pop(key, None) is not None for key in keys)
+
+    async def aclose(self):
+        pass
+
+
+def mongo_client() -> AsyncMongoMockClient:
+    # The same patches the tests use
+    allow_bulk_write_sort()
+    keep_partial_indexes()
+    return AsyncMongoMockClient()
+
+
+@contextmanager
+def counting_mongo_operations(calls: Counter):
+    """
+    Counts each Mongo collection operation made while inside, for every
+    mongomock collection.
+    """
+    collection_class = type(AsyncMongoMockClient()["counting"]["counting"])
+
+    def counting(name):
+        original = getattr(collection_class, name)
+
+        def wrapper(self, *args, **kwargs):
+            calls[name] += 1
+            return original(self, *args, **kwargs)
+
+        return wrapper
+
+    with mock.patch.multiple(
+        collection_class,
+        **{
+            name: counting(name)
+            for name in MONGO_OPERATIONS
+            if hasattr(collection_class, name)
+        },
+    ):
+        yield calls
@@ -0,0 +1,99 @@
+"""
+Documents per second for GET /transactions/suspicious/{user_id} on a user
+with 100k suspicious transactions, validating each document into a model and
+encoding through a dict (before), serializing the models (models) and
+serializing the documents straight to bytes (documents).
+
+    python -m benchmarks.suspicious_reads [--documents 100000] [--with-read]
+
+The documents are built in memory in the shape the read returns them.
+Reading them from mongomock runs at around a thousand documents a second,
+which hides everything else, so it's only included with --with-read.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import time
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+
+from benchmarks.stand_ins import mongo_client
+from models.db.transaction_model import TransactionModel
+from repositories.transaction_repository import TransactionRepository
+
+USER_ID = "user1234"
+
+
+def _documents(count: int):
+    start = datetime.datetime(2024, 1, 1)
+    return [
+        {
+            "_id": ObjectId(),
+            "user_id": USER_ID,
+            "amount": 10_000.0 + i,
+            "currency": "USD",
+            "timestamp": start + datetime.timedelta(milliseconds=i * 250),
+            "type": "TRANSFER",
+            "is_suspicious": True,
+            "suspicious_reasons": ["HIGH_VOLUME_TRANSACTION", "RAPID_TRANSFERS"],
+        }
+        for i in range(count)
+    ]
+
+
+def _before(documents) -> bytes:
+    transactions = [TransactionModel(**d) for d in documents]
+    return json.dumps(
+        jsonable_encoder([t.to_dict_json() for t in transactions])
+    ).encode()
+
+
+def _models(documents) -> bytes:
+    transactions = [TransactionModel(**d) for d in documents]
+    return TransactionModel.list_to_json_bytes(transactions)
+
+
+def _documents_to_bytes(documents) -> bytes:
+    return TransactionModel.stored_list_to_json_bytes(documents)
+
+
+PATHS = {
+    "before": _before,
+    "models": _models,
+    "documents": _documents_to_bytes,
+}
+
+
+def _rate(count: int, seconds: float) -> str:
+    return f"{count / seconds:12,.0f} docs/s"
+
+
+async def main(count: int, with_read: bool):
+    documents = _documents(count)
+    read = 0.0
+    if with_read:
+        db = mongo_client()["bench"]
+        await db["transaction"].insert_many(documents)
+        started = time.perf_counter()
+        documents = await TransactionRepository(
+            db=db
+        ).get_suspicious_documents_for_user(USER_ID)
+        read = time.perf_counter() - started
+        print(f"{'read':>10}: {_rate(count, read)}")
+
+    for name, path in PATHS.items():
+        started = time.perf_counter()
+        path(documents)
+        seconds = time.perf_counter() - started + read
+        print(f"{name:>10}: {_rate(count, seconds)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=100_000)
+    parser.add_argument("--with-read", action="store_true")
+    args = parser.parse_args()
+    asyncio.run(main(args.documents, args.with_read))
@@ -0,0 +1,83 @@
+"""
+Synthetic transaction streams for the benchmarks.
+"""
+
+import datetime
+import itertools
+import random
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, Optional
+
+
+@dataclass
+class SyntheticStream:
+    """
+    Transactions for `users` users. With `skew` above 0 users are picked with
+    a Zipf like weighting so a few hot users send most of the transactions,
+    0 picks them uniformly.
+
+    Amounts are small (at most 100) with probability `small_fraction`, over
+    the high volume threshold with probability `large_fraction` and log
+    normally distributed around `typical_amount` otherwise. Timestamps are
+    `interval_seconds` apart and end at `end` (now by default).
+    """
+
+    users: int = 1000
+    skew: float = 1.1
+    type_mix: Dict[str, float] = field(
+        default_factory=lambda: {
+            "DEPOSIT": 0.35,
+            "WITHDRAWAL": 0.25,
+            "TRANSFER": 0.3,
+            "OTHER": 0.1,
+        }
+    )
+    small_fraction: float = 0.4
+    large_fraction: float = 0.02
+    typical_amount: float = 500.0
+    currency: str = "USD"
+    interval_seconds: float = 0.5
+    end: Optional[datetime.datetime] = None
+    seed: int = 1
+
+    def __post_init__(self):
+        self._rand = random.Random(self.seed)
+        self._user_ids = [f"user{i}" for i in range(self.users)]
+        self._user_weights = list(
+            itertools.accumulate(
+                1 / (rank**self.skew) for rank in range(1, self.users + 1)
+            )
+        )
+        self._types = list(self.type_mix)
+        self._type_weights = list(itertools.accumulate(self.type_mix.values()))
+
+    def user_id(self) -> str:
+        return self._rand.choices(self._user_ids, cum_weights=self._user_weights)[0]
+
+    def amount(self) -> float:
+        roll = self._rand.random()
+        if roll < self.small_fraction:
+            return round(self._rand.uniform(1, 100), 2)
+        if roll < self.small_fraction + self.large_fraction:
+            return round(self._rand.uniform(10_001, 50_000), 2)
+        return round(self._rand.lognormvariate(0, 0.75) * self.typical_amount, 2)
+
+    def transactions(self, count: int) -> Iterator[dict]:
+        """
+        `count` transaction payloads as JSON ready dicts, oldest first.
+        """
+        end = self.end or datetime.datetime.now(datetime.timezone.utc)
+        start = end - datetime.timedelta(seconds=self.interval_seconds * count)
+        for i in range(count):
+            yield {
+                "user_id": self.user_id(),
+                "amount": self.amount(),
+                "currency": self.currency,
+                "timestamp": (
+                    start + datetime.timedelta(seconds=self.interval_seconds * i)
+                ).isoformat(),
+                "type": self.type(),
+            }
+
+    def type(self) -> str:
+        return self._rand.choices(self._types, cum_weights=self._type_weights)[0]
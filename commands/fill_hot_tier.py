@@ -0,0 +1,35 @@
+"""
+Copies the last TRANSACTION_HOT_SECONDS of transactions into the hot tier,
+after turning on TRANSACTION_HOT_TIER with history already stored.
+
+    python -m commands.fill_hot_tier [--batch-size 1000]
+
+Run it straight after the workers restart with the hot tier on, until it has
+finished the windowed rules can under count. Running it again is harmless.
+"""
+
+import argparse
+import asyncio
+import json
+
+from connections import connections
+from repositories.partitioned_transaction_repository import transaction_repository_for
+from repositories.transaction_repository import settings
+
+
+async def main(batch_size: int):
+    repo = transaction_repository_for(
+        connections.db, hot_seconds=settings.TRANSACTION_HOT_SECONDS
+    )
+    await repo.ensure_indexes()
+    copied = await repo.fill_hot_tier(batch_size=batch_size)
+    print(json.dumps({"copied": copied}, indent=2))
+
+    await connections.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(main(batch_size=args.batch_size))
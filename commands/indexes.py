@@ -0,0 +1,72 @@
+"""
+Reports the declared transaction indexes that are missing from the database
+and the query plan for each repository query.
+
+    python -m commands.indexes [--user-id user1234] [--create]
+"""
+
+import argparse
+import asyncio
+import json
+
+from connections import connections
+from repositories.partitioned_transaction_repository import transaction_repository_for
+
+
+def _winning_stages(plan: dict) -> str:
+    # Walks the winning plan down to the leaf, e.g. FETCH <- IXSCAN(user_id_...)
+    stages = []
+    stage = plan
+    while stage:
+        name = stage.get("stage", "?")
+        if "indexName" in stage:
+            name = f"{name}({stage['indexName']})"
+        stages.append(name)
+        stage = stage.get("inputStage")
+    return " <- ".join(stages)
+
+
+def _winning_plan(explain: dict) -> dict:
+    if "queryPlanner" in explain:
+        return explain["queryPlanner"]["winningPlan"]
+    # Aggregations nest the find plan in their first stage
+    for stage in explain.get("stages", []):
+        if "$cursor" in stage:
+            return stage["$cursor"]["queryPlanner"]["winningPlan"]
+    return {}
+
+
+async def main(user_id: str, create: bool, verbose: bool):
+    repo = transaction_repository_for(connections.db)
+    if create:
+        await repo.ensure_indexes()
+
+    missing = await repo.missing_indexes()
+    if missing:
+        print("Missing indexes:")
+        for index in missing:
+            print(f"  {index.document['name']}: {dict(index.document['key'])}")
+    else:
+        print("All declared indexes exist")
+
+    print()
+    print(f"Query plans for user {user_id}:")
+    for query, explain in (await repo.explain_queries(user_id=user_id)).items():
+        print(f"  {query}: {_winning_stages(_winning_plan(explain))}")
+        if verbose:
+            print(json.dumps(explain, indent=2, default=str))
+
+    await connections.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--user-id", default="user1234")
+    parser.add_argument(
+        "--create", action="store_true", help="create missing indexes first"
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="print the full explain output"
+    )
+    args = parser.parse_args()
+    asyncio.run(main(user_id=args.user_id, create=args.create, verbose=args.verbose))
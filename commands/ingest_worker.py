@@ -0,0 +1,55 @@
+"""
+Runs ingest workers that write the transactions queued by
+POST /transactions?mode=async, in this process rather than the app's.
+
+    python -m commands.ingest_worker [--workers 4] [--consumer name]
+
+These write alongside the app, so the rule windows, user locks and suspicious
+feed have to be shared in Redis (RULE_WINDOW_STORE=redis, USER_LOCKS=redis,
+SUSPICIOUS_FEED=redis, or the feed off).
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+
+import config
+from connections import connections
+from services.rules.rule_engine import rule_engine
+from services.transaction.ingest_queue import ingest_workers
+
+settings = config.get_settings()
+
+
+async def main(workers: int, consumer: str):
+    local = settings.process_local()
+    if local:
+        raise SystemExit(
+            f"{', '.join(local)} isn't shared with the app or other ingest "
+            "workers, keep them in Redis"
+        )
+    await rule_engine.start(connections.db)
+    ingest_workers.start(connections.db, count=workers, consumer=consumer)
+    try:
+        # The workers run until the process is stopped
+        await asyncio.Event().wait()
+    finally:
+        await ingest_workers.stop()
+        await rule_engine.stop()
+        await connections.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--consumer",
+        default=f"{socket.gethostname()}-{os.getpid()}",
+        help="Name in the consumer group, unique per process",
+    )
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(workers=args.workers, consumer=args.consumer))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,39 @@
+"""
+Moves users' transactions to the partitions the hash ring gives them, after
+adding to MONGO_PARTITIONS.
+
+    python -m commands.rebalance_partitions [--batch-size 1000] [--dry-run]
+
+Keep the app running with MONGO_PARTITIONS_PREVIOUS set to the partitions
+from before the change until this has finished, then unset it. Rescoring and
+rebuilding risk summaries should wait until then too, a user part way
+through being moved is in both partitions.
+"""
+
+import argparse
+import asyncio
+import json
+
+from connections import connections
+from repositories.partitioned_transaction_repository import transaction_repository_for
+from services.transaction.rebalance_partitions import RebalancePartitions
+
+
+async def main(batch_size: int, dry_run: bool):
+    await transaction_repository_for(connections.db).ensure_indexes()
+    result = await RebalancePartitions(
+        database=connections.db, batch_size=batch_size, dry_run=dry_run
+    )()
+    print(json.dumps(result, indent=2))
+
+    await connections.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument(
+        "--dry-run", action="store_true", help="count what would move, move nothing"
+    )
+    args = parser.parse_args()
+    asyncio.run(main(batch_size=args.batch_size, dry_run=args.dry_run))
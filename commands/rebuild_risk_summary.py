@@ -0,0 +1,39 @@
+"""
+Recomputes the user_risk_summary documents from the stored transactions, for
+every user or the ones given.
+
+    python -m commands.rebuild_risk_summary [--user-id user1234 ...]
+        [--batch-size 1000]
+
+Rescoring rebuilds the users it changes itself. Run this after turning
+RISK_SUMMARY_ENABLED on with transactions already written, after changing
+transactions outside the app, or when a process stopped between writing
+transactions and adding them to the summaries.
+"""
+
+import argparse
+import asyncio
+import json
+from typing import List, Optional
+
+from connections import connections
+from services.transaction.risk_summary import RebuildRiskSummaries
+
+
+async def main(user_ids: Optional[List[str]], batch_size: int):
+    result = await RebuildRiskSummaries(
+        database=connections.db, user_ids=user_ids, batch_size=batch_size
+    )()
+    print(json.dumps(result, indent=2))
+
+    await connections.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--user-id", dest="user_ids", action="append", help="All users if not given"
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(main(user_ids=args.user_ids, batch_size=args.batch_size))
@@ -0,0 +1,40 @@
+"""
+Reloads the rule windows kept in Redis (RULE_WINDOW_STORE=redis) from the
+stored transactions, for every user or the ones given.
+
+    python -m commands.rebuild_windows [--user-id user1234 ...]
+
+Not needed after Redis is flushed, each user's windows are loaded the next
+time they're seen, but it saves those first transactions the MongoDB reads.
+"""
+
+import argparse
+import asyncio
+import json
+from typing import List, Optional
+
+from connections import connections
+from repositories.partitioned_transaction_repository import transaction_repository_for
+from services.rules.redis_windows import redis_windows_for
+from services.rules.rule_engine import rule_engine
+
+
+async def main(user_ids: Optional[List[str]]):
+    transaction_repo = transaction_repository_for(connections.db)
+    if user_ids is None:
+        user_ids = [user_id async for user_id in transaction_repo.iter_user_ids()]
+    await rule_engine.load(connections.db)
+    windows = redis_windows_for(rule_engine.plan.windows, connections.redis)
+    users = await windows.rebuild(transaction_repo, user_ids)
+    print(json.dumps({"users": users}, indent=2))
+
+    await connections.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--user-id", dest="user_ids", action="append", help="All users if not given"
+    )
+    args = parser.parse_args()
+    asyncio.run(main(user_ids=args.user_ids))
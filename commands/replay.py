@@ -0,0 +1,52 @@
+"""
+Replays historical transactions through the rules into a database, judging
+each one as of its own timestamp rather than the clock.
+
+    python -m commands.replay --input transactions.jsonl --database replay
+        [--batch-size 1000]
+
+The input has one transaction per line in the POST /transactions format.
+"""
+
+import argparse
+import asyncio
+import json
+
+from connections import connections
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from repositories.partitioned_transaction_repository import transaction_repository_for
+from services.rules.rule_engine import rule_engine
+from services.transaction.replay_transactions import ReplayTransactions
+
+
+async def main(input: str, database: str, batch_size: int):
+    with open(input) as f:
+        transactions = [
+            NewTransactionPayload.model_validate_json(line)
+            for line in f
+            if line.strip()
+        ]
+
+    db = connections.database(database)
+    await transaction_repository_for(db).ensure_indexes()
+    await rule_engine.load(connections.db)
+
+    result = await ReplayTransactions(
+        transactions=transactions, database=db, batch_size=batch_size
+    )()
+    print(json.dumps(result, indent=2))
+
+    await connections.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--input", required=True, help="JSON lines of transactions")
+    parser.add_argument(
+        "--database", required=True, help="Database to replay into, best empty"
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(
+        main(input=args.input, database=args.database, batch_size=args.batch_size)
+    )
@@ -0,0 +1,71 @@
+"""
+Rescores every stored transaction against the current rules, or the rules in
+a JSON file, and updates the verdicts that changed.
+
+    python -m commands.rescore [--rules rules.json] [--workers 8]
+        [--checkpoint rescore.json] [--users-per-range 1000] [--batch-size 1000]
+
+Interrupted runs carry on from the checkpoint when run again with the same
+rules.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+
+from connections import connections
+from models.db.rule_model import RuleSetModel
+from services.rules.rule_engine import rule_engine
+from services.transaction.rescore_transactions import RescoreJob
+
+
+async def main(
+    rules: str,
+    workers: int,
+    checkpoint: str,
+    users_per_range: int,
+    batch_size: int,
+):
+    if rules:
+        with open(rules) as f:
+            rule_set = RuleSetModel.model_validate_json(f.read())
+    else:
+        await rule_engine.load(connections.db)
+        rule_set = RuleSetModel(rules=rule_engine.plan.rules)
+
+    result = await RescoreJob(
+        rule_set=rule_set,
+        database=connections.db,
+        checkpoint=checkpoint,
+        workers=workers,
+        users_per_range=users_per_range,
+        batch_size=batch_size,
+    )()
+    print(json.dumps(result, indent=2))
+
+    await connections.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rules", help="JSON file of rules, the loaded ones if not")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Processes to split users across, 0 for this one",
+    )
+    parser.add_argument("--checkpoint", default="rescore.json")
+    parser.add_argument("--users-per-range", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(
+        main(
+            rules=args.rules,
+            workers=args.workers,
+            checkpoint=args.checkpoint,
+            users_per_range=args.users_per_range,
+            batch_size=args.batch_size,
+        )
+    )
@@ -0,0 +1,48 @@
+"""
+Shows the rules the app would load and how they're evaluated, or saves the
+rules in a JSON file to MongoDB for apps with RULES_SOURCE=mongo.
+
+    python -m commands.rules [--save rules.json]
+"""
+
+import argparse
+import asyncio
+
+from connections import connections
+from models.db.rule_model import RuleSetModel
+from repositories.rule_repository import RuleRepository
+from services.rules.rule_engine import rule_engine
+
+
+async def main(save: str):
+    if save:
+        with open(save) as f:
+            rules = RuleSetModel.model_validate_json(f.read()).rules
+        rule_set = await RuleRepository(db=connections.db).save_rules(rules)
+        print(f"Saved {len(rule_set.rules)} rules as version {rule_set.version}")
+
+    await rule_engine.load(connections.db)
+    plan = rule_engine.plan
+    print(f"Rules from {rule_engine.settings.RULES_SOURCE}:")
+    for rule in plan.rules:
+        window = plan.window_of(rule)
+        print(
+            f"  {rule.name}: {rule.reason.value} "
+            f"{rule.filter.model_dump(mode='json', exclude_none=True)}"
+            + (f" counted by {window.name}" if window else "")
+        )
+    print(f"{len(plan.windows)} windows, looked up together:")
+    for window in plan.windows:
+        print(
+            f"  {window.name}: last {window.minutes} minutes, "
+            f"up to {window.threshold}"
+        )
+
+    await connections.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--save", help="JSON file of rules to save to MongoDB")
+    args = parser.parse_args()
+    asyncio.run(main(save=args.save))
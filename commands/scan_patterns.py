@@ -0,0 +1,77 @@
+"""
+Scans the transactions of every user for structuring and coordinated bursts,
+adding the reasons to the transactions found.
+
+    python -m commands.scan_patterns [--minutes 60] [--until 2024-01-01T12:00]
+        [--every [SECONDS]] [--batch-size 10000]
+
+Without --every it scans the --minutes up to --until (now) once. With it the
+scan is repeated every SECONDS (SCANNER_INTERVAL_SECONDS) over the minutes
+up to the latest whole minute, so each minute is scanned in several windows
+while late transactions arrive.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+from typing import Optional
+
+from connections import connections
+from services.rules.pattern_scanner import ScanPatterns, settings, window_ending
+from services.rules.rule_engine import rule_engine
+
+
+async def main(
+    minutes: int,
+    until: Optional[datetime.datetime],
+    every: Optional[float],
+    batch_size: int,
+):
+    await rule_engine.start(connections.db)
+    try:
+        while True:
+            since, end = window_ending(
+                until or datetime.datetime.utcnow(), minutes=minutes
+            )
+            result = await ScanPatterns(
+                since=since, until=end, database=connections.db, batch_size=batch_size
+            )()
+            print(json.dumps(result, indent=2), flush=True)
+            if every is None:
+                break
+            await asyncio.sleep(every)
+    finally:
+        await rule_engine.stop()
+        await connections.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--minutes", type=int, default=settings.SCANNER_WINDOW_MINUTES)
+    when = parser.add_mutually_exclusive_group()
+    when.add_argument(
+        "--until",
+        type=datetime.datetime.fromisoformat,
+        help="UTC, the window ends at the start of its minute. Now if not given",
+    )
+    when.add_argument(
+        "--every",
+        type=float,
+        nargs="?",
+        const=settings.SCANNER_INTERVAL_SECONDS,
+        help="Seconds between scans, scans once if not given",
+    )
+    parser.add_argument("--batch-size", type=int, default=settings.SCANNER_BATCH_SIZE)
+    args = parser.parse_args()
+    try:
+        asyncio.run(
+            main(
+                minutes=args.minutes,
+                until=args.until,
+                every=args.every,
+                batch_size=args.batch_size,
+            )
+        )
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,82 @@
+"""
+Runs the app for production: several worker processes, uvloop and httptools
+when they're installed (pip install "uvicorn[standard]"), no reloader.
+
+    python -m commands.serve [--workers 4] [--host 0.0.0.0] [--port 8000]
+
+Workers default to SERVER_WORKERS, or one per CPU this process may run on.
+Several workers need the rule windows, user locks and suspicious feed shared
+in Redis (RULE_WINDOW_STORE=redis, USER_LOCKS=redis, SUSPICIOUS_FEED=redis),
+otherwise one is run.
+"""
+
+import argparse
+import importlib
+import importlib.util
+import os
+
+import uvicorn
+
+import config
+
+settings = config.get_settings()
+
+
+def worker_count(workers: int = 0, settings: config.Settings = settings) -> int:
+    # Workers keeping their own windows, locks and feed would each count,
+    # lock and publish only the transactions they were sent
+    local = settings.process_local()
+    if workers > 1 and local:
+        raise SystemExit(
+            f"{', '.join(local)} only holds for one worker, keep them in Redis "
+            f"to run {workers}"
+        )
+    if workers > 0:
+        return workers
+    if local:
+        print(f"Running one worker, {', '.join(local)} only holds for one")
+        return 1
+    if hasattr(os, "sched_getaffinity"):
+        # Respects CPU pinning and container cpusets, cpu_count doesn't
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def preload(app: str):
+    """
+    Imports the app before any workers start, so one that can't be built
+    fails here once rather than in every worker. Nothing connects on import,
+    the workers' clients are created in their own lifespans.
+    """
+    module, _, attribute = app.partition(":")
+    getattr(importlib.import_module(module), attribute)
+
+
+def main(app: str, host: str, port: int, workers: int):
+    preload(app)
+    workers = worker_count(workers)
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    print(f"Serving {app} with {workers} workers on {loop} and {http}")
+    uvicorn.run(
+        app,
+        host=host,
+        port=port,
+        workers=workers,
+        loop=loop,
+        http=http,
+        lifespan="on",
+        # Requests are already counted and timed by the metrics middleware
+        access_log=False,
+        log_level="info",
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--app", default="main:app")
+    parser.add_argument("--host", default=settings.SERVER_HOST)
+    parser.add_argument("--port", type=int, default=settings.SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=settings.SERVER_WORKERS)
+    args = parser.parse_args()
+    main(app=args.app, host=args.host, port=args.port, workers=args.workers)
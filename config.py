@@ -1,5 +1,7 @@
 from functools import lru_cache
 
+from typing import Dict, List, Literal, Optional, Union
+
 from pydantic_settings import BaseSettings
 
 
@@ -8,12 +10,133 @@ class Settings(BaseSettings):
     MONGO_PASSWORD: str = "password007"
     MONGO_CONNECTION_STRING: str = "mongodb://localhost"
     MONGO_DATABASE: str = "remodemo"
+    # Write concern for inserts, unset leaves the server default
+    MONGO_WRITE_CONCERN_W: Optional[Union[int, str]] = None
+    MONGO_WRITE_CONCERN_JOURNAL: Optional[bool] = None
+    # Spread the transactions over several MongoDB deployments by user_id,
+    # partition name to connection string (JSON in the environment).
+    # Everything else stays on MONGO_CONNECTION_STRING. After adding
+    # partitions set MONGO_PARTITIONS_PREVIOUS to the names before, until
+    # commands.rebalance_partitions has moved the users across.
+    MONGO_PARTITIONS: Dict[str, str] = {}
+    MONGO_PARTITIONS_PREVIOUS: List[str] = []
+    MONGO_PARTITION_VNODES: int = 256
     REDIS_HOST: str = "localhost"
     REDIS_PORT: int = 6379
+    # Connection pools, timeouts are in milliseconds for Mongo and seconds for
+    # Redis to match their clients
+    MONGO_MAX_POOL_SIZE: int = 100
+    MONGO_MIN_POOL_SIZE: int = 0
+    MONGO_CONNECT_TIMEOUT_MS: int = 5_000
+    MONGO_SOCKET_TIMEOUT_MS: int = 10_000
+    MONGO_SERVER_SELECTION_TIMEOUT_MS: int = 5_000
+    MONGO_WAIT_QUEUE_TIMEOUT_MS: int = 5_000
+    REDIS_MAX_CONNECTIONS: int = 50
+    REDIS_POOL_TIMEOUT: float = 5.0
+    REDIS_SOCKET_TIMEOUT: float = 5.0
+    REDIS_SOCKET_CONNECT_TIMEOUT: float = 2.0
+    REDIS_HEALTH_CHECK_INTERVAL: int = 30
+    # Ping both backends on startup, and how long shutdown waits for
+    # connections in use to be returned
+    CONNECTIONS_WARM_UP: bool = True
+    CONNECTIONS_DRAIN_SECONDS: float = 10.0
+    # Answer the windowed rules from in process counters rather than querying
+    # Mongo every time. Only accurate while a single process writes per user.
+    RULE_WINDOW_COUNTERS_ENABLED: bool = True
+    RULE_WINDOW_COUNTERS_MAX_USERS: int = 100_000
+    # "redis" keeps the counts in Redis instead, shared by every worker.
+    # Transactions up to RULE_WINDOW_REDIS_LATE_SECONDS older than a user's
+    # newest are still counted there, older ones are counted in Mongo.
+    RULE_WINDOW_STORE: Literal["process", "redis"] = "process"
+    RULE_WINDOW_REDIS_LATE_SECONDS: int = 3600
+    RULE_WINDOW_REDIS_LOAD_LIMIT: int = 10_000
+    # Also keep the last TRANSACTION_HOT_SECONDS of transactions (by their
+    # timestamp) in a small TTL collection of their own, which the rules'
+    # window queries read instead of the full history. Needs to cover the
+    # widest rule window and RULE_WINDOW_REDIS_LATE_SECONDS.
+    TRANSACTION_HOT_TIER: bool = False
+    TRANSACTION_HOT_SECONDS: int = 86_400
+    # Writes for the same user are evaluated and inserted one at a time so
+    # they count each other. "process" covers a single worker, "redis" every
+    # worker sharing the Redis, "off" lets them race.
+    USER_LOCKS: Literal["off", "process", "redis"] = "process"
+    USER_LOCK_TIMEOUT_SECONDS: float = 5.0
+    USER_LOCK_TTL_SECONDS: float = 10.0
+    # How long Redis remembers the transaction written for an idempotency key,
+    # retries after that are still answered from Mongo
+    IDEMPOTENCY_TTL_SECONDS: int = 86_400
+    # POST /transactions?mode=async queues transactions on a Redis Stream and
+    # answers straight away. INGEST_WORKERS consume it inside the app, or run
+    # python -m commands.ingest_worker. Past INGEST_MAX_QUEUED it answers 503.
+    INGEST_ASYNC_ENABLED: bool = False
+    INGEST_WORKERS: int = 0
+    INGEST_STREAM: str = "transactions:ingest"
+    INGEST_GROUP: str = "ingest_workers"
+    INGEST_MAX_QUEUED: int = 100_000
+    INGEST_BATCH_SIZE: int = 500
+    INGEST_BLOCK_MS: int = 1000
+    INGEST_CLAIM_IDLE_MS: int = 30_000
+    INGEST_STATUS_TTL_SECONDS: int = 86_400
+    # Where the rules come from, "default", "file" (RULES_FILE) or "mongo",
+    # and how often they're checked for changes
+    RULES_SOURCE: Literal["default", "file", "mongo"] = "default"
+    RULES_FILE: str = "rules.json"
+    RULES_RELOAD_SECONDS: float = 10.0
+    # Suspicious transactions are added to the user_risk_summary of their user
+    # as they're written, for GET /transactions/suspicious/{user_id}/summary
+    RISK_SUMMARY_ENABLED: bool = True
+    # Cached GET /transactions/suspicious/{user_id} responses
+    SUSPICIOUS_CACHE_MAX_ENTRIES: int = 10_000
+    SUSPICIOUS_CACHE_MAX_BODY_BYTES: int = 1_000_000
+    SUSPICIOUS_CACHE_TTL_SECONDS: int = 300
+    # GET /transactions/suspicious-feed pushes suspicious transactions as
+    # they're written. "process" only sees this worker's, "redis" every
+    # worker's through a Redis Stream capped at SUSPICIOUS_FEED_BACKLOG,
+    # which is also how far back a subscriber can resume. A subscriber more
+    # than SUSPICIOUS_FEED_BUFFER events behind is dropped.
+    SUSPICIOUS_FEED: Literal["off", "process", "redis"] = "process"
+    SUSPICIOUS_FEED_STREAM: str = "transactions:suspicious"
+    SUSPICIOUS_FEED_BACKLOG: int = 10_000
+    SUSPICIOUS_FEED_BUFFER: int = 1000
+    SUSPICIOUS_FEED_BLOCK_MS: int = 1000
+    SUSPICIOUS_FEED_HEARTBEAT_SECONDS: float = 15.0
+    # Fraction of requests that record their stage timings, they're logged
+    # when the request takes at least METRICS_SLOW_REQUEST_SECONDS. 0 is off.
+    METRICS_TRACE_SAMPLE_RATE: float = 0.0
+    METRICS_SLOW_REQUEST_SECONDS: float = 0.5
+    # python -m commands.scan_patterns, see services/rules/pattern_scanner.py.
+    # The structuring threshold defaults to the high volume rule's amount.
+    SCANNER_WINDOW_MINUTES: int = 60
+    SCANNER_INTERVAL_SECONDS: float = 300.0
+    SCANNER_BATCH_SIZE: int = 10_000
+    SCANNER_STRUCTURING_THRESHOLD: Optional[float] = None
+    SCANNER_STRUCTURING_BAND: float = 0.1
+    SCANNER_STRUCTURING_MIN_USERS: int = 3
+    SCANNER_BURST_MIN_USERS: int = 10
+    SCANNER_BURST_FACTOR: float = 5.0
+    # python -m commands.serve, 0 workers is one per CPU available
+    SERVER_HOST: str = "0.0.0.0"
+    SERVER_PORT: int = 8000
+    SERVER_WORKERS: int = 0
 
     class Config:
         env_file = ".env"
 
+    def process_local(self) -> List[str]:
+        """
+        The settings that keep the rule windows, user locks or suspicious
+        feed in each process, which only hold while one process writes
+        transactions.
+        """
+        local = []
+        if self.RULE_WINDOW_COUNTERS_ENABLED and self.RULE_WINDOW_STORE == "process":
+            local.append("RULE_WINDOW_STORE=process")
+        if self.USER_LOCKS == "process":
+            local.append("USER_LOCKS=process")
+        if self.SUSPICIOUS_FEED == "process":
+            local.append("SUSPICIOUS_FEED=process")
+        return local
+
 
 @lru_cache()
 def get_settings():
@@ -0,0 +1,261 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+import motor.motor_asyncio
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import monitoring
+from redis.asyncio import BlockingConnectionPool, Redis
+
+import config
+from repositories.partitions import TransactionPartitions, set_partitions
+
+logger = logging.getLogger(__name__)
+
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    """
+    Counts the connections in the Mongo pools so utilisation can be reported,
+    Motor doesn't expose it otherwise.
+    """
+
+    def __init__(self):
+        self.open = 0
+        self.in_use = 0
+        self.check_out_failures = 0
+
+    def connection_created(self, event):
+        self.open += 1
+
+    def connection_closed(self, event):
+        self.open -= 1
+
+    def connection_checked_out(self, event):
+        self.in_use += 1
+
+    def connection_checked_in(self, event):
+        self.in_use -= 1
+
+    def connection_check_out_failed(self, event):
+        self.check_out_failures += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+
+class Connections:
+    """
+    The Mongo and Redis clients shared by everything in a process.
+
+    Clients are only created when first used or when `start` is called from
+    the app's lifespan, never on import. `close` waits for connections in use
+    to be returned before closing the pools.
+    """
+
+    def __init__(
+        self,
+        settings: config.Settings,
+        mongo_client: Optional[AsyncIOMotorClient] = None,
+        redis: Optional[Redis] = None,
+    ):
+        self.settings = settings
+        self.mongo_pool = MongoPoolListener()
+        self._mongo_client = mongo_client
+        self._db: Optional[AsyncIOMotorDatabase] = None
+        self._redis = redis
+        # MONGO_PARTITIONS name -> client
+        self._partition_clients: Dict[str, AsyncIOMotorClient] = {}
+
+    @property
+    def mongo_client(self) -> AsyncIOMotorClient:
+        if self._mongo_client is None:
+            self._mongo_client = self._create_mongo_client()
+        return self._mongo_client
+
+    @property
+    def db(self) -> AsyncIOMotorDatabase:
+        # The same object every time, things like the rule window counters
+        # are kept per database object
+        if self._db is None:
+            self._db = self.database(self.settings.MONGO_DATABASE)
+        return self._db
+
+    def database(self, name: str) -> AsyncIOMotorDatabase:
+        """
+        A database on MONGO_CONNECTION_STRING. With MONGO_PARTITIONS its
+        transactions are in the database of the same name on each partition,
+        see transaction_repository_for.
+        """
+        database = self.mongo_client[name]
+        if self.settings.MONGO_PARTITIONS:
+            set_partitions(
+                database,
+                TransactionPartitions(
+                    {
+                        partition: self._partition_client(partition)[name]
+                        for partition in self.settings.MONGO_PARTITIONS
+                    },
+                    previous=self.settings.MONGO_PARTITIONS_PREVIOUS,
+                    vnodes=self.settings.MONGO_PARTITION_VNODES,
+                ),
+            )
+        return database
+
+    def _partition_client(self, partition: str) -> AsyncIOMotorClient:
+        if partition not in self._partition_clients:
+            self._partition_clients[partition] = self._create_mongo_client(
+                self.settings.MONGO_PARTITIONS[partition]
+            )
+        return self._partition_clients[partition]
+
+    @db.setter
+    def db(self, db: AsyncIOMotorDatabase):
+        self._db = db
+
+    @db.deleter
+    def db(self):
+        self._db = None
+
+    @property
+    def redis(self) -> Redis:
+        if self._redis is None:
+            self._redis = self._create_redis()
+        return self._redis
+
+    @redis.setter
+    def redis(self, redis: Redis):
+        self._redis = redis
+
+    @redis.deleter
+    def redis(self):
+        self._redis = None
+
+    async def start(self):
+        if self.settings.CONNECTIONS_WARM_UP:
+            await self.warm_up()
+
+    async def warm_up(self):
+        """
+        Opens a connection to each backend so the first requests don't pay
+        for it. A backend being down is logged rather than stopping startup,
+        requests will fail until it's back.
+        """
+        try:
+            await self.db.command("ping")
+        except Exception:
+            logger.warning("Could not reach MongoDB while warming up", exc_info=True)
+        try:
+            await self.redis.ping()
+        except Exception:
+            logger.warning("Could not reach Redis while warming up", exc_info=True)
+
+    def after_fork(self):
+        """
+        Forgets clients inherited from the parent process without closing
+        them, their sockets are still the parent's. The child creates its own
+        when they're first used.
+        """
+        self._mongo_client = None
+        self._db = None
+        self._redis = None
+        self._partition_clients = {}
+
+    async def close(self):
+        await self._drain()
+        if self._redis is not None:
+            await self._redis.aclose()
+        if self._mongo_client is not None:
+            self._mongo_client.close()
+        for client in self._partition_clients.values():
+            client.close()
+        self._partition_clients = {}
+        self._redis = None
+        self._mongo_client = None
+        self._db = None
+
+    async def _drain(self):
+        deadline = time.monotonic() + self.settings.CONNECTIONS_DRAIN_SECONDS
+        while time.monotonic() < deadline:
+            stats = self.stats()
+            if stats["mongo"]["in_use"] <= 0 and stats["redis"]["in_use"] <= 0:
+                return
+            await asyncio.sleep(0.05)
+        logger.warning("Closing connections that are still in use")
+
+    def stats(self) -> dict:
+        mongo = {
+            "max": self.settings.MONGO_MAX_POOL_SIZE,
+            "open": self.mongo_pool.open,
+            "in_use": self.mongo_pool.in_use,
+            "check_out_failures": self.mongo_pool.check_out_failures,
+        }
+        redis = {"max": self.settings.REDIS_MAX_CONNECTIONS, "open": 0, "in_use": 0}
+        pool = getattr(self._redis, "connection_pool", None)
+        if pool is not None and hasattr(pool, "_in_use_connections"):
+            in_use = len(pool._in_use_connections)
+            redis["in_use"] = in_use
+            redis["open"] = in_use + len(
+                [c for c in pool._available_connections if c is not None]
+            )
+        return {"mongo": mongo, "redis": redis}
+
+    def _create_mongo_client(
+        self, connection_string: Optional[str] = None
+    ) -> AsyncIOMotorClient:
+        settings = self.settings
+        if connection_string is None:
+            connection_string = settings.MONGO_CONNECTION_STRING
+        options = {}
+        if settings.MONGO_WRITE_CONCERN_W is not None:
+            options["w"] = settings.MONGO_WRITE_CONCERN_W
+        if settings.MONGO_WRITE_CONCERN_JOURNAL is not None:
+            options["journal"] = settings.MONGO_WRITE_CONCERN_JOURNAL
+        return motor.motor_asyncio.AsyncIOMotorClient(
+            host=f"{connection_string}/{settings.MONGO_DATABASE}",
+            username=settings.MONGO_USER,
+            password=settings.MONGO_PASSWORD,
+            maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+            minPoolSize=settings.MONGO_MIN_POOL_SIZE,
+            connectTimeoutMS=settings.MONGO_CONNECT_TIMEOUT_MS,
+            socketTimeoutMS=settings.MONGO_SOCKET_TIMEOUT_MS,
+            serverSelectionTimeoutMS=settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            waitQueueTimeoutMS=settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+            event_listeners=[self.mongo_pool],
+            **options,
+        )
+
+    def _create_redis(self) -> Redis:
+        settings = self.settings
+        # Blocking so a burst waits for a free connection rather than failing
+        pool = BlockingConnectionPool(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+            health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+        )
+        return Redis(connection_pool=pool)
+
+
+connections = Connections(settings=config.get_settings())
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=connections.after_fork)
@@ -0,0 +1,17 @@
+from fastapi import Request
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from redis.asyncio import Redis
+
+from connections import Connections
+
+
+def get_connections(request: Request) -> Connections:
+    return request.app.state.connections
+
+
+def get_database(request: Request) -> AsyncIOMotorDatabase:
+    return get_connections(request).db
+
+
+def get_redis(request: Request) -> Redis:
+    return get_connections(request).redis
@@ -1,18 +1,52 @@
+import os
+import socket
 from contextlib import asynccontextmanager
 
 import uvicorn
 from fastapi import FastAPI
 
-from db import ensure_indexes
+import config
+from connections import connections
+from metrics import MetricsMiddleware
+from repositories.partitioned_transaction_repository import transaction_repository_for
+from routers.metrics_router import MetricsRouter
+from routers.responses import FastJSONResponse
 from routers.transaction_router import TransactionRouter
+from services.rules.rule_engine import rule_engine
+from services.transaction.ingest_queue import ingest_workers
+from services.transaction.suspicious_feed import suspicious_feed
+
+settings = config.get_settings()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.connections = connections
+    await connections.start()
+    await transaction_repository_for(connections.db).ensure_indexes()
+    await rule_engine.start(connections.db)
+    if settings.INGEST_WORKERS:
+        ingest_workers.start(
+            connections.db,
+            count=settings.INGEST_WORKERS,
+            consumer=f"{socket.gethostname()}-{os.getpid()}",
+        )
+    yield
+    await suspicious_feed.stop()
+    await ingest_workers.stop()
+    await rule_engine.stop()
+    await connections.close()
 
 
 def remodemo_app():
-    app = FastAPI()
+    app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+    app.add_middleware(MetricsMiddleware)
 
     transaction_router = TransactionRouter()
+    metrics_router = MetricsRouter()
 
     app.include_router(transaction_router.router)
+    app.include_router(metrics_router.router)
 
     return app
 
@@ -20,10 +54,6 @@ def remodemo_app():
 app = remodemo_app()
 
 
-@asynccontextmanager
-async def lifespan():
-    await ensure_indexes()
-
-
 if __name__ == "__main__":
+    # For development, python -m commands.serve runs it in production
     uvicorn.run("main:app", host="0.0.0.0", port=8000, log_level="info", reload=True)
@@ -0,0 +1,323 @@
+import bisect
+import contextvars
+import logging
+import random
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from fastapi import Request
+from fastapi.routing import APIRoute
+
+import config
+
+logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+# Stage timings of the current request when it has been sampled for tracing
+_trace: contextvars.ContextVar[Optional[List[Tuple[str, dict, float]]]]
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+def _format_labels(labelnames: Sequence[str], values: Sequence[str], **extra) -> str:
+    pairs = list(zip(labelnames, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Histogram:
+    DEFAULT_BUCKETS = (
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+    )
+
+    def __init__(
+        self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [per bucket counts (not cumulative) + overflow, sum]
+        self._values: Dict[tuple, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, seconds: float, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        values = self._values.get(key)
+        if values is None:
+            values = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        values[0][bisect.bisect_left(self.buckets, seconds)] += 1
+        values[1][0] += seconds
+
+        trace = _trace.get()
+        if trace is not None:
+            trace.append((self.name, labels, seconds))
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        values = self._values.get(tuple(labels[name] for name in self.labelnames))
+        return sum(values[0]) if values else 0
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _format_labels(self.labelnames, key, le=le)
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {total[0]}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class CallbackGauge:
+    """
+    A gauge read when scraped, `callback` returns the value for each set of
+    label values.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str],
+        callback: Callable[[], Dict[tuple, float]],
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        for key, value in self.callback().items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_seconds = registry.register(
+    Histogram(
+        "remodemo_request_seconds",
+        "Time to handle a request",
+        labelnames=["method", "route", "status"],
+    )
+)
+stage_seconds = registry.register(
+    Histogram(
+        "remodemo_stage_seconds",
+        "Time spent in each stage of handling a transaction",
+        labelnames=["stage"],
+    )
+)
+rule_seconds = registry.register(
+    Histogram(
+        "remodemo_rule_seconds",
+        "Time spent counting the windows of each windowed rule in ProcessRules",
+        labelnames=["rule"],
+    )
+)
+redis_seconds = registry.register(
+    Histogram(
+        "remodemo_redis_seconds",
+        "Time spent on Redis commands made by the rules",
+        labelnames=["command"],
+    )
+)
+lock_wait_seconds = registry.register(
+    Histogram(
+        "remodemo_lock_wait_seconds",
+        "Time spent waiting on the locks of the users being written",
+        labelnames=["backend"],
+    )
+)
+ingest_enqueued = registry.register(
+    Counter(
+        "remodemo_ingest_enqueued_total",
+        "Transactions sent to the ingest queue, by whether they were queued",
+        labelnames=["result"],
+    )
+)
+ingest_processed = registry.register(
+    Counter(
+        "remodemo_ingest_processed_total",
+        "Queued transactions written by the ingest workers",
+    )
+)
+ingest_queue_seconds = registry.register(
+    Histogram(
+        "remodemo_ingest_queue_seconds",
+        "Time from queueing a transaction to it being written",
+        buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0),
+    )
+)
+rule_hits = registry.register(
+    Counter(
+        "remodemo_rule_hits_total",
+        "Transactions flagged, by suspicious reason",
+        labelnames=["reason"],
+    )
+)
+rule_flag_cache = registry.register(
+    Counter(
+        "remodemo_rule_flag_cache_total",
+        "Lookups of the cached rule flags in Redis, by key and hit or miss",
+        labelnames=["key", "result"],
+    )
+)
+
+suspicious_feed_events = registry.register(
+    Counter(
+        "remodemo_suspicious_feed_events_total",
+        "Suspicious transactions published to the feed, and subscribers dropped "
+        "for falling behind",
+        labelnames=["event"],
+    )
+)
+
+
+class MetricsMiddleware:
+    """
+    Times every request. A sample of requests also collect their stage
+    timings and log them when the request was slow.
+
+    Plain ASGI rather than `@app.middleware` so it adds next to nothing to
+    each request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        trace_token = None
+        if (
+            settings.METRICS_TRACE_SAMPLE_RATE > 0
+            and random.random() < settings.METRICS_TRACE_SAMPLE_RATE
+        ):
+            trace_token = _trace.set([])
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            seconds = time.perf_counter() - started
+            # Labelled by the route's path template to keep the series bounded
+            route = scope.get("route")
+            request_seconds.observe(
+                seconds,
+                method=scope["method"],
+                route=route.path if route is not None else "unmatched",
+                status=str(status),
+            )
+            if trace_token is not None:
+                trace = _trace.get()
+                _trace.reset(trace_token)
+                if seconds >= settings.METRICS_SLOW_REQUEST_SECONDS:
+                    logger.warning(
+                        "Slow request %s %s took %.4fs: %s",
+                        scope["method"],
+                        scope["path"],
+                        seconds,
+                        ", ".join(
+                            f"{name}{labels} {value:.4f}s"
+                            for name, labels, value in trace
+                        ),
+                    )
+
+
+class TimedRoute(APIRoute):
+    """
+    Notes when FastAPI starts handling a request, so an endpoint can tell how
+    long reading and validating its body took with `observe_validation`.
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def timed_handler(request: Request):
+            request.scope["remodemo.handler_started"] = time.perf_counter()
+            return await handler(request)
+
+        return timed_handler
+
+
+def observe_validation(request: Request):
+    started = request.scope.get("remodemo.handler_started")
+    if started is not None:
+        stage_seconds.observe(time.perf_counter() - started, stage="validation")
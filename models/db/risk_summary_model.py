@@ -0,0 +1,31 @@
+from typing import Dict
+
+from pydantic import BaseModel, ConfigDict, Field
+
+from models.db.transaction_model import SuspiciousReasonsType
+
+
+class DayRiskSummary(BaseModel):
+    suspicious_transactions: int = 0
+    # By currency, amounts in different currencies aren't added together
+    flagged_volume: Dict[str, float] = Field(default_factory=dict)
+    reasons: Dict[SuspiciousReasonsType, int] = Field(default_factory=dict)
+
+
+class RiskSummaryModel(BaseModel):
+    """
+    A user's suspicious transactions counted by reason and by day (UTC, of
+    the transaction's timestamp), kept up to date as they're written.
+    """
+
+    model_config = ConfigDict(populate_by_name=True)
+
+    user_id: str = Field(alias="_id")
+    suspicious_transactions: int = 0
+    flagged_volume: Dict[str, float] = Field(default_factory=dict)
+    reasons: Dict[SuspiciousReasonsType, int] = Field(default_factory=dict)
+    # "YYYY-MM-DD" -> that day's counts
+    days: Dict[str, DayRiskSummary] = Field(default_factory=dict)
+
+    def to_json_bytes(self) -> bytes:
+        return self.__pydantic_serializer__.to_json(self)
@@ -0,0 +1,116 @@
+from typing import List, Optional, Tuple
+
+from pydantic import BaseModel, ConfigDict, Field, model_validator
+
+from models.db.transaction_model import SuspiciousReasonsType, TransactionType
+
+
+class TransactionFilter(BaseModel):
+    """
+    Which transactions a rule looks at, every condition that's set has to
+    match. Amounts are compared with the operator in the field name.
+    """
+
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
+    types: Optional[Tuple[TransactionType, ...]] = None
+    currencies: Optional[Tuple[str, ...]] = None
+    amount_gt: Optional[float] = None
+    amount_gte: Optional[float] = None
+    amount_lt: Optional[float] = None
+    amount_lte: Optional[float] = None
+
+    def matches(self, amount: float, type: TransactionType, currency: str) -> bool:
+        if self.types is not None and type not in self.types:
+            return False
+        if self.currencies is not None and currency not in self.currencies:
+            return False
+        if self.amount_gt is not None and not amount > self.amount_gt:
+            return False
+        if self.amount_gte is not None and not amount >= self.amount_gte:
+            return False
+        if self.amount_lt is not None and not amount < self.amount_lt:
+            return False
+        if self.amount_lte is not None and not amount <= self.amount_lte:
+            return False
+        return True
+
+    def query(self) -> dict:
+        """
+        The same conditions as a MongoDB query.
+        """
+        query = {}
+        if self.types is not None:
+            query["type"] = {"$in": [t.value for t in self.types]}
+        if self.currencies is not None:
+            query["currency"] = {"$in": list(self.currencies)}
+        amount = {
+            f"${op}": value
+            for op, value in [
+                ("gt", self.amount_gt),
+                ("gte", self.amount_gte),
+                ("lt", self.amount_lt),
+                ("lte", self.amount_lte),
+            ]
+            if value is not None
+        }
+        if amount:
+            query["amount"] = amount
+        return query
+
+
+class RuleModel(BaseModel):
+    """
+    A rule flags a transaction matching its filter with `reason`.
+
+    Windowed rules (with `window_minutes`) also need at least `threshold`
+    earlier matching transactions from the same user in the window before
+    the transaction's timestamp, the current transaction isn't counted. Once
+    one fires it keeps firing for every transaction from the user until the
+    oldest of those leaves the window, or for `flag_seconds` when set, that's
+    remembered in Redis under `{name}{user_id}`.
+    """
+
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
+    name: str = Field(pattern=r"^[A-Za-z0-9_]+$")
+    reason: SuspiciousReasonsType
+    filter: TransactionFilter = TransactionFilter()
+    window_minutes: Optional[int] = Field(None, gt=0)
+    threshold: int = Field(0, ge=0)
+    flag_seconds: Optional[int] = Field(None, gt=0)
+    enabled: bool = True
+
+    @model_validator(mode="after")
+    def _window_settings_need_a_window(self):
+        if self.window_minutes is None and (self.threshold or self.flag_seconds):
+            raise ValueError("threshold and flag_seconds need window_minutes")
+        return self
+
+    @property
+    def is_windowed(self) -> bool:
+        return self.window_minutes is not None
+
+    @property
+    def flag_ttl_seconds(self) -> int:
+        # The longest a flag can hold
+        return self.flag_seconds or self.window_minutes * 60
+
+
+class RuleSetModel(BaseModel):
+    """
+    The rules in the order their reasons are reported. Stored as a single
+    document so replacing the rules is atomic.
+    """
+
+    model_config = ConfigDict(extra="ignore")
+
+    version: int = 0
+    rules: List[RuleModel]
+
+    @model_validator(mode="after")
+    def _names_are_unique(self):
+        names = [rule.name for rule in self.rules]
+        if len(names) != len(set(names)):
+            raise ValueError("Rule names must be unique")
+        return self
@@ -1,6 +1,7 @@
 import datetime
+from typing import Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from models.db.transaction_model import TransactionType
 
@@ -11,3 +12,6 @@ class NewTransactionPayload(BaseModel):
     currency: str
     timestamp: datetime.datetime
     type: TransactionType
+    # Chosen by the client, resending a transaction with the same key doesn't
+    # write it again
+    idempotency_key: Optional[str] = Field(None, min_length=1, max_length=128)
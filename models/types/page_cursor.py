@@ -0,0 +1,23 @@
+import base64
+import datetime
+from typing import Tuple
+
+from bson.objectid import ObjectId
+
+
+def encode_cursor(timestamp: datetime.datetime, id: ObjectId) -> str:
+    """
+    An opaque cursor for the position after a transaction when sorted by
+    (timestamp, _id).
+    """
+    raw = f"{timestamp.isoformat()}|{id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime.datetime, ObjectId]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp, id = raw.split("|")
+        return datetime.datetime.fromisoformat(timestamp), ObjectId(id)
+    except Exception as e:
+        raise ValueError("Invalid cursor") from e
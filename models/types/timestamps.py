@@ -0,0 +1,14 @@
+import datetime
+
+
+def as_naive_utc(timestamp: datetime.datetime) -> datetime.datetime:
+    # Mongo hands back naive UTC datetimes, payloads may carry a timezone
+    if timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def as_stored_timestamp(timestamp: datetime.datetime) -> datetime.datetime:
+    # BSON dates only hold milliseconds, this is what reading it back gives
+    timestamp = as_naive_utc(timestamp)
+    return timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
@@ -0,0 +1,395 @@
+import asyncio
+import datetime
+import heapq
+from typing import (
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import IndexModel, WriteConcern
+
+from models.db.transaction_model import SuspiciousReasonsType, TransactionModel
+from models.types.py_object_id import PyObjectId
+from repositories.partitions import TransactionPartitions, partitions_for
+from repositories.transaction_repository import TransactionRepository, WindowQuery
+
+
+class _Descending:
+    # Reverses the order of a key for heapq, for streams sorted descending
+    __slots__ = ["value"]
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other: "_Descending") -> bool:
+        return other.value < self.value
+
+    def __eq__(self, other: "_Descending") -> bool:
+        return self.value == other.value
+
+
+async def _merged(
+    streams: List[AsyncIterator[dict]], key: Callable[[dict], object]
+) -> AsyncIterator[dict]:
+    """
+    Streams that are each sorted by `key` merged into one sorted by `key`.
+    """
+    heap = []
+    for i, stream in enumerate(streams):
+        first = await anext(stream, None)
+        if first is not None:
+            heap.append((key(first), i, first))
+    heapq.heapify(heap)
+    while heap:
+        _, i, item = heap[0]
+        yield item
+        following = await anext(streams[i], None)
+        if following is None:
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (key(following), i, following))
+
+
+def _unique(transactions: Iterable) -> list:
+    # A user being moved can have the same transaction in both partitions
+    seen = set()
+    unique = []
+    for t in transactions:
+        id = t["_id"] if isinstance(t, dict) else t.id
+        if id not in seen:
+            seen.add(id)
+            unique.append(t)
+    return unique
+
+
+class PartitionedTransactionRepository:
+    """
+    TransactionRepository over a database's partitions. A user's queries go
+    to the partition that holds them, queries across users go to every
+    partition and their results are merged in the same order one database
+    would give.
+
+    Idempotency keys are unique per user, and a user's transactions are
+    written to one partition, so that holds across partitions too.
+    """
+
+    def __init__(
+        self, partitions: TransactionPartitions, hot_seconds: Optional[int] = None
+    ):
+        self.partitions = partitions
+        self.repositories: Dict[str, TransactionRepository] = {
+            name: TransactionRepository(db=db, hot_seconds=hot_seconds)
+            for name, db in partitions.databases.items()
+        }
+
+    def for_user(self, user_id: str) -> TransactionRepository:
+        return self.repositories[self.partitions.owner(user_id)]
+
+    def _reading(self, user_id: str) -> List[TransactionRepository]:
+        return [self.repositories[name] for name in self.partitions.owners(user_id)]
+
+    async def _every(self, call) -> list:
+        return await asyncio.gather(
+            *[call(repository) for repository in self.repositories.values()]
+        )
+
+    async def ensure_indexes(self):
+        await self._every(lambda r: r.ensure_indexes())
+
+    async def missing_indexes(self) -> List[IndexModel]:
+        return [
+            index
+            for missing in await self._every(lambda r: r.missing_indexes())
+            for index in missing
+        ]
+
+    async def explain_queries(self, user_id: str) -> Dict[str, dict]:
+        return await self.for_user(user_id).explain_queries(user_id)
+
+    async def get_transaction(self, id: PyObjectId) -> Optional[TransactionModel]:
+        for transaction in await self._every(lambda r: r.get_transaction(id)):
+            if transaction is not None:
+                return transaction
+
+    async def get_transactions_by_idempotency_keys(
+        self, keys: List[Tuple[str, str]]
+    ) -> List[TransactionModel]:
+        # Each user's keys are looked up where the user's transactions are
+        by_partition: Dict[str, List[Tuple[str, str]]] = {}
+        for user_id, key in keys:
+            for name in self.partitions.owners(user_id):
+                by_partition.setdefault(name, []).append((user_id, key))
+        found = await asyncio.gather(
+            *[
+                self.repositories[name].get_transactions_by_idempotency_keys(
+                    partition_keys
+                )
+                for name, partition_keys in by_partition.items()
+            ]
+        )
+        return _unique(t for transactions in found for t in transactions)
+
+    async def insert_transaction(
+        self, transaction: dict, write_concern: Optional[WriteConcern] = None
+    ) -> TransactionModel:
+        return await self.for_user(transaction["user_id"]).insert_transaction(
+            transaction, write_concern
+        )
+
+    def _by_partition(self, transactions: List[dict]) -> Dict[str, List[int]]:
+        positions: Dict[str, List[int]] = {}
+        for i, t in enumerate(transactions):
+            positions.setdefault(self.partitions.owner(t["user_id"]), []).append(i)
+        return positions
+
+    async def _insert(self, insert, transactions: List[dict]) -> list:
+        # Each partition's share in one write, in their original order
+        inserted = [None] * len(transactions)
+        for name, positions in self._by_partition(transactions).items():
+            written = await insert(
+                self.repositories[name], [transactions[i] for i in positions]
+            )
+            for i, transaction in zip(positions, written):
+                inserted[i] = transaction
+        return inserted
+
+    async def insert_transactions(
+        self, transactions: List[dict], write_concern: Optional[WriteConcern] = None
+    ) -> List[TransactionModel]:
+        return await self._insert(
+            lambda r, ts: r.insert_transactions(ts, write_concern), transactions
+        )
+
+    async def insert_new_transactions(
+        self, transactions: List[dict], write_concern: Optional[WriteConcern] = None
+    ) -> List[Optional[TransactionModel]]:
+        return await self._insert(
+            lambda r, ts: r.insert_new_transactions(ts, write_concern), transactions
+        )
+
+    async def get_latest_in_windows(
+        self, user_id: str, windows: List[WindowQuery]
+    ) -> Dict[str, List[dict]]:
+        readers = self._reading(user_id)
+        if len(readers) == 1:
+            return await readers[0].get_latest_in_windows(
+                user_id=user_id, windows=windows
+            )
+        found = await asyncio.gather(
+            *[
+                r.get_latest_in_windows(user_id=user_id, windows=windows)
+                for r in readers
+            ]
+        )
+        latest = {}
+        for w in windows:
+            transactions = _unique(t for f in found for t in f.get(w.name, []))
+            transactions.sort(key=lambda t: t["timestamp"], reverse=True)
+            latest[w.name] = transactions[: w.limit]
+        return latest
+
+    async def get_transactions_for_user_between(
+        self,
+        user_id: str,
+        since: datetime.datetime,
+        until: datetime.datetime,
+        projection: Optional[dict] = None,
+    ) -> List[dict]:
+        return await self._read_unique(
+            user_id,
+            lambda r, projection: r.get_transactions_for_user_between(
+                user_id, since, until, projection
+            ),
+            projection,
+        )
+
+    async def _read_unique(self, user_id: str, read, projection: Optional[dict]):
+        readers = self._reading(user_id)
+        if len(readers) == 1:
+            return await read(readers[0], projection)
+        # The _ids tell apart the copies of a user part way through a move
+        without_id = projection is not None and not projection.get("_id", True)
+        if without_id:
+            projection = {**projection, "_id": 1}
+        found = await asyncio.gather(*[read(r, projection) for r in readers])
+        transactions = _unique(t for f in found for t in f)
+        if without_id:
+            for t in transactions:
+                del t["_id"]
+        return transactions
+
+    async def iter_transactions_between(
+        self,
+        since: datetime.datetime,
+        until: datetime.datetime,
+        projection: Optional[dict] = None,
+        batch_size: int = 10_000,
+    ) -> AsyncIterator[dict]:
+        # One partition after another. Users being moved can have the same
+        # transaction in two, those are told apart by their _ids.
+        moving = self.partitions.previous_ring is not None
+        if moving and projection is not None:
+            projection = {**projection, "_id": 1, "user_id": 1}
+        seen = set()
+        for repository in self.repositories.values():
+            async for t in repository.iter_transactions_between(
+                since, until, projection, batch_size
+            ):
+                if moving and len(self.partitions.owners(t["user_id"])) > 1:
+                    if t["_id"] in seen:
+                        continue
+                    seen.add(t["_id"])
+                yield t
+
+    async def iter_user_ids(self) -> AsyncIterator[str]:
+        last = None
+        async for group in _merged(
+            [self._user_ids(r) for r in self.repositories.values()],
+            key=lambda g: g["_id"],
+        ):
+            if group["_id"] != last:
+                last = group["_id"]
+                yield last
+
+    @staticmethod
+    async def _user_ids(repository: TransactionRepository) -> AsyncIterator[dict]:
+        async for user_id in repository.iter_user_ids():
+            yield {"_id": user_id}
+
+    async def iter_risk_rollups(
+        self, user_ids: Optional[List[str]] = None
+    ) -> AsyncIterator[dict]:
+        async for rollup in _merged(
+            [r.iter_risk_rollups(user_ids) for r in self.repositories.values()],
+            key=lambda rollup: rollup["_id"]["user_id"],
+        ):
+            yield rollup
+
+    async def iter_user_histories(
+        self,
+        from_user: Optional[str] = None,
+        to_user: Optional[str] = None,
+        projection: Optional[dict] = None,
+        batch_size: int = 1000,
+    ) -> AsyncIterator[dict]:
+        # Each user is in one partition, so whole users are interleaved. Users
+        # being moved can be in two, their copies are merged oldest first and
+        # told apart by their _ids.
+        moving = self.partitions.previous_ring is not None
+        if moving and projection is not None:
+            projection = {**projection, "_id": 1, "user_id": 1, "timestamp": 1}
+        user_id = None
+        seen = set()
+        async for t in _merged(
+            [
+                r.iter_user_histories(from_user, to_user, projection, batch_size)
+                for r in self.repositories.values()
+            ],
+            key=lambda t: (_Descending(t["user_id"]), t["timestamp"]),
+        ):
+            if moving and len(self.partitions.owners(t["user_id"])) > 1:
+                if t["user_id"] != user_id:
+                    user_id = t["user_id"]
+                    seen = set()
+                if t["_id"] in seen:
+                    continue
+                seen.add(t["_id"])
+            yield t
+
+    async def update_verdicts(
+        self, verdicts: List[Tuple[PyObjectId, List[SuspiciousReasonsType]]]
+    ) -> int:
+        if not verdicts:
+            return 0
+        # Only the _ids are known here, each partition updates the ones it has
+        return sum(await self._every(lambda r: r.update_verdicts(verdicts)))
+
+    async def add_reasons(
+        self, additions: List[Tuple[PyObjectId, List[SuspiciousReasonsType]]]
+    ) -> int:
+        if not additions:
+            return 0
+        return sum(await self._every(lambda r: r.add_reasons(additions)))
+
+    async def fill_hot_tier(self, batch_size: int = 1000) -> int:
+        return sum(await self._every(lambda r: r.fill_hot_tier(batch_size)))
+
+    async def get_suspicious_transactions_for_user(
+        self,
+        user_id: str,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[datetime.datetime, PyObjectId]] = None,
+    ) -> List[TransactionModel]:
+        transactions = await self.get_suspicious_documents_for_user(
+            user_id, limit, after
+        )
+        return [TransactionModel(**t) for t in transactions]
+
+    async def get_suspicious_documents_for_user(
+        self,
+        user_id: str,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[datetime.datetime, PyObjectId]] = None,
+    ) -> List[dict]:
+        readers = self._reading(user_id)
+        if len(readers) == 1:
+            return await readers[0].get_suspicious_documents_for_user(
+                user_id, limit, after
+            )
+        found = await asyncio.gather(
+            *[
+                r.get_suspicious_documents_for_user(user_id, limit, after)
+                for r in readers
+            ]
+        )
+        transactions = _unique(t for f in found for t in f)
+        transactions.sort(key=lambda t: (t["timestamp"], t["_id"]))
+        return transactions if limit is None else transactions[:limit]
+
+    async def iter_suspicious_transactions_for_user(
+        self,
+        user_id: str,
+        after: Optional[Tuple[datetime.datetime, PyObjectId]] = None,
+        batch_size: int = 500,
+    ) -> AsyncIterator[TransactionModel]:
+        async for t in self.iter_suspicious_documents_for_user(
+            user_id, after, batch_size
+        ):
+            yield TransactionModel(**t)
+
+    async def iter_suspicious_documents_for_user(
+        self,
+        user_id: str,
+        after: Optional[Tuple[datetime.datetime, PyObjectId]] = None,
+        batch_size: int = 500,
+    ) -> AsyncIterator[dict]:
+        last = None
+        async for t in _merged(
+            [
+                r.iter_suspicious_documents_for_user(user_id, after, batch_size)
+                for r in self._reading(user_id)
+            ],
+            key=lambda t: (t["timestamp"], t["_id"]),
+        ):
+            if t["_id"] != last:
+                last = t["_id"]
+                yield t
+
+
+def transaction_repository_for(
+    db: AsyncIOMotorDatabase, hot_seconds: Optional[int] = None
+):
+    """
+    The repository for a database's transactions, over its partitions when
+    they're spread over several (see connections.database).
+    """
+    partitions = partitions_for(db)
+    if partitions is None:
+        return TransactionRepository(db=db, hot_seconds=hot_seconds)
+    return PartitionedTransactionRepository(partitions, hot_seconds=hot_seconds)
@@ -0,0 +1,96 @@
+import bisect
+import hashlib
+import weakref
+from typing import Dict, List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+
+def _hash(value: str) -> int:
+    # Stable across processes and restarts, unlike hash()
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    A consistent hash ring of partition names. Each partition has `vnodes`
+    points on the ring and a key belongs to the first point after its hash,
+    so adding a partition only moves the keys it takes over.
+    """
+
+    def __init__(self, names: List[str], vnodes: int = 256):
+        if not names:
+            raise ValueError("A ring needs at least one partition")
+        points = sorted(
+            (_hash(f"{name}#{i}"), name) for name in names for i in range(vnodes)
+        )
+        self.names = sorted(names)
+        self._hashes = [h for h, _ in points]
+        self._names = [name for _, name in points]
+
+    def partition_of(self, key: str) -> str:
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._names[i]
+
+
+class TransactionPartitions:
+    """
+    The databases a home database's transactions are spread over, each user
+    on one of them.
+
+    `previous` is the ring's partitions before some were added, while users
+    are being moved to their new partitions. Their transactions are read
+    from both until then.
+    """
+
+    def __init__(
+        self,
+        databases: Dict[str, AsyncIOMotorDatabase],
+        previous: Optional[List[str]] = None,
+        vnodes: int = 256,
+    ):
+        self.databases = databases
+        self.ring = HashRing(list(databases), vnodes)
+        self.previous_ring = HashRing(previous, vnodes) if previous else None
+
+    def owner(self, user_id: str) -> str:
+        return self.ring.partition_of(user_id)
+
+    def owners(self, user_id: str) -> List[str]:
+        """
+        Where a user's transactions may be, where they're written first.
+        """
+        owner = self.owner(user_id)
+        if self.previous_ring is None:
+            return [owner]
+        previous = self.previous_ring.partition_of(user_id)
+        return [owner] if previous == owner else [owner, previous]
+
+
+# id(database) -> (weak reference to the database, its partitions). Keyed on
+# identity because databases compare equal by name.
+_partitions: Dict[int, Tuple[weakref.ref, TransactionPartitions]] = {}
+
+
+def set_partitions(
+    database: AsyncIOMotorDatabase, partitions: Optional[TransactionPartitions]
+):
+    """
+    Spreads the database's transactions over `partitions`, or keeps them in
+    it again when None.
+    """
+    key = id(database)
+    if partitions is None:
+        _partitions.pop(key, None)
+        return
+    _partitions[key] = (
+        weakref.ref(database, lambda _: _partitions.pop(key, None)),
+        partitions,
+    )
+
+
+def partitions_for(database: AsyncIOMotorDatabase) -> Optional[TransactionPartitions]:
+    entry = _partitions.get(id(database))
+    if entry is not None and entry[0]() is database:
+        return entry[1]
+    return None
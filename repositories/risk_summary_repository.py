@@ -0,0 +1,138 @@
+import datetime
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase, AsyncIOMotorCollection
+from pymongo import ReplaceOne, UpdateOne
+
+from models.db.risk_summary_model import RiskSummaryModel
+from models.db.transaction_model import SuspiciousReasonsType, TransactionModel
+
+
+def day_of(timestamp: datetime.datetime) -> str:
+    # The same as $dateToString with "%Y-%m-%d", timestamps are naive UTC
+    return timestamp.strftime("%Y-%m-%d")
+
+
+def currency_field(currency: str) -> str:
+    # Currencies are field names here, which can't hold dots or start with $
+    return currency.replace(".", "_").replace("$", "_")
+
+
+class RiskSummaryRepository:
+    """
+    One document per user in `user_risk_summary`, keyed by user_id, that
+    every suspicious transaction written adds itself to with $inc.
+    """
+
+    def __init__(self, db: AsyncIOMotorDatabase):
+        self._db = db
+        self._collection: AsyncIOMotorCollection = db["user_risk_summary"]
+
+    async def get(self, user_id: str) -> RiskSummaryModel:
+        summary = await self._collection.find_one({"_id": user_id})
+        if summary is None:
+            return RiskSummaryModel(user_id=user_id)
+        return RiskSummaryModel(**summary)
+
+    async def increment(self, transactions: Iterable[TransactionModel]):
+        """
+        Adds the suspicious transactions to their users' summaries, one
+        upsert per user.
+        """
+        await self._apply(
+            (transaction.user_id, self._increments(transaction))
+            for transaction in transactions
+            if transaction.is_suspicious
+        )
+
+    async def add_reasons(
+        self,
+        additions: Iterable[Tuple[TransactionModel, List[SuspiciousReasonsType]]],
+    ):
+        """
+        Counts reasons added to transactions after they were written, e.g. by
+        the pattern scanner. The transactions are as they were before, ones
+        that weren't suspicious then are counted as suspicious now.
+        """
+        await self._apply(
+            (
+                transaction.user_id,
+                self._increments(
+                    transaction, reasons, counted=transaction.is_suspicious
+                ),
+            )
+            for transaction, reasons in additions
+        )
+
+    async def _apply(self, user_increments: Iterable[Tuple[str, Dict[str, float]]]):
+        increments: Dict[str, Counter] = {}
+        for user_id, inc in user_increments:
+            increments.setdefault(user_id, Counter()).update(inc)
+        if not increments:
+            return
+        now = datetime.datetime.utcnow()
+        await self._collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": user_id},
+                    {"$inc": dict(inc), "$set": {"updated_at": now}},
+                    upsert=True,
+                )
+                for user_id, inc in increments.items()
+            ],
+            ordered=False,
+        )
+
+    @staticmethod
+    def _increments(
+        transaction: TransactionModel,
+        reasons: Optional[List[SuspiciousReasonsType]] = None,
+        counted: bool = False,
+    ) -> Dict[str, float]:
+        # `counted` transactions are already in the totals, only their new
+        # reasons are added
+        day = f"days.{day_of(transaction.timestamp)}"
+        currency = currency_field(transaction.currency)
+        inc = {}
+        if not counted:
+            inc = {
+                "suspicious_transactions": 1,
+                f"flagged_volume.{currency}": transaction.amount,
+                f"{day}.suspicious_transactions": 1,
+                f"{day}.flagged_volume.{currency}": transaction.amount,
+            }
+        if reasons is None:
+            reasons = transaction.suspicious_reasons
+        for reason in reasons:
+            inc[f"reasons.{reason.value}"] = 1
+            inc[f"{day}.reasons.{reason.value}"] = 1
+        return inc
+
+    async def replace(self, summaries: List[dict], updated_at: datetime.datetime):
+        if not summaries:
+            return
+        await self._collection.bulk_write(
+            [
+                ReplaceOne(
+                    {"_id": summary["_id"]},
+                    {**summary, "updated_at": updated_at},
+                    upsert=True,
+                )
+                for summary in summaries
+            ],
+            ordered=False,
+        )
+
+    async def delete_not_updated_since(
+        self, updated_at: datetime.datetime, user_ids: Optional[List[str]] = None
+    ) -> int:
+        """
+        Deletes the summaries that were neither rebuilt nor added to since
+        `updated_at`, the users with no suspicious transactions left.
+        """
+        query = {"updated_at": {"$not": {"$gte": updated_at}}}
+        if user_ids is not None:
+            query["_id"] = {"$in": user_ids}
+        result = await self._collection.delete_many(query)
+        return result.deleted_count
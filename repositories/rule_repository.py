@@ -0,0 +1,41 @@
+from typing import List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pymongo import ReturnDocument
+
+from models.db.rule_model import RuleModel, RuleSetModel
+
+
+class RuleRepository:
+
+    # The whole rule set is one document, replacing it swaps every rule at once
+    RULE_SET_ID = "transaction_rules"
+
+    def __init__(self, db: AsyncIOMotorDatabase):
+        self._collection: AsyncIOMotorCollection = db["rules"]
+
+    async def get_version(self) -> Optional[int]:
+        document = await self._collection.find_one(
+            {"_id": self.RULE_SET_ID}, {"version": 1}
+        )
+        return document["version"] if document else None
+
+    async def get_rule_set(self) -> Optional[RuleSetModel]:
+        document = await self._collection.find_one({"_id": self.RULE_SET_ID})
+        return RuleSetModel(**document) if document else None
+
+    async def save_rules(self, rules: List[RuleModel]) -> RuleSetModel:
+        """
+        Replaces the stored rules, bumping the version so running apps pick
+        them up.
+        """
+        document = await self._collection.find_one_and_update(
+            {"_id": self.RULE_SET_ID},
+            {
+                "$set": {"rules": [rule.model_dump(mode="json") for rule in rules]},
+                "$inc": {"version": 1},
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return RuleSetModel(**document)
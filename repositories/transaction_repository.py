@@ -1,49 +1,697 @@
 import datetime
-from typing import List, Optional
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Tuple
 
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError
 from motor.motor_asyncio import AsyncIOMotorDatabase, AsyncIOMotorCollection
 
-from models.db.transaction_model import TransactionModel, TransactionType
+import config
+from models.db.transaction_model import (
+    TransactionModel,
+    TransactionType,
+    SuspiciousReasonsType,
+)
 from models.types.py_object_id import PyObjectId
+from models.types.timestamps import as_stored_timestamp
+
+
+settings = config.get_settings()
+
+DUPLICATE_KEY_ERROR = 11000
+
+# How far the clocks of the app and Mongo's TTL monitor are allowed to drift
+# before a window could reach past what's left in the hot tier
+_HOT_MARGIN = datetime.timedelta(minutes=1)
+
+
+class WindowQuery(NamedTuple):
+    """
+    A user's transactions from `since` to `until` (or the newest when None)
+    matching `query`, named so several can be answered by one aggregation.
+    """
+
+    name: str
+    since: datetime.datetime
+    until: Optional[datetime.datetime]
+    limit: int
+    query: dict
 
 
 class TransactionRepository:
 
-    def __init__(self, db: AsyncIOMotorDatabase):
+    # Shaped for the queries below, all but the pattern scanner's are scoped
+    # to a user_id
+    INDEXES = [
+        # Windowed rules filtering on type, e.g. rapid transfers
+        IndexModel(
+            [("user_id", ASCENDING), ("type", ASCENDING), ("timestamp", DESCENDING)],
+            name="user_id_type_timestamp",
+        ),
+        # Windowed rules filtering on amount, e.g. frequent small transactions,
+        # and anything else only needing a user's recent transactions
+        IndexModel(
+            [("user_id", ASCENDING), ("timestamp", DESCENDING), ("amount", ASCENDING)],
+            name="user_id_timestamp_amount",
+        ),
+        # get_suspicious_transactions_for_user and its pages, only suspicious
+        # ones are indexed
+        IndexModel(
+            [("user_id", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)],
+            name="user_id_timestamp_id_suspicious",
+            partialFilterExpression={"is_suspicious": True},
+        ),
+        # Client supplied keys, a transaction is only written once per key for
+        # each user. Partial rather than sparse, a compound sparse index holds
+        # every document with a user_id.
+        IndexModel(
+            [("user_id", ASCENDING), ("idempotency_key", ASCENDING)],
+            name="user_id_idempotency_key_unique",
+            unique=True,
+            partialFilterExpression={"idempotency_key": {"$exists": True}},
+        ),
+        # Every user's transactions in a time range, for the pattern scanner
+        IndexModel([("timestamp", ASCENDING)], name="timestamp"),
+    ]
+
+    # Indexes declared before that ensure_indexes drops once their
+    # replacements exist. Keys used to be unique across every user.
+    REPLACED_INDEXES = ["idempotency_key_unique"]
+
+    SUSPICIOUS_SORT = [("timestamp", ASCENDING), ("_id", ASCENDING)]
+
+    # What the responses need from a stored transaction
+    RESPONSE_PROJECTION = {"idempotency_key": False}
+
+    # Each user's transactions oldest first. Users run backwards so this is
+    # user_id_timestamp_amount walked in reverse rather than a blocking sort.
+    USER_HISTORY_SORT = [("user_id", DESCENDING), ("timestamp", ASCENDING)]
+
+    def __init__(self, db: AsyncIOMotorDatabase, hot_seconds: Optional[int] = None):
         self._db = db
+        # Every transaction ever written
         self._collection: AsyncIOMotorCollection = db["transaction"]
+        # With the hot tier, the recent ones are written to transaction_hot
+        # as well and dropped from it by a TTL index. Queries that only look
+        # at recent transactions read it, everything else the full history.
+        if hot_seconds is None and settings.TRANSACTION_HOT_TIER:
+            hot_seconds = settings.TRANSACTION_HOT_SECONDS
+        self.hot_seconds = hot_seconds
+        self._hot: Optional[AsyncIOMotorCollection] = (
+            db["transaction_hot"] if hot_seconds else None
+        )
+
+    def hot_indexes(self) -> List[IndexModel]:
+        # Only the rules' window queries read the hot tier
+        return [
+            IndexModel(
+                [
+                    ("user_id", ASCENDING),
+                    ("type", ASCENDING),
+                    ("timestamp", DESCENDING),
+                ],
+                name="hot_user_id_type_timestamp",
+            ),
+            IndexModel(
+                [
+                    ("user_id", ASCENDING),
+                    ("timestamp", DESCENDING),
+                    ("amount", ASCENDING),
+                ],
+                name="hot_user_id_timestamp_amount",
+            ),
+            IndexModel(
+                [("timestamp", ASCENDING)],
+                name="hot_timestamp_ttl",
+                expireAfterSeconds=self.hot_seconds,
+            ),
+        ]
+
+    def _collections_indexes(
+        self,
+    ) -> List[Tuple[AsyncIOMotorCollection, List[IndexModel]]]:
+        collections = [(self._collection, self.INDEXES)]
+        if self._hot is not None:
+            collections.append((self._hot, self.hot_indexes()))
+        return collections
+
+    async def ensure_indexes(self):
+        for collection, indexes in self._collections_indexes():
+            await collection.create_indexes(indexes)
+        existing = await self._collection.index_information()
+        for name in self.REPLACED_INDEXES:
+            if name in existing:
+                await self._collection.drop_index(name)
+
+    async def missing_indexes(self) -> List[IndexModel]:
+        """
+        The declared indexes that don't exist on their collection, matched on
+        their keys rather than their names.
+        """
+        missing = []
+        for collection, indexes in self._collections_indexes():
+            existing = await collection.index_information()
+            existing_keys = [list(index["key"]) for index in existing.values()]
+            missing += [
+                index
+                for index in indexes
+                if list(index.document["key"].items()) not in existing_keys
+            ]
+        return missing
+
+    def _reading_since(self, since: datetime.datetime) -> AsyncIOMotorCollection:
+        # The hot tier while everything from `since` on is still in it
+        if self._hot is None:
+            return self._collection
+        kept_from = (
+            datetime.datetime.utcnow()
+            - datetime.timedelta(seconds=self.hot_seconds)
+            + _HOT_MARGIN
+        )
+        return self._hot if since >= kept_from else self._collection
+
+    async def explain_queries(self, user_id: str) -> Dict[str, dict]:
+        """
+        The query plan of each query this repository makes, for a user.
+        """
+        now = datetime.datetime.utcnow()
+        windows = [
+            WindowQuery(
+                name="small",
+                since=now - datetime.timedelta(minutes=60),
+                until=now,
+                limit=4,
+                query={"amount": {"$lte": 100.0}},
+            ),
+            WindowQuery(
+                name="transfers",
+                since=now - datetime.timedelta(minutes=5),
+                until=now,
+                limit=2,
+                query={"type": {"$in": [TransactionType.TRANSFER.value]}},
+            ),
+        ]
+        recent = self._reading_since(now - datetime.timedelta(minutes=60))
+        return {
+            "get_latest_in_windows": await self._explain_aggregate(
+                recent,
+                [
+                    {"$match": self._windows_query(user_id, windows)},
+                    {"$sort": {"timestamp": DESCENDING}},
+                ],
+            ),
+            "get_suspicious_transactions_for_user": await self._collection.find(
+                self._suspicious_query(user_id)
+            )
+            .sort(self.SUSPICIOUS_SORT)
+            .limit(100)
+            .explain(),
+        }
+
+    async def _explain_aggregate(
+        self, collection: AsyncIOMotorCollection, pipeline: List[dict]
+    ) -> dict:
+        # Only the leading $match and $sort decide which index is used
+        return await self._db.command(
+            "explain",
+            {"aggregate": collection.name, "pipeline": pipeline, "cursor": {}},
+            verbosity="queryPlanner",
+        )
 
     async def get_transaction(self, id: PyObjectId) -> TransactionModel:
         transaction = await self._collection.find_one({"_id": id})
         if transaction:
             return TransactionModel(**transaction)
 
-    async def insert_transaction(self, transaction: dict) -> TransactionModel:
-        inserted_transaction = await self._collection.insert_one(transaction)
-        return await self.get_transaction(inserted_transaction.inserted_id)
+    async def get_transactions_by_idempotency_keys(
+        self, keys: List[Tuple[str, str]]
+    ) -> List[TransactionModel]:
+        """
+        The transactions stored for (user_id, idempotency_key) pairs.
+        """
+        if not keys:
+            return []
+        by_user: Dict[str, List[str]] = {}
+        for user_id, key in keys:
+            by_user.setdefault(user_id, []).append(key)
+        transactions = await self._collection.find(
+            {
+                "$or": [
+                    {"user_id": user_id, "idempotency_key": {"$in": user_keys}}
+                    for user_id, user_keys in by_user.items()
+                ]
+            }
+        ).to_list(None)
+        return [TransactionModel(**t) for t in transactions]
+
+    async def insert_transaction(
+        self, transaction: dict, write_concern: Optional[WriteConcern] = None
+    ) -> TransactionModel:
+        inserted_transaction = await self._writer(write_concern).insert_one(transaction)
+        await self._insert_hot([transaction], write_concern)
+        return self._as_stored(transaction, inserted_transaction.inserted_id)
+
+    async def insert_transactions(
+        self, transactions: List[dict], write_concern: Optional[WriteConcern] = None
+    ) -> List[TransactionModel]:
+        if not transactions:
+            return []
+        # Ordered so the documents land in the same order they were evaluated
+        try:
+            inserted_transactions = await self._writer(write_concern).insert_many(
+                transactions, ordered=True
+            )
+        except BulkWriteError as e:
+            # The ones before the error were written, and need to be hot too
+            await self._insert_hot(
+                transactions[: e.details["nInserted"]], write_concern
+            )
+            raise
+        await self._insert_hot(transactions, write_concern)
+        return [
+            self._as_stored(transaction, id)
+            for transaction, id in zip(transactions, inserted_transactions.inserted_ids)
+        ]
+
+    async def insert_new_transactions(
+        self, transactions: List[dict], write_concern: Optional[WriteConcern] = None
+    ) -> List[Optional[TransactionModel]]:
+        """
+        Like insert_transactions, but a transaction whose idempotency key is
+        already stored is skipped rather than stopping the rest. Skipped
+        transactions are None.
+        """
+        inserted: List[Optional[TransactionModel]] = []
+        while transactions:
+            try:
+                return inserted + await self.insert_transactions(
+                    transactions, write_concern
+                )
+            except BulkWriteError as e:
+                # Ordered, so everything before the first error was written
+                # and nothing after it
+                error = e.details["writeErrors"][0]
+                index = error["index"]
+                # Only a key that's already stored is skipped
+                if (
+                    error["code"] != DUPLICATE_KEY_ERROR
+                    or "idempotency_key" not in transactions[index]
+                ):
+                    raise
+                inserted += [
+                    self._as_stored(t, t["_id"]) for t in transactions[:index]
+                ] + [None]
+                transactions = transactions[index + 1 :]
+        return inserted
 
-    async def get_recent_transactions_for_user(
+    def _writer(
+        self,
+        write_concern: Optional[WriteConcern],
+        collection: Optional[AsyncIOMotorCollection] = None,
+    ) -> AsyncIOMotorCollection:
+        collection = self._collection if collection is None else collection
+        if write_concern is None:
+            return collection
+        return collection.with_options(write_concern=write_concern)
+
+    async def _insert_hot(
+        self, transactions: List[dict], write_concern: Optional[WriteConcern] = None
+    ):
+        """
+        Copies transactions already written to the full history into the hot
+        tier, leaving out any the TTL index would drop straight away. Ones
+        already there, from fill_hot_tier, are skipped.
+        """
+        if self._hot is None:
+            return
+        kept_from = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=self.hot_seconds
+        )
+        hot = [
+            t for t in transactions if as_stored_timestamp(t["timestamp"]) >= kept_from
+        ]
+        await self._insert_missing(self._writer(write_concern, self._hot), hot)
+
+    @staticmethod
+    async def _insert_missing(
+        collection: AsyncIOMotorCollection, transactions: List[dict]
+    ):
+        # Inserts the ones not already there by _id (or the user's idempotency
+        # key)
+        if not transactions:
+            return
+        try:
+            await collection.insert_many(transactions, ordered=False)
+        except BulkWriteError as e:
+            if any(
+                error["code"] != DUPLICATE_KEY_ERROR
+                for error in e.details["writeErrors"]
+            ):
+                raise
+
+    async def copy_transactions(self, transactions: List[dict]):
+        """
+        Writes transactions stored somewhere else as they are, _ids and
+        verdicts included. Ones already here are skipped, so a copy that
+        stopped part way can be run again.
+        """
+        await self._insert_missing(self._collection, transactions)
+        await self._insert_hot(transactions)
+
+    async def count_transactions(self, ids: List[PyObjectId]) -> int:
+        """
+        How many of the transactions with these _ids are stored here.
+        """
+        if not ids:
+            return 0
+        return await self._collection.count_documents({"_id": {"$in": ids}})
+
+    async def delete_user_transactions(self, user_id: str) -> int:
+        result = await self._collection.delete_many({"user_id": user_id})
+        if self._hot is not None:
+            await self._hot.delete_many({"user_id": user_id})
+        return result.deleted_count
+
+    async def fill_hot_tier(self, batch_size: int = 1000) -> int:
+        """
+        Copies the transactions from the last hot_seconds into the hot tier,
+        for when it's turned on with history already written. Returns how
+        many were copied.
+        """
+        if self._hot is None:
+            return 0
+        kept_from = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=self.hot_seconds
+        )
+        cursor = self._collection.find({"timestamp": {"$gte": kept_from}}).batch_size(
+            batch_size
+        )
+        copied = 0
+        batch = []
+        async for t in cursor:
+            batch.append(t)
+            if len(batch) == batch_size:
+                await self._insert_hot(batch)
+                copied += len(batch)
+                batch = []
+        await self._insert_hot(batch)
+        return copied + len(batch)
+
+    @staticmethod
+    def _as_stored(transaction: dict, id: PyObjectId) -> TransactionModel:
+        # Everything is already here so rather than reading the document back
+        # it's built the way Mongo would return it. The values came from a
+        # validated payload so only the enums need restoring, not validating.
+        return TransactionModel.model_construct(
+            **{
+                **transaction,
+                "id": id,
+                "timestamp": as_stored_timestamp(transaction["timestamp"]),
+                "type": TransactionType(transaction["type"]),
+                "suspicious_reasons": [
+                    SuspiciousReasonsType(r) for r in transaction["suspicious_reasons"]
+                ],
+            }
+        )
+
+    async def get_latest_in_windows(
+        self, user_id: str, windows: List[WindowQuery]
+    ) -> Dict[str, List[dict]]:
+        """
+        The newest `limit` matching transactions in each window, only their
+        `_id` and `timestamp`, newest first. One round trip for every window,
+        so the rules only pay for as many as their thresholds.
+        """
+        if not windows:
+            return {}
+        match = self._windows_query(user_id, windows)
+        pipeline = [
+            {"$match": match},
+            {"$sort": {"timestamp": DESCENDING}},
+            {
+                "$facet": {
+                    w.name: [
+                        {"$match": {"timestamp": self._between(w), **w.query}},
+                        {"$limit": w.limit},
+                        {"$project": {"_id": 1, "timestamp": 1}},
+                    ]
+                    for w in windows
+                }
+            },
+        ]
+        collection = self._reading_since(match["timestamp"]["$gte"])
+        results = await collection.aggregate(pipeline).to_list(None)
+        return results[0] if results else {w.name: [] for w in windows}
+
+    @staticmethod
+    def _windows_query(user_id: str, windows: List[WindowQuery]) -> dict:
+        # Only the user's transactions in the widest window that match at
+        # least one of the windows reach the facets
+        query = {
+            "user_id": user_id,
+            "timestamp": {"$gte": min(w.since for w in windows)},
+        }
+        if all(w.until is not None for w in windows):
+            query["timestamp"]["$lte"] = max(w.until for w in windows)
+        if all(w.query for w in windows):
+            query["$or"] = [w.query for w in windows]
+        return query
+
+    @staticmethod
+    def _between(window: WindowQuery) -> dict:
+        if window.until is None:
+            return {"$gte": window.since}
+        return {"$gte": window.since, "$lte": window.until}
+
+    async def get_transactions_for_user_between(
         self,
         user_id: str,
-        minutes=60,
-        types=Optional[List[TransactionType]],
-        max_amount=Optional[float],
-    ) -> List[TransactionModel]:
-        now = datetime.datetime.utcnow()
-        past = now - datetime.timedelta(minutes=minutes)
-        query = {"user_id": user_id, "timestamp": {"$gte": past}}
-        if type(types) == list:
-            query["type"] = {"$in": types}
-        if type(max_amount) == float:
-            query["amount"] = {"$lte": max_amount}
-        return await self._collection.find(query).to_list(None)
+        since: datetime.datetime,
+        until: datetime.datetime,
+        projection: Optional[dict] = None,
+    ) -> List[dict]:
+        query = {"user_id": user_id, "timestamp": {"$gte": since, "$lte": until}}
+        collection = self._reading_since(since)
+        return await collection.find(query, projection).to_list(None)
+
+    async def iter_transactions_between(
+        self,
+        since: datetime.datetime,
+        until: datetime.datetime,
+        projection: Optional[dict] = None,
+        batch_size: int = 10_000,
+    ) -> AsyncIterator[dict]:
+        """
+        Every user's transactions from `since` up to but not including
+        `until`, in no particular order.
+        """
+        cursor = (
+            self._reading_since(since)
+            .find({"timestamp": {"$gte": since, "$lt": until}}, projection)
+            .batch_size(batch_size)
+        )
+        async for t in cursor:
+            yield t
+
+    async def iter_user_ids(self) -> AsyncIterator[str]:
+        """
+        Every user with a transaction, in order.
+        """
+        cursor = self._collection.aggregate(
+            [{"$group": {"_id": "$user_id"}}, {"$sort": {"_id": ASCENDING}}],
+            allowDiskUse=True,
+        )
+        async for group in cursor:
+            yield group["_id"]
+
+    async def iter_risk_rollups(
+        self, user_ids: Optional[List[str]] = None
+    ) -> AsyncIterator[dict]:
+        """
+        The suspicious transactions counted and summed by user, day, currency
+        and set of reasons, ordered by user so each user's rows come
+        together.
+        """
+        match = {"is_suspicious": True}
+        if user_ids is not None:
+            match["user_id"] = {"$in": user_ids}
+        cursor = self._collection.aggregate(
+            [
+                {"$match": match},
+                {
+                    "$group": {
+                        "_id": {
+                            "user_id": "$user_id",
+                            "day": {
+                                "$dateToString": {
+                                    "format": "%Y-%m-%d",
+                                    "date": "$timestamp",
+                                }
+                            },
+                            "currency": "$currency",
+                            "reasons": "$suspicious_reasons",
+                        },
+                        "count": {"$sum": 1},
+                        "volume": {"$sum": "$amount"},
+                    }
+                },
+                {"$sort": {"_id.user_id": ASCENDING}},
+            ],
+            allowDiskUse=True,
+        )
+        async for rollup in cursor:
+            yield rollup
+
+    async def iter_user_histories(
+        self,
+        from_user: Optional[str] = None,
+        to_user: Optional[str] = None,
+        projection: Optional[dict] = None,
+        batch_size: int = 1000,
+    ) -> AsyncIterator[dict]:
+        """
+        The transactions of the users from `from_user` up to but not including
+        `to_user` (either end open when None), a user at a time and each
+        user's oldest first.
+        """
+        user_ids = {}
+        if from_user is not None:
+            user_ids["$gte"] = from_user
+        if to_user is not None:
+            user_ids["$lt"] = to_user
+        cursor = (
+            self._collection.find({"user_id": user_ids} if user_ids else {}, projection)
+            .sort(self.USER_HISTORY_SORT)
+            .batch_size(batch_size)
+        )
+        async for t in cursor:
+            yield t
+
+    async def update_verdicts(
+        self, verdicts: List[Tuple[PyObjectId, List[SuspiciousReasonsType]]]
+    ) -> int:
+        """
+        Sets the suspicious reasons of stored transactions by _id, returning
+        how many changed.
+        """
+        if not verdicts:
+            return 0
+        updates = [
+            UpdateOne(
+                {"_id": id},
+                {
+                    "$set": {
+                        "is_suspicious": len(reasons) != 0,
+                        "suspicious_reasons": [r.value for r in reasons],
+                    }
+                },
+            )
+            for id, reasons in verdicts
+        ]
+        result = await self._collection.bulk_write(updates, ordered=False)
+        if self._hot is not None:
+            # The rules don't read verdicts, this only keeps the copies alike
+            await self._hot.bulk_write(updates, ordered=False)
+        return result.modified_count
+
+    async def add_reasons(
+        self, additions: List[Tuple[PyObjectId, List[SuspiciousReasonsType]]]
+    ) -> int:
+        """
+        Adds suspicious reasons to stored transactions by _id, keeping the
+        ones they have, returning how many changed.
+        """
+        if not additions:
+            return 0
+        updates = [
+            UpdateOne(
+                {"_id": id},
+                {
+                    "$addToSet": {
+                        "suspicious_reasons": {"$each": [r.value for r in reasons]}
+                    },
+                    "$set": {"is_suspicious": True},
+                },
+            )
+            for id, reasons in additions
+        ]
+        result = await self._collection.bulk_write(updates, ordered=False)
+        if self._hot is not None:
+            await self._hot.bulk_write(updates, ordered=False)
+        return result.modified_count
 
     async def get_suspicious_transactions_for_user(
-        self, user_id: str
+        self,
+        user_id: str,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[datetime.datetime, PyObjectId]] = None,
     ) -> List[TransactionModel]:
-        transactions = (
-            await self._collection.find({"user_id": user_id, "is_suspicious": True})
-            .sort("timestamp")
-            .to_list(None)
+        """
+        Ordered by (timestamp, _id). `after` is the (timestamp, _id) of the
+        last transaction of the previous page.
+        """
+        transactions = await self.get_suspicious_documents_for_user(
+            user_id, limit, after
         )
         return [TransactionModel(**t) for t in transactions]
+
+    async def get_suspicious_documents_for_user(
+        self,
+        user_id: str,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[datetime.datetime, PyObjectId]] = None,
+    ) -> List[dict]:
+        """
+        get_suspicious_transactions_for_user as the stored documents, for
+        responses that don't need the models, see
+        TransactionModel.stored_to_json_dict.
+        """
+        cursor = self._collection.find(
+            self._suspicious_query(user_id, after), self.RESPONSE_PROJECTION
+        ).sort(self.SUSPICIOUS_SORT)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return await cursor.to_list(None)
+
+    async def iter_suspicious_transactions_for_user(
+        self,
+        user_id: str,
+        after: Optional[Tuple[datetime.datetime, PyObjectId]] = None,
+        batch_size: int = 500,
+    ) -> AsyncIterator[TransactionModel]:
+        """
+        The same as get_suspicious_transactions_for_user, a batch at a time
+        as the cursor produces them rather than all at once.
+        """
+        async for t in self.iter_suspicious_documents_for_user(
+            user_id, after, batch_size
+        ):
+            yield TransactionModel(**t)
+
+    async def iter_suspicious_documents_for_user(
+        self,
+        user_id: str,
+        after: Optional[Tuple[datetime.datetime, PyObjectId]] = None,
+        batch_size: int = 500,
+    ) -> AsyncIterator[dict]:
+        cursor = (
+            self._collection.find(
+                self._suspicious_query(user_id, after), self.RESPONSE_PROJECTION
+            )
+            .sort(self.SUSPICIOUS_SORT)
+            .batch_size(batch_size)
+        )
+        async for t in cursor:
+            yield t
+
+    @staticmethod
+    def _suspicious_query(
+        user_id: str, after: Optional[Tuple[datetime.datetime, PyObjectId]] = None
+    ) -> dict:
+        query = {"user_id": user_id, "is_suspicious": True}
+        if after is not None:
+            timestamp, id = after
+            query["$or"] = [
+                {"timestamp": {"$gt": timestamp}},
+                {"timestamp": timestamp, "_id": {"$gt": id}},
+            ]
+        return query
@@ -0,0 +1,78 @@
+from fastapi import APIRouter, Request, Response
+
+import config
+from dependencies import get_connections
+from metrics import CallbackGauge, registry
+from services.transaction.ingest_queue import ingest_queue
+from services.transaction.suspicious_feed import suspicious_feed
+from services.transaction.suspicious_transactions_cache import (
+    suspicious_transactions_cache,
+)
+
+settings = config.get_settings()
+
+
+class MetricsRouter:
+
+    @staticmethod
+    def _suspicious_cache_stats():
+        return {
+            (name,): value
+            for name, value in suspicious_transactions_cache.stats().items()
+        }
+
+    @property
+    def router(self) -> APIRouter:
+        api_router = APIRouter()
+
+        @api_router.get("/metrics", include_in_schema=False)
+        async def metrics(request: Request):
+            connections = get_connections(request)
+            # Read when scraped, these are owned by the connections and cache
+            # so are reported as they are rather than counted again here
+            gauges = [
+                CallbackGauge(
+                    "remodemo_suspicious_cache",
+                    "Suspicious transaction response cache counts",
+                    ["stat"],
+                    self._suspicious_cache_stats,
+                ),
+                CallbackGauge(
+                    "remodemo_connection_pool",
+                    "Mongo and Redis connection pool usage",
+                    ["backend", "stat"],
+                    lambda: {
+                        (backend, stat): value
+                        for backend, stats in connections.stats().items()
+                        for stat, value in stats.items()
+                    },
+                ),
+            ]
+            if suspicious_feed.enabled:
+                gauges.append(
+                    CallbackGauge(
+                        "remodemo_suspicious_feed_subscribers",
+                        "Connections subscribed to the suspicious feed",
+                        [],
+                        lambda: {(): suspicious_feed.subscribers},
+                    )
+                )
+            if settings.INGEST_ASYNC_ENABLED:
+                lag = await ingest_queue.lag()
+                gauges.append(
+                    CallbackGauge(
+                        "remodemo_ingest_queue",
+                        "Queued transactions waiting, being written and the "
+                        "seconds the oldest has waited",
+                        ["stat"],
+                        lambda: {(stat,): value for stat, value in lag.items()},
+                    )
+                )
+            body = registry.render() + "".join(
+                "\n".join(gauge.render()) + "\n" for gauge in gauges
+            )
+            return Response(
+                content=body, media_type="text/plain; version=0.0.4; charset=utf-8"
+            )
+
+        return api_router
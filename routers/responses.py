@@ -0,0 +1,15 @@
+from typing import Any
+
+from fastapi.responses import JSONResponse
+from pydantic_core import to_json
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSONResponse rendered by pydantic_core's serializer rather than the
+    json module, the same idea as ORJSONResponse without another dependency.
+    The app's default response class.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return to_json(content)
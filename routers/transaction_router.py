@@ -1,22 +1,197 @@
-from fastapi import APIRouter
+from typing import List, Literal, Optional
 
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+)
+from fastapi.responses import StreamingResponse
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from redis.asyncio import Redis
+
+import config
+from dependencies import get_database, get_redis
+from metrics import TimedRoute, observe_validation, stage_seconds
+
+from models.db.transaction_model import TransactionModel
 from models.payloads.new_transaction_payload import NewTransactionPayload
+from routers.responses import FastJSONResponse
 from services.transaction.get_suspicious_transactions import GetSuspiciousTransactions
+from services.transaction.ingest_queue import IngestQueueFull, ingest_queue
 from services.transaction.new_transaction import NewTransaction
+from services.transaction.new_transaction_batch import NewTransactionBatch
+from services.transaction.risk_summary import GetRiskSummary
+from services.transaction.suspicious_feed import suspicious_feed
+from services.transaction.user_locks import UserLockTimeout
+
+
+MAX_PAGE_SIZE = 1000
+
+settings = config.get_settings()
 
 
 class TransactionRouter:
 
+    @staticmethod
+    def _get_suspicious_transactions(**kwargs) -> GetSuspiciousTransactions:
+        try:
+            return GetSuspiciousTransactions(**kwargs)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+
+    @staticmethod
+    async def _create(new_transaction):
+        # Another write for the same user held its lock for too long
+        try:
+            return await new_transaction.create()
+        except UserLockTimeout as e:
+            raise HTTPException(
+                status_code=503, detail=str(e), headers={"Retry-After": "1"}
+            )
+
+    @staticmethod
+    async def _enqueue(transaction: NewTransactionPayload) -> Response:
+        if not settings.INGEST_ASYNC_ENABLED:
+            raise HTTPException(status_code=400, detail="Async ingest is not enabled")
+        try:
+            status = await ingest_queue.enqueue(transaction)
+        except IngestQueueFull as e:
+            raise HTTPException(
+                status_code=503, detail=str(e), headers={"Retry-After": "1"}
+            )
+        return FastJSONResponse(content=status, status_code=202)
+
     @property
     def router(self) -> APIRouter:
-        api_router = APIRouter()
+        api_router = APIRouter(route_class=TimedRoute)
 
+        # The transactions are serialized straight to the response body rather
+        # than going through a dict and FastAPI's encoder
         @api_router.post("/transactions", status_code=201)
-        async def new_transaction(body: NewTransactionPayload):
-            return await NewTransaction(transaction=body)()
+        async def new_transaction(
+            request: Request,
+            body: NewTransactionPayload,
+            mode: Literal["sync", "async"] = "sync",
+            database: AsyncIOMotorDatabase = Depends(get_database),
+            redis: Redis = Depends(get_redis),
+        ):
+            observe_validation(request)
+            # Async answers 202 once the transaction is queued, its verdict
+            # comes from GET /transactions/queue/{user_id}/{idempotency_key}
+            if mode == "async":
+                return await self._enqueue(body)
+            transaction = await self._create(
+                NewTransaction(transaction=body, database=database, redis=redis)
+            )
+            with stage_seconds.time(stage="serialization"):
+                content = transaction.to_json_bytes()
+            return Response(
+                content=content,
+                status_code=201,
+                media_type="application/json",
+            )
+
+        @api_router.post("/transactions/batch", status_code=201)
+        async def new_transaction_batch(
+            body: List[NewTransactionPayload],
+            database: AsyncIOMotorDatabase = Depends(get_database),
+            redis: Redis = Depends(get_redis),
+        ):
+            transactions = await self._create(
+                NewTransactionBatch(transactions=body, database=database, redis=redis)
+            )
+            return Response(
+                content=TransactionModel.list_to_json_bytes(transactions),
+                status_code=201,
+                media_type="application/json",
+            )
+
+        @api_router.get("/transactions/queue/{user_id}/{idempotency_key}")
+        async def queued_transaction_status(user_id: str, idempotency_key: str):
+            status = await ingest_queue.status(user_id, idempotency_key)
+            if status is None:
+                raise HTTPException(status_code=404, detail="Unknown idempotency key")
+            return FastJSONResponse(content=status)
 
         @api_router.get("/transactions/suspicious/{user_id}")
-        async def fetch_suspicious_transactions(user_id: str):
-            return await GetSuspiciousTransactions(user_id=user_id)()
+        async def fetch_suspicious_transactions(
+            user_id: str,
+            limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+            after: Optional[str] = None,
+            database: AsyncIOMotorDatabase = Depends(get_database),
+        ):
+            get_suspicious_transactions = self._get_suspicious_transactions(
+                user_id=user_id, database=database, limit=limit, after=after
+            )
+            body = await get_suspicious_transactions.as_json()
+            headers = {}
+            if get_suspicious_transactions.next_cursor:
+                headers["X-Next-Cursor"] = get_suspicious_transactions.next_cursor
+            return Response(
+                content=body, media_type="application/json", headers=headers
+            )
+
+        @api_router.get("/transactions/suspicious/{user_id}/summary")
+        async def suspicious_transactions_summary(
+            user_id: str,
+            database: AsyncIOMotorDatabase = Depends(get_database),
+        ):
+            summary = await GetRiskSummary(user_id=user_id, database=database)()
+            return Response(
+                content=summary.to_json_bytes(), media_type="application/json"
+            )
+
+        @api_router.get("/transactions/suspicious/{user_id}/stream")
+        async def stream_suspicious_transactions(
+            user_id: str,
+            after: Optional[str] = None,
+            database: AsyncIOMotorDatabase = Depends(get_database),
+        ):
+            get_suspicious_transactions = self._get_suspicious_transactions(
+                user_id=user_id, database=database, after=after
+            )
+            return StreamingResponse(
+                get_suspicious_transactions.stream(),
+                media_type="application/x-ndjson",
+            )
+
+        # Server-sent events of suspicious transactions as they're written, for
+        # every user or the user_ids given. Reconnecting with Last-Event-ID
+        # (or last_event_id) carries on after the last one received.
+        @api_router.get("/transactions/suspicious-feed")
+        async def suspicious_transactions_feed(
+            user_id: Optional[List[str]] = Query(None),
+            last_event_id: Optional[str] = None,
+            last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID"),
+        ):
+            if not suspicious_feed.enabled:
+                raise HTTPException(
+                    status_code=400, detail="The suspicious feed is not enabled"
+                )
+            try:
+                subscription = suspicious_feed.subscribe(
+                    user_ids=user_id, last_id=last_event_id_header or last_event_id
+                )
+            except ValueError:
+                raise HTTPException(status_code=422, detail="Unknown Last-Event-ID")
+
+            async def server_sent_events():
+                async for event in suspicious_feed.events(
+                    subscription, settings.SUSPICIOUS_FEED_HEARTBEAT_SECONDS
+                ):
+                    if event is None:
+                        yield b": keep-alive\n\n"
+                    else:
+                        yield event.to_server_sent_event()
+
+            return StreamingResponse(
+                server_sent_events(),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
 
         return api_router
@@ -0,0 +1,361 @@
+import datetime
+import time
+from array import array
+from collections import Counter
+from itertools import compress
+from typing import Dict, List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+import config
+from connections import connections
+from metrics import rule_hits
+from models.db.transaction_model import (
+    SuspiciousReasonsType,
+    TransactionModel,
+    TransactionType,
+)
+from repositories.partitioned_transaction_repository import transaction_repository_for
+from repositories.risk_summary_repository import RiskSummaryRepository
+from services.rules.rule_engine import rule_engine
+from services.rules.rule_plan import RulePlan
+from services.transaction.suspicious_feed import suspicious_feed
+from services.transaction.suspicious_transactions_cache import (
+    SuspiciousTransactionsCache,
+    suspicious_transactions_cache,
+)
+
+settings = config.get_settings()
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+_TYPES = list(TransactionType)
+
+
+def _interned(values: Dict, value) -> int:
+    # The value's number, the next free one the first time it's seen
+    number = values.get(value)
+    if number is None:
+        number = values[value] = len(values)
+    return number
+
+
+class TransactionColumns:
+    """
+    An array-backed window of transactions, a flat array of numbers per
+    field rather than a document per row. Users, types, currencies and sets
+    of reasons are numbered as they're first seen, so every column is one
+    machine value per row. The passes over them are still Python loops
+    (zip, compress, Counter), not vectorised.
+    """
+
+    PROJECTION = {
+        "_id": 1,
+        "user_id": 1,
+        "amount": 1,
+        "currency": 1,
+        "type": 1,
+        "timestamp": 1,
+        "suspicious_reasons": 1,
+    }
+
+    def __init__(self):
+        self.ids: list = []
+        self.users = array("L")
+        self.amounts = array("d")
+        # Microseconds since the epoch, and the minute they fall in
+        self.timestamps = array("q")
+        self.minutes = array("q")
+        self.types = array("B")
+        # The minute and type together, minute * len(_TYPES) + type
+        self.minute_types = array("q")
+        self.currencies = array("H")
+        self.reasons = array("H")
+        self._users: Dict[str, int] = {}
+        self._types = {t.value: i for i, t in enumerate(_TYPES)}
+        self._currencies: Dict[str, int] = {}
+        self._reasons: Dict[Tuple[str, ...], int] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def append(self, document: dict):
+        timestamp = (document["timestamp"] - _EPOCH) // _MICROSECOND
+        minute = timestamp // 60_000_000
+        self.ids.append(document["_id"])
+        self.users.append(_interned(self._users, document["user_id"]))
+        self.amounts.append(document["amount"])
+        self.timestamps.append(timestamp)
+        self.minutes.append(minute)
+        type = self._types[document["type"]]
+        self.types.append(type)
+        self.minute_types.append(minute * len(_TYPES) + type)
+        self.currencies.append(_interned(self._currencies, document["currency"]))
+        self.reasons.append(
+            _interned(self._reasons, tuple(document["suspicious_reasons"]))
+        )
+
+    def user_ids(self) -> List[str]:
+        return list(self._users)
+
+    def reason_sets(self) -> List[Tuple[str, ...]]:
+        # By their number in `reasons`
+        return list(self._reasons)
+
+    def transactions(self, rows: List[int]) -> List[TransactionModel]:
+        """
+        The rows as they're stored, apart from the idempotency keys.
+        """
+        user_ids = self.user_ids()
+        currencies = list(self._currencies)
+        reason_sets = self.reason_sets()
+        transactions = []
+        for row in rows:
+            reasons = reason_sets[self.reasons[row]]
+            transactions.append(
+                TransactionModel.model_construct(
+                    id=self.ids[row],
+                    user_id=user_ids[self.users[row]],
+                    amount=self.amounts[row],
+                    currency=currencies[self.currencies[row]],
+                    timestamp=_EPOCH + self.timestamps[row] * _MICROSECOND,
+                    type=_TYPES[self.types[row]],
+                    is_suspicious=len(reasons) != 0,
+                    suspicious_reasons=[SuspiciousReasonsType(r) for r in reasons],
+                )
+            )
+        return transactions
+
+
+def structuring_rows(
+    columns: TransactionColumns,
+    threshold: float,
+    flagged_at_threshold: bool,
+    band: float,
+    min_users: int,
+) -> List[int]:
+    """
+    The rows with an amount within `band` (a fraction) below `threshold`,
+    in a minute when at least `min_users` users sent one. Amounts the
+    threshold flags on their own aren't counted.
+    """
+    low = threshold * (1 - band)
+    if flagged_at_threshold:
+        below = [low <= a < threshold for a in columns.amounts]
+    else:
+        below = [low <= a <= threshold for a in columns.amounts]
+    # Each user once per minute, as minute << 32 | user
+    users = Counter(
+        key >> 32
+        for key in {
+            minute << 32 | user
+            for minute, user in zip(
+                compress(columns.minutes, below), compress(columns.users, below)
+            )
+        }
+    )
+    busy = {minute for minute, count in users.items() if count >= min_users}
+    if not busy:
+        return []
+    return [
+        row
+        for row, minute in compress(enumerate(columns.minutes), below)
+        if minute in busy
+    ]
+
+
+def burst_rows(
+    columns: TransactionColumns,
+    window_minutes: int,
+    min_users: int,
+    factor: float,
+) -> List[int]:
+    """
+    The rows of a type in a minute when at least `min_users` users, and at
+    least `factor` times the users in an average minute of the window, sent
+    one of that type.
+    """
+    users = Counter(
+        key >> 32
+        for key in {
+            minute_type << 32 | user
+            for minute_type, user in zip(columns.minute_types, columns.users)
+        }
+    )
+    per_type = Counter()
+    for minute_type, count in users.items():
+        per_type[minute_type % len(_TYPES)] += count
+    busy = {
+        minute_type
+        for minute_type, count in users.items()
+        if count >= min_users
+        and count >= factor * per_type[minute_type % len(_TYPES)] / window_minutes
+    }
+    if not busy:
+        return []
+    return [
+        row
+        for row, minute_type in enumerate(columns.minute_types)
+        if minute_type in busy
+    ]
+
+
+def amount_threshold(plan: RulePlan) -> Optional[Tuple[float, bool]]:
+    """
+    The lowest amount the high volume rules flag on its own, and whether
+    that amount itself is flagged.
+    """
+    thresholds = []
+    for rule in plan.rules:
+        if rule.reason != SuspiciousReasonsType.HIGH_VOLUME_TRANSACTION:
+            continue
+        if rule.is_windowed and rule.threshold:
+            continue
+        if rule.filter.amount_gt is not None:
+            thresholds.append((rule.filter.amount_gt, False))
+        if rule.filter.amount_gte is not None:
+            thresholds.append((rule.filter.amount_gte, True))
+    return min(thresholds, default=None, key=lambda t: (t[0], not t[1]))
+
+
+class ScanPatterns:
+    """
+    Looks for patterns across users in the transactions from `since` up to
+    but not including `until`, which the rules can't see one user at a
+    time:
+
+    - STRUCTURING: amounts just under the high volume threshold from
+      several users in the same minute
+    - COORDINATED_BURST: a minute when far more users than usual sent
+      transactions of the same type
+
+    The window is loaded into the array-backed TransactionColumns and each
+    pattern is a Python pass over its arrays. Reasons are added to the transactions that don't
+    already have them with one bulk write, and counted in the risk
+    summaries. Minutes are whole minutes of the clock, so windows that start
+    on one (see window_ending) don't split a minute between scans.
+
+    Rescoring keeps these reasons. Only one scan should run at a time.
+    """
+
+    def __init__(
+        self,
+        since: datetime.datetime,
+        until: datetime.datetime,
+        database: Optional[AsyncIOMotorDatabase] = None,
+        plan: Optional[RulePlan] = None,
+        cache: Optional[SuspiciousTransactionsCache] = None,
+        batch_size: Optional[int] = None,
+    ):
+        self.since = since
+        self.until = until
+        self.db = connections.db if database is None else database
+        self.plan = rule_engine.plan if plan is None else plan
+        self.cache = cache or suspicious_transactions_cache
+        self.batch_size = batch_size or settings.SCANNER_BATCH_SIZE
+        self.transaction_repo = transaction_repository_for(self.db)
+        self.risk_summary_repo = RiskSummaryRepository(db=self.db)
+
+    def _threshold(self) -> Optional[Tuple[float, bool]]:
+        if settings.SCANNER_STRUCTURING_THRESHOLD is not None:
+            return settings.SCANNER_STRUCTURING_THRESHOLD, False
+        return amount_threshold(self.plan)
+
+    def _patterns(
+        self, columns: TransactionColumns
+    ) -> List[Tuple[SuspiciousReasonsType, List[int]]]:
+        window_minutes = max(1, int((self.until - self.since).total_seconds() // 60))
+        patterns = []
+        threshold = self._threshold()
+        if threshold is not None:
+            patterns.append(
+                (
+                    SuspiciousReasonsType.STRUCTURING,
+                    structuring_rows(
+                        columns,
+                        *threshold,
+                        settings.SCANNER_STRUCTURING_BAND,
+                        settings.SCANNER_STRUCTURING_MIN_USERS,
+                    ),
+                )
+            )
+        patterns.append(
+            (
+                SuspiciousReasonsType.COORDINATED_BURST,
+                burst_rows(
+                    columns,
+                    window_minutes,
+                    settings.SCANNER_BURST_MIN_USERS,
+                    settings.SCANNER_BURST_FACTOR,
+                ),
+            )
+        )
+        return patterns
+
+    async def __call__(self) -> dict:
+        started = time.perf_counter()
+        columns = TransactionColumns()
+        async for t in self.transaction_repo.iter_transactions_between(
+            self.since, self.until, TransactionColumns.PROJECTION, self.batch_size
+        ):
+            columns.append(t)
+        loaded = time.perf_counter()
+
+        # Only reasons the transactions don't have yet, so a window scanned
+        # again isn't counted twice
+        reason_sets = columns.reason_sets()
+        added: Dict[int, List[SuspiciousReasonsType]] = {}
+        found = Counter()
+        for reason, rows in self._patterns(columns):
+            for row in rows:
+                if reason.value not in reason_sets[columns.reasons[row]]:
+                    added.setdefault(row, []).append(reason)
+                    found[reason.value] += 1
+        scanned = time.perf_counter()
+
+        updated = await self.transaction_repo.add_reasons(
+            [(columns.ids[row], reasons) for row, reasons in added.items()]
+        )
+        transactions = list(zip(columns.transactions(list(added)), added.values()))
+        if settings.RISK_SUMMARY_ENABLED:
+            await self.risk_summary_repo.add_reasons(transactions)
+        for user_id in {t.user_id for t, _ in transactions}:
+            await self.cache.invalidate(user_id)
+        await suspicious_feed.publish(
+            t.model_copy(
+                update={
+                    "is_suspicious": True,
+                    "suspicious_reasons": t.suspicious_reasons + reasons,
+                }
+            )
+            for t, reasons in transactions
+        )
+        for reason, count in found.items():
+            rule_hits.inc(count, reason=reason)
+
+        finished = time.perf_counter()
+        return {
+            "since": self.since.isoformat(),
+            "until": self.until.isoformat(),
+            "rows": len(columns),
+            "users": len(columns.user_ids()),
+            "flagged": found,
+            "updated": updated,
+            "load_seconds": loaded - started,
+            "scan_seconds": scanned - loaded,
+            "seconds": finished - started,
+            "rows_per_second": len(columns) / max(finished - started, 1e-9),
+            "scan_rows_per_second": len(columns) / max(scanned - loaded, 1e-9),
+        }
+
+
+def window_ending(
+    until: datetime.datetime, minutes: Optional[int] = None
+) -> Tuple[datetime.datetime, datetime.datetime]:
+    """
+    The `minutes` (SCANNER_WINDOW_MINUTES) up to the start of the minute
+    `until` is in.
+    """
+    minutes = minutes or settings.SCANNER_WINDOW_MINUTES
+    until = until.replace(second=0, microsecond=0)
+    return until - datetime.timedelta(minutes=minutes), until
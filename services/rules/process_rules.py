@@ -1,25 +1,36 @@
-from typing import Optional, List
+import asyncio
+import datetime
+import time
+from typing import Optional, List, Dict
 
+from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorDatabase
 
 import config
-from db import db
-from models.db.transaction_model import TransactionType, SuspiciousReasonsType
+from connections import connections
+from metrics import redis_seconds, rule_flag_cache, rule_hits, rule_seconds
+from models.db.transaction_model import SuspiciousReasonsType
 from models.payloads.new_transaction_payload import NewTransactionPayload
-from repositories.transaction_repository import TransactionRepository
+from models.types.timestamps import as_stored_timestamp
+from repositories.partitioned_transaction_repository import transaction_repository_for
 from redis.asyncio import Redis
+from services.rules.redis_windows import redis_windows_for
+from services.rules.rule_engine import rule_engine
+from services.rules.rule_plan import RulePlan, encode_flag
+from services.rules.window_counters import (
+    WindowCounters,
+    WindowRule,
+    window_counters_for,
+)
 
 settings = config.get_settings()
 
 
-FLAG_AMOUNT_THRESHOLD = 10000
-FREQUENT_SMALL_TRANSACTIONS_PER_HOUR_MAX = 4
-FREQUENT_SMALL_TRANSACTIONS_LIMIT = 100.00  # $100 classed as small transaction
-RAPID_TRANSFERS_MINUTES = 5
-RAPID_TRANSFER_MAX = 2
-
-
-redis = Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT)
+def get_window_counters(
+    database: AsyncIOMotorDatabase, plan: Optional[RulePlan] = None
+) -> WindowCounters:
+    plan = rule_engine.plan if plan is None else plan
+    return window_counters_for(database, plan.windows)
 
 
 class ProcessRules:
@@ -28,72 +39,167 @@ class ProcessRules:
         self,
         transaction: NewTransactionPayload,
         database: Optional[AsyncIOMotorDatabase] = None,
+        redis: Optional[Redis] = None,
+        plan: Optional[RulePlan] = None,
+        id: Optional[ObjectId] = None,
     ):
         self.transaction = transaction
-        self.db = db if database is None else database
-        self.transaction_repo = TransactionRepository(db=self.db)
-
-    async def __call__(self) -> List[str]:
-        reasons = []
-        high_volume = await self.is_high_volume()
-        if high_volume:
-            reasons.append(high_volume)
-
-        frequent_small = await self.has_frequent_small_transactions()
-        if frequent_small:
-            reasons.append(frequent_small)
+        # The _id the transaction will be written with, so the Redis windows
+        # can add it while they're being counted
+        self.id = id
+        self.db = connections.db if database is None else database
+        self.redis = connections.redis if redis is None else redis
+        # Taken once so a reload part way through doesn't mix rule sets
+        self.plan = rule_engine.plan if plan is None else plan
+        self.transaction_repo = transaction_repository_for(self.db)
+        counters = settings.RULE_WINDOW_COUNTERS_ENABLED
+        self.window_counters = (
+            get_window_counters(self.db, self.plan)
+            if counters and settings.RULE_WINDOW_STORE == "process"
+            else None
+        )
+        self.redis_windows = (
+            redis_windows_for(self.plan.windows, self.redis)
+            if counters and settings.RULE_WINDOW_STORE == "redis"
+            else None
+        )
+        # The windows the transaction was added to in Redis
+        self.recorded: List[WindowRule] = []
+        # Seconds spent in each step that ran, for the last call
+        self.timings: Dict[str, float] = {}
+
+    async def __call__(self) -> List[SuspiciousReasonsType]:
+        transaction = self.transaction
+        plan = self.plan
+
+        # Windows end at the transaction, not the clock, so replayed and late
+        # transactions are judged as they would have been when they were made
+        at = as_stored_timestamp(transaction.timestamp)
+
+        if self.redis_windows is not None and plan.windowed_rules:
+            ranges, times = await self.evaluate_redis_windows(at)
+            flagged = plan.flagged_at(ranges, at)
+        else:
+            ranges, flagged, times = await self.evaluate_windows(at)
+        for rule in plan.windowed_rules:
+            rule_flag_cache.inc(
+                key=rule.name, result="hit" if rule.name in flagged else "miss"
+            )
 
-        rapid_transfers = await self.has_rapid_transfers()
-        if rapid_transfers:
-            reasons.append(rapid_transfers)
+        reasons, fired = plan.evaluate(
+            transaction.amount, transaction.type, transaction.currency, flagged, times
+        )
+
+        # We have hit a limit, we can cache this in redis to prevent counting
+        # again. The flag runs until the window that fired it would have
+        # dropped below the threshold, a flag running later than that (from
+        # a transaction made after this one) is left alone.
+        now = datetime.datetime.utcnow()
+        writes = []
+        for rule in fired:
+            flag = plan.flag_range(rule, at, times)
+            current = ranges.get(rule.name)
+            if current is not None and current[1] > flag[1]:
+                continue
+            writes.append(
+                self.redis.set(
+                    plan.flag_key(rule, transaction.user_id),
+                    encode_flag(flag),
+                    ex=plan.flag_expiry_seconds(rule, flag, now),
+                )
+            )
+        if writes:
+            with redis_seconds.time(command="set"):
+                await asyncio.gather(*writes)
 
+        for reason in reasons:
+            rule_hits.inc(reason=reason.value)
         return reasons
 
-    async def is_high_volume(self):
-        if self.transaction.amount > FLAG_AMOUNT_THRESHOLD:
-            return SuspiciousReasonsType.HIGH_VOLUME_TRANSACTION
+    async def evaluate_windows(self, at: datetime.datetime):
+        transaction = self.transaction
+        plan = self.plan
 
-    async def has_frequent_small_transactions(self):
-        # We use redis here to save constantly running the same query if there
+        # Every cached flag comes back in a single round trip. A cached flag
+        # fires its rule whatever the current transaction looks like, we use
+        # redis here to save constantly counting the same windows if there
         # are multiple transactions going on for a particular user.
-        redis_key = f"small_transactions{self.transaction.user_id}"
-        exists = await redis.get(redis_key)
-        if exists:
-            return SuspiciousReasonsType.FREQUENT_SMALL_TRANSACTIONS
-
-        # If the current transaction is not a small transaction then we don't
-        # check the previous transactions
-        if self.transaction.amount <= FREQUENT_SMALL_TRANSACTIONS_LIMIT:
-            transactions = await self.transaction_repo.get_recent_transactions_for_user(
-                user_id=self.transaction.user_id,
-                minutes=60,
-                max_amount=FREQUENT_SMALL_TRANSACTIONS_LIMIT,
+        ranges = {}
+        if plan.windowed_rules:
+            started = time.perf_counter()
+            flags = await self.redis.mget(*plan.flag_keys(transaction.user_id))
+            self.timings["redis_flags"] = time.perf_counter() - started
+            redis_seconds.observe(self.timings["redis_flags"], command="mget")
+            ranges = plan.flag_ranges(flags)
+        flagged = plan.flagged_at(ranges, at)
+
+        # Only the windows of rules that could fire are counted, all of them
+        # in one lookup
+        windows = plan.windows_needed(
+            transaction.amount, transaction.type, transaction.currency, flagged
+        )
+        times = {}
+        if windows:
+            started = time.perf_counter()
+            times = await self.count_windows(windows, at)
+            self.timings["windows"] = time.perf_counter() - started
+            self.observe_rules(windows, self.timings["windows"])
+        return ranges, flagged, times
+
+    async def evaluate_redis_windows(self, at: datetime.datetime):
+        # The flags and every window the transaction matches come back from
+        # one script, which adds the transaction to those windows as well
+        transaction = self.transaction
+        plan = self.plan
+        windows = plan.windows_needed(
+            transaction.amount, transaction.type, transaction.currency, set()
+        )
+        started = time.perf_counter()
+        flags, times = await self.redis_windows.evaluate(
+            self.transaction_repo,
+            transaction.user_id,
+            at,
+            self.id,
+            plan.flag_keys(transaction.user_id),
+            windows,
+        )
+        self.timings["windows"] = time.perf_counter() - started
+        self.observe_rules(windows, self.timings["windows"])
+        if self.id is not None:
+            self.recorded = windows
+        return plan.flag_ranges(flags), times
+
+    def observe_rules(self, windows: List[WindowRule], seconds: float):
+        # Every window is counted in the one lookup, so each rule that was
+        # waiting on it is timed at the whole lookup
+        for rule in self.plan.windowed_rules:
+            if self.plan.window_of(rule) in windows:
+                rule_seconds.observe(seconds, rule=rule.name)
+
+    async def forget(self):
+        """
+        Takes the transaction back out of the Redis windows when it wasn't
+        written after all.
+        """
+        if self.recorded:
+            await self.redis_windows.forget(
+                self.transaction.user_id, self.id, self.recorded
             )
-            if len(transactions) >= FREQUENT_SMALL_TRANSACTIONS_PER_HOUR_MAX:
-                # We have hit a frequent transaction limit, we can cache this in redis
-                # to prevent running this query constantly
-
-                # Technically we should set this to 1 hour from the first transaction
-                # but for simplicity will mark all future small transactions as suspicious
-                # for the next hour
-                await redis.set(redis_key, 1, ex=3600)
-                return SuspiciousReasonsType.FREQUENT_SMALL_TRANSACTIONS
-
-    async def has_rapid_transfers(self):
-        redis_key = f"rapid_transfers{self.transaction.user_id}"
-        exists = await redis.get(redis_key)
-        if exists:
-            return SuspiciousReasonsType.RAPID_TRANSFERS
-
-        # Ensure the current transaction is a transfer
-        if self.transaction.type == TransactionType.TRANSFER:
-            transactions = await self.transaction_repo.get_recent_transactions_for_user(
-                user_id=self.transaction.user_id,
-                minutes=RAPID_TRANSFERS_MINUTES,
-                types=[TransactionType.TRANSFER],
+            self.recorded = []
+
+    async def count_windows(
+        self, windows: List[WindowRule], at: datetime.datetime
+    ) -> Dict[str, List[datetime.datetime]]:
+        if self.window_counters is not None:
+            return await self.window_counters.counts(
+                self.transaction_repo, self.transaction.user_id, windows, at
             )
-            # This becomes >= as the limit is e.g. 4. So 4 from the DB and 1 from the current one goes over the limit
-            if len(transactions) >= RAPID_TRANSFER_MAX:
-                # Store in Redis so we don't have to keep running this query.
-                await redis.set(redis_key, 1, ex=300)  # 5mins
-                return SuspiciousReasonsType.RAPID_TRANSFERS
+
+        latest = await self.transaction_repo.get_latest_in_windows(
+            user_id=self.transaction.user_id,
+            windows=[window.as_query(at) for window in windows],
+        )
+        return {
+            window.name: [t["timestamp"] for t in latest.get(window.name, [])]
+            for window in windows
+        }
@@ -0,0 +1,144 @@
+import bisect
+import datetime
+from typing import Optional, List
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from redis.asyncio import Redis
+
+from connections import connections
+from metrics import rule_hits
+from models.db.transaction_model import SuspiciousReasonsType
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from models.types.timestamps import as_stored_timestamp
+from repositories.partitioned_transaction_repository import transaction_repository_for
+from services.rules.rule_engine import rule_engine
+from services.rules.rule_plan import RulePlan, encode_flag
+from services.rules.window_counters import WindowRule
+
+
+class ProcessRulesBatch:
+    """
+    Evaluates the same rules as ProcessRules for a group of transactions
+    belonging to a single user, using one windowed fetch instead of a query
+    per rule per transaction.
+
+    Transactions are evaluated in the order given and each one counts toward
+    the windows of the ones after it, as if they had been sent one at a time.
+    Each window ends at the transaction's own timestamp.
+    """
+
+    def __init__(
+        self,
+        user_id: str,
+        transactions: List[NewTransactionPayload],
+        database: Optional[AsyncIOMotorDatabase] = None,
+        redis: Optional[Redis] = None,
+        plan: Optional[RulePlan] = None,
+    ):
+        self.user_id = user_id
+        self.transactions = transactions
+        self.db = connections.db if database is None else database
+        self.redis = connections.redis if redis is None else redis
+        self.plan = rule_engine.plan if plan is None else plan
+        self.transaction_repo = transaction_repository_for(self.db)
+
+    async def __call__(self) -> List[List[SuspiciousReasonsType]]:
+        plan = self.plan
+        ranges = {}
+        if plan.windowed_rules:
+            ranges = plan.flag_ranges(
+                await self.redis.mget(*plan.flag_keys(self.user_id))
+            )
+
+        # Windows end at each transaction's own timestamp, so everything the
+        # batch can look back on is fetched once and searched per transaction
+        ats = [as_stored_timestamp(t.timestamp) for t in self.transactions]
+        window_times = {window.name: [] for window in plan.windows}
+        if plan.windows and ats:
+            widest = datetime.timedelta(
+                minutes=max(window.minutes for window in plan.windows)
+            )
+            stored = await self.transaction_repo.get_transactions_for_user_between(
+                user_id=self.user_id,
+                since=min(ats) - widest,
+                until=max(ats),
+                projection={
+                    "_id": 0,
+                    "timestamp": 1,
+                    "amount": 1,
+                    "type": 1,
+                    "currency": 1,
+                },
+            )
+            for t in stored:
+                self._add(
+                    window_times,
+                    t["amount"],
+                    t["type"],
+                    t.get("currency"),
+                    t["timestamp"],
+                )
+
+        now = datetime.datetime.utcnow()
+        results = []
+        for transaction, at in zip(self.transactions, ats):
+            flagged = plan.flagged_at(ranges, at)
+            times = {
+                window.name: self._latest(window_times[window.name], window, at)
+                for window in plan.windows_needed(
+                    transaction.amount,
+                    transaction.type,
+                    transaction.currency,
+                    flagged,
+                )
+            }
+            reasons, fired = plan.evaluate(
+                transaction.amount,
+                transaction.type,
+                transaction.currency,
+                flagged,
+                times,
+            )
+            for rule in fired:
+                flag = plan.flag_range(rule, at, times)
+                current = ranges.get(rule.name)
+                if current is not None and current[1] > flag[1]:
+                    continue
+                await self.redis.set(
+                    plan.flag_key(rule, self.user_id),
+                    encode_flag(flag),
+                    ex=plan.flag_expiry_seconds(rule, flag, now),
+                )
+                ranges[rule.name] = flag
+
+            # This transaction is written before the next one would have been
+            # evaluated, so it counts toward the following windows
+            self._add(
+                window_times,
+                transaction.amount,
+                transaction.type,
+                transaction.currency,
+                at,
+            )
+
+            for reason in reasons:
+                rule_hits.inc(reason=reason.value)
+            results.append(reasons)
+
+        return results
+
+    def _add(self, window_times, amount, type, currency, timestamp):
+        for window in self.plan.windows:
+            if window.matches(amount, type, currency):
+                bisect.insort(window_times[window.name], timestamp)
+
+    @staticmethod
+    def _latest(
+        timestamps: List[datetime.datetime], window: WindowRule, at: datetime.datetime
+    ) -> List[datetime.datetime]:
+        # The same as the newest `threshold` from Mongo, newest first
+        end = bisect.bisect_right(timestamps, at)
+        start = max(
+            bisect.bisect_left(timestamps, window.since(at)), end - window.threshold
+        )
+        return timestamps[start:end][::-1]
@@ -0,0 +1,362 @@
+import datetime
+import hashlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bson import ObjectId
+from redis.asyncio import Redis
+from redis.exceptions import NoScriptError
+
+import config
+from connections import connections
+from metrics import redis_seconds
+from models.db.transaction_model import TransactionModel
+from models.types.timestamps import as_stored_timestamp
+from repositories.transaction_repository import TransactionRepository, WindowQuery
+from services.rules.window_counters import WindowRule
+
+settings = config.get_settings()
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MILLISECOND = datetime.timedelta(milliseconds=1)
+
+
+def _ms(timestamp: datetime.datetime) -> int:
+    return (as_stored_timestamp(timestamp) - _EPOCH) // _MILLISECOND
+
+
+def _timestamp(ms) -> datetime.datetime:
+    return _EPOCH + int(float(ms)) * _MILLISECOND
+
+
+class _Script:
+    """
+    A Lua script run by its SHA, sent again if Redis doesn't have it yet
+    (after a restart or a SCRIPT FLUSH).
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        self.sha = hashlib.sha1(source.encode()).hexdigest()
+
+    async def __call__(self, redis: Redis, keys: List[str], args: list):
+        try:
+            return await redis.evalsha(self.sha, len(keys), *keys, *args)
+        except NoScriptError:
+            return await redis.eval(self.source, len(keys), *keys, *args)
+
+
+class RedisWindows:
+    """
+    The windowed rules' counts kept in Redis, so every worker sees every
+    transaction and the rules don't read Mongo on the way.
+
+    Each user has a sorted set per window of their matching transactions,
+    scored by timestamp in milliseconds, and a hash of the time each set is
+    complete from. A transaction's flags and windows are read and the
+    transaction is added to its windows in one script, so two transactions
+    from the same user on different workers always count one another.
+    Entries older than the newest by more than the window and
+    `late_seconds` are trimmed as new ones are added.
+
+    A user whose sets aren't there, new or flushed, has them loaded from
+    Mongo. A transaction older than what's complete is counted in Mongo
+    instead, as with the in process counters.
+    """
+
+    # KEYS: since hash, flag keys, window sets. ARGV: at, member ("" to only
+    # count), late ms, ttl ms, number of flag keys, then name, window ms and
+    # threshold for each window. Returns the flags and per window either
+    # {"ok", scores newest first...}, {"late", scores...} or {"missing"}, the
+    # member's own entry is never counted.
+    EVALUATE = _Script(
+        """
+        local at = tonumber(ARGV[1])
+        local member = ARGV[2]
+        local late = tonumber(ARGV[3])
+        local ttl = tonumber(ARGV[4])
+        local flags = tonumber(ARGV[5])
+        local result = {}
+        for i = 1, flags do
+            result[i] = redis.call("get", KEYS[1 + i])
+        end
+        local windows = {}
+        for w = 1, #KEYS - 1 - flags do
+            local key = KEYS[1 + flags + w]
+            local name = ARGV[3 + 3 * w]
+            local window = tonumber(ARGV[4 + 3 * w])
+            local threshold = tonumber(ARGV[5 + 3 * w])
+            local since = redis.call("hget", KEYS[1], name)
+            if not since then
+                -- Added all the same, so it's counted by the others once
+                -- the window has been loaded
+                if member ~= "" then
+                    redis.call("zadd", key, at, member)
+                end
+                windows[w] = {"missing"}
+            else
+                since = tonumber(since)
+                local entry = {"ok"}
+                local scores = redis.call(
+                    "zrevrangebyscore", key, at, at - window,
+                    "withscores", "limit", 0, threshold + 1
+                )
+                for j = 1, #scores, 2 do
+                    if scores[j] ~= member and #entry - 1 < threshold then
+                        entry[#entry + 1] = scores[j + 1]
+                    end
+                end
+                if at - window < since and #entry - 1 < threshold then
+                    entry[1] = "late"
+                end
+                if member ~= "" then
+                    redis.call("zadd", key, at, member)
+                    local newest = redis.call("zrevrange", key, 0, 0, "withscores")
+                    local cut = tonumber(newest[2]) - window - late
+                    if cut > since then
+                        redis.call("zremrangebyscore", key, "-inf", "(" .. cut)
+                        redis.call("hset", KEYS[1], name, cut)
+                    end
+                end
+                redis.call("pexpire", key, ttl)
+                windows[w] = entry
+            end
+        end
+        redis.call("pexpire", KEYS[1], ttl)
+        result[flags + 1] = windows
+        return result
+        """
+    )
+
+    # KEYS: since hash, window sets. ARGV: ttl ms, then for each window its
+    # name, the time it's complete from, the number of entries and the
+    # entries as score, member pairs.
+    LOAD = _Script(
+        """
+        local ttl = tonumber(ARGV[1])
+        local arg = 2
+        for w = 1, #KEYS - 1 do
+            local name = ARGV[arg]
+            local since = tonumber(ARGV[arg + 1])
+            local count = tonumber(ARGV[arg + 2])
+            arg = arg + 3
+            for j = 1, count do
+                redis.call("zadd", KEYS[1 + w], ARGV[arg], ARGV[arg + 1])
+                arg = arg + 2
+            end
+            local current = redis.call("hget", KEYS[1], name)
+            if not current or tonumber(current) < since then
+                redis.call("hset", KEYS[1], name, since)
+            end
+            redis.call("pexpire", KEYS[1 + w], ttl)
+        end
+        redis.call("pexpire", KEYS[1], ttl)
+        return 1
+        """
+    )
+
+    def __init__(
+        self,
+        rules: List[WindowRule],
+        late_seconds: int = 3600,
+        load_limit: int = 10_000,
+        redis: Optional[Redis] = None,
+    ):
+        self.rules = rules
+        self.late_seconds = late_seconds
+        self.load_limit = load_limit
+        self._redis = redis
+        widest = max((rule.minutes for rule in rules), default=0)
+        # Long enough that a set is only ever dropped once all of it would
+        # have been trimmed anyway
+        self.ttl_ms = (widest * 60 + late_seconds + 60) * 1000
+
+    @property
+    def redis(self) -> Redis:
+        return connections.redis if self._redis is None else self._redis
+
+    @staticmethod
+    def _since_key(user_id: str) -> str:
+        return f"windows:{{{user_id}}}"
+
+    @staticmethod
+    def _window_key(user_id: str, rule: WindowRule) -> str:
+        return f"windows:{{{user_id}}}:{rule.name}"
+
+    async def evaluate(
+        self,
+        transaction_repo: TransactionRepository,
+        user_id: str,
+        at: datetime.datetime,
+        id: Optional[ObjectId],
+        flag_keys: List[str],
+        windows: List[WindowRule],
+    ) -> Tuple[List[Optional[bytes]], Dict[str, List[datetime.datetime]]]:
+        """
+        The values at `flag_keys` and the timestamps of the newest matching
+        transactions in each window ending at `at`, newest first and at most
+        the window's threshold. The transaction `id` is added to the windows,
+        they should be the ones it matches.
+        """
+        flags, replies = await self._evaluate(user_id, at, id, flag_keys, windows)
+
+        missing = [w for w, reply in zip(windows, replies) if reply[0] == b"missing"]
+        if missing:
+            await self.load(transaction_repo, user_id, missing, at)
+            _, loaded = await self._evaluate(user_id, at, id, [], missing)
+            replies = [
+                loaded[missing.index(w)] if w in missing else reply
+                for w, reply in zip(windows, replies)
+            ]
+
+        times = {}
+        late = []
+        for window, reply in zip(windows, replies):
+            if reply[0] == b"ok":
+                times[window.name] = [_timestamp(score) for score in reply[1:]]
+            else:
+                late.append(window)
+        if late:
+            latest = await transaction_repo.get_latest_in_windows(
+                user_id=user_id, windows=[window.as_query(at) for window in late]
+            )
+            for window in late:
+                times[window.name] = [
+                    t["timestamp"] for t in latest.get(window.name, [])
+                ]
+        return flags, times
+
+    async def _evaluate(
+        self,
+        user_id: str,
+        at: datetime.datetime,
+        id: Optional[ObjectId],
+        flag_keys: List[str],
+        windows: List[WindowRule],
+    ) -> Tuple[list, List[list]]:
+        args = [
+            _ms(at),
+            "" if id is None else str(id),
+            self.late_seconds * 1000,
+            self.ttl_ms,
+            len(flag_keys),
+        ]
+        for window in windows:
+            args += [window.name, window.minutes * 60_000, window.threshold]
+        with redis_seconds.time(command="evalsha"):
+            reply = await self.EVALUATE(
+                self.redis,
+                [self._since_key(user_id)]
+                + flag_keys
+                + [self._window_key(user_id, window) for window in windows],
+                args,
+            )
+        replies = [[self._bytes(value) for value in entry] for entry in reply[-1]]
+        return reply[:-1], replies
+
+    @staticmethod
+    def _bytes(value) -> bytes:
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    async def load(
+        self,
+        transaction_repo: TransactionRepository,
+        user_id: str,
+        windows: List[WindowRule],
+        at: Optional[datetime.datetime] = None,
+    ):
+        """
+        Loads the user's windows from Mongo, complete from the start of the
+        window ending at `at` (now by default) on to the newest transaction.
+        Past `load_limit` transactions only the newest are loaded and they're
+        complete from the oldest of those.
+        """
+        at = datetime.datetime.utcnow() if at is None else at
+        latest = await transaction_repo.get_latest_in_windows(
+            user_id=user_id,
+            windows=[
+                WindowQuery(
+                    name=window.name,
+                    since=window.since(at),
+                    until=None,
+                    limit=self.load_limit,
+                    query=window.filter.query(),
+                )
+                for window in windows
+            ],
+        )
+        args = [self.ttl_ms]
+        for window in windows:
+            transactions = latest.get(window.name, [])
+            since = _ms(window.since(at))
+            if len(transactions) >= self.load_limit:
+                # Others at the oldest one's time may not have made it in
+                since = _ms(transactions[-1]["timestamp"]) + 1
+            args += [window.name, since, len(transactions)]
+            for t in transactions:
+                args += [_ms(t["timestamp"]), str(t["_id"])]
+        await self.LOAD(
+            self.redis,
+            [self._since_key(user_id)]
+            + [self._window_key(user_id, window) for window in windows],
+            args,
+        )
+
+    async def record(self, transactions: Iterable[TransactionModel]):
+        """
+        Adds transactions written without going through evaluate, batches.
+        They're added whether the user's windows are loaded or not, a load
+        later on only adds to what's there.
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for transaction in transactions:
+                for window in self.rules:
+                    if window.matches(
+                        transaction.amount, transaction.type, transaction.currency
+                    ):
+                        key = self._window_key(transaction.user_id, window)
+                        pipe.zadd(
+                            key, {str(transaction.id): _ms(transaction.timestamp)}
+                        )
+                        pipe.pexpire(key, self.ttl_ms)
+            await pipe.execute()
+
+    async def forget(self, user_id: str, id: ObjectId, windows: List[WindowRule]):
+        """
+        Takes back a transaction evaluate added that wasn't written after all.
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for window in windows:
+                pipe.zrem(self._window_key(user_id, window), str(id))
+            await pipe.execute()
+
+    async def rebuild(
+        self,
+        transaction_repo: TransactionRepository,
+        user_ids: Iterable[str],
+        at: Optional[datetime.datetime] = None,
+    ) -> int:
+        """
+        Drops and reloads the users' windows from Mongo, after Redis has been
+        flushed or has lost writes. Users not rebuilt are loaded when they're
+        next seen.
+        """
+        users = 0
+        for user_id in user_ids:
+            await self.redis.delete(
+                self._since_key(user_id),
+                *[self._window_key(user_id, window) for window in self.rules],
+            )
+            await self.load(transaction_repo, user_id, self.rules, at)
+            users += 1
+        return users
+
+
+def redis_windows_for(
+    rules: List[WindowRule], redis: Optional[Redis] = None
+) -> RedisWindows:
+    return RedisWindows(
+        rules=rules,
+        late_seconds=settings.RULE_WINDOW_REDIS_LATE_SECONDS,
+        load_limit=settings.RULE_WINDOW_REDIS_LOAD_LIMIT,
+        redis=redis,
+    )
@@ -0,0 +1,91 @@
+import asyncio
+import contextlib
+import logging
+import os
+from typing import Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+import config
+from models.db.rule_model import RuleSetModel
+from repositories.rule_repository import RuleRepository
+from services.rules.rule_plan import DEFAULT_RULE_SET, RulePlan
+
+logger = logging.getLogger(__name__)
+
+
+class RuleEngine:
+    """
+    Holds the compiled rules and reloads them from their source.
+
+    RULES_SOURCE is "default" for the rules in rule_plan.py, "file" for the
+    JSON file at RULES_FILE or "mongo" for the rule set saved with
+    RuleRepository. A reload compiles the new rules before replacing `plan`
+    in one assignment, and the rules read `plan` once per transaction, so
+    every transaction is evaluated against one complete set of rules.
+    """
+
+    def __init__(self, settings: config.Settings):
+        self.settings = settings
+        self.plan = RulePlan(DEFAULT_RULE_SET)
+        # File modification time or stored version of the loaded rules
+        self._loaded: Optional[int] = None
+        self._watcher: Optional[asyncio.Task] = None
+
+    async def start(self, database: Optional[AsyncIOMotorDatabase] = None):
+        """
+        Loads the rules and keeps reloading them in the background. Called
+        from the app's lifespan, rules that can't be loaded stop startup.
+        """
+        await self.load(database)
+        if self.settings.RULES_SOURCE != "default":
+            self._watcher = asyncio.create_task(self.watch(database))
+
+    async def stop(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._watcher
+            self._watcher = None
+
+    async def load(self, database: Optional[AsyncIOMotorDatabase] = None) -> bool:
+        """
+        Loads the rules if they've changed since they were last loaded.
+        Invalid rules raise and leave the current ones in place.
+        """
+        source = self.settings.RULES_SOURCE
+        if source == "file":
+            loaded = os.stat(self.settings.RULES_FILE).st_mtime_ns
+            if loaded == self._loaded:
+                return False
+            with open(self.settings.RULES_FILE) as f:
+                rule_set = RuleSetModel.model_validate_json(f.read())
+        elif source == "mongo":
+            rule_repo = RuleRepository(db=database)
+            loaded = await rule_repo.get_version()
+            if loaded is None or loaded == self._loaded:
+                return False
+            rule_set = await rule_repo.get_rule_set()
+        else:
+            return False
+
+        self.plan = RulePlan(rule_set)
+        self._loaded = loaded
+        logger.info(
+            "Loaded %s rules from %s (%s)", len(self.plan.rules), source, loaded
+        )
+        return True
+
+    async def watch(self, database: Optional[AsyncIOMotorDatabase] = None):
+        """
+        Reloads the rules every RULES_RELOAD_SECONDS until cancelled.
+        """
+        while True:
+            await asyncio.sleep(self.settings.RULES_RELOAD_SECONDS)
+            try:
+                await self.load(database)
+            except Exception:
+                logger.exception("Could not reload the rules, keeping the current ones")
+
+
+rule_engine = RuleEngine(settings=config.get_settings())
@@ -0,0 +1,222 @@
+import datetime
+import hashlib
+import math
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from models.db.rule_model import RuleModel, RuleSetModel, TransactionFilter
+from models.db.transaction_model import SuspiciousReasonsType, TransactionType
+from services.rules.window_counters import WindowRule
+
+# The rules used when none are configured
+DEFAULT_RULE_SET = RuleSetModel(
+    rules=[
+        RuleModel(
+            name="high_volume",
+            reason=SuspiciousReasonsType.HIGH_VOLUME_TRANSACTION,
+            filter=TransactionFilter(amount_gt=10000),
+        ),
+        # This is >= 4 from the DB, so the 5th small transaction in an hour
+        # is flagged including the current one
+        RuleModel(
+            name="small_transactions",
+            reason=SuspiciousReasonsType.FREQUENT_SMALL_TRANSACTIONS,
+            filter=TransactionFilter(amount_lte=100.00),  # $100 classed as small
+            window_minutes=60,
+            threshold=4,
+        ),
+        RuleModel(
+            name="rapid_transfers",
+            reason=SuspiciousReasonsType.RAPID_TRANSFERS,
+            filter=TransactionFilter(types=[TransactionType.TRANSFER]),
+            window_minutes=5,
+            threshold=2,
+        ),
+    ]
+)
+
+
+# When a rule's flag holds, from the transaction that fired it until the
+# end of the window it filled, in transaction time
+FlagRange = Tuple[datetime.datetime, datetime.datetime]
+
+# Flags written before they carried a range hold until Redis expires them
+_UNBOUNDED_FLAG: FlagRange = (datetime.datetime.min, datetime.datetime.max)
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def encode_flag(flag: FlagRange) -> str:
+    start, until = flag
+    return f"{(start - _EPOCH) // _MICROSECOND}:{(until - _EPOCH) // _MICROSECOND}"
+
+
+def decode_flag(value: Union[bytes, str]) -> FlagRange:
+    value = value.decode() if isinstance(value, bytes) else str(value)
+    try:
+        start, until = value.split(":")
+        return (
+            _EPOCH + int(start) * _MICROSECOND,
+            _EPOCH + int(until) * _MICROSECOND,
+        )
+    except ValueError:
+        return _UNBOUNDED_FLAG
+
+
+def _window_name(minutes: int, threshold: int, filter: TransactionFilter) -> str:
+    # Named after what's counted so a reload keeps the counts of windows that
+    # haven't changed
+    digest = hashlib.sha1(filter.model_dump_json().encode()).hexdigest()[:10]
+    return f"w{minutes}m_{threshold}_{digest}"
+
+
+class RulePlan:
+    """
+    A rule set compiled for evaluation.
+
+    Windowed rules with the same window and filter share one WindowRule, so
+    they're one counter or one facet of the windows query however many there
+    are. The cached flags of every windowed rule are fetched with one MGET
+    and the windows with one lookup, so adding rules doesn't add round trips.
+    """
+
+    def __init__(self, rule_set: RuleSetModel):
+        self.version = rule_set.version
+        self.rules: List[RuleModel] = [r for r in rule_set.rules if r.enabled]
+        self.windowed_rules: List[RuleModel] = [r for r in self.rules if r.is_windowed]
+
+        # Rules with a threshold of 0 fire on the transaction alone
+        thresholds: Dict[Tuple[int, TransactionFilter], int] = {}
+        for rule in self.windowed_rules:
+            if rule.threshold:
+                key = (rule.window_minutes, rule.filter)
+                thresholds[key] = max(thresholds.get(key, 0), rule.threshold)
+        self.windows: List[WindowRule] = [
+            WindowRule(
+                name=_window_name(minutes, threshold, filter),
+                minutes=minutes,
+                threshold=threshold,
+                filter=filter,
+            )
+            for (minutes, filter), threshold in thresholds.items()
+        ]
+        windows = {(w.minutes, w.filter): w for w in self.windows}
+        self._window_of: Dict[str, WindowRule] = {
+            rule.name: windows[(rule.window_minutes, rule.filter)]
+            for rule in self.windowed_rules
+            if rule.threshold
+        }
+
+    def window_of(self, rule: RuleModel) -> Optional[WindowRule]:
+        return self._window_of.get(rule.name)
+
+    @staticmethod
+    def flag_key(rule: RuleModel, user_id: str) -> str:
+        return f"{rule.name}{user_id}"
+
+    def flag_keys(self, user_id: str) -> List[str]:
+        """
+        The Redis keys of the windowed rules' flags, in `windowed_rules` order.
+        """
+        return [self.flag_key(rule, user_id) for rule in self.windowed_rules]
+
+    def flag_ranges(self, flags: List[Optional[bytes]]) -> Dict[str, FlagRange]:
+        """
+        The flags of the rules that have one, from the values at `flag_keys`.
+        """
+        return {
+            rule.name: decode_flag(flag)
+            for rule, flag in zip(self.windowed_rules, flags)
+            if flag
+        }
+
+    @staticmethod
+    def flagged_at(ranges: Dict[str, FlagRange], at: datetime.datetime) -> Set[str]:
+        """
+        The names of the rules flagged for a transaction made at `at`.
+        """
+        return {name for name, (start, until) in ranges.items() if start <= at < until}
+
+    def flag_range(
+        self,
+        rule: RuleModel,
+        at: datetime.datetime,
+        times: Dict[str, List[datetime.datetime]],
+    ) -> FlagRange:
+        """
+        How long a rule that fired at `at` stays flagged. That's until the
+        oldest transaction it counted leaves the window, when the count could
+        drop below the threshold again, unless `flag_seconds` says otherwise.
+        """
+        if rule.flag_seconds:
+            return at, at + datetime.timedelta(seconds=rule.flag_seconds)
+        window = self._window_of.get(rule.name)
+        if window is None:
+            oldest = at
+        else:
+            oldest = times[window.name][rule.threshold - 1]
+        return at, oldest + datetime.timedelta(minutes=rule.window_minutes)
+
+    @staticmethod
+    def flag_expiry_seconds(
+        rule: RuleModel, flag: FlagRange, now: datetime.datetime
+    ) -> int:
+        """
+        The Redis expiry for a flag, so it goes when the range ends. Flags
+        already over by the clock, from replays or late transactions, are
+        kept for the length of the rule for others arriving around them.
+        """
+        seconds = math.ceil((flag[1] - now).total_seconds())
+        return seconds if seconds > 0 else rule.flag_ttl_seconds
+
+    def windows_needed(
+        self, amount: float, type: TransactionType, currency: str, flagged: Set[str]
+    ) -> List[WindowRule]:
+        """
+        The windows that have to be counted to evaluate a transaction. A rule
+        that's flagged or doesn't match the transaction can't need its count.
+        """
+        needed = {}
+        for rule in self.windowed_rules:
+            window = self._window_of.get(rule.name)
+            if (
+                window is not None
+                and rule.name not in flagged
+                and rule.filter.matches(amount, type, currency)
+            ):
+                needed[window.name] = window
+        return list(needed.values())
+
+    def evaluate(
+        self,
+        amount: float,
+        type: TransactionType,
+        currency: str,
+        flagged: Set[str],
+        times: Dict[str, List[datetime.datetime]],
+    ) -> Tuple[List[SuspiciousReasonsType], List[RuleModel]]:
+        """
+        The reasons a transaction is suspicious, in rule order, and the
+        windowed rules that fired without already being flagged. `times` has
+        the newest timestamps in each of the `windows_needed`, newest first,
+        up to the window's threshold.
+        """
+        reasons = []
+        fired = []
+        for rule in self.rules:
+            if rule.name in flagged:
+                # A flagged rule fires whatever the current transaction is
+                matched = True
+            elif not rule.filter.matches(amount, type, currency):
+                matched = False
+            elif rule.is_windowed:
+                window = self._window_of.get(rule.name)
+                matched = window is None or len(times[window.name]) >= rule.threshold
+                if matched:
+                    fired.append(rule)
+            else:
+                matched = True
+
+            if matched and rule.reason not in reasons:
+                reasons.append(rule.reason)
+        return reasons, fired
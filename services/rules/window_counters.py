@@ -0,0 +1,233 @@
+import bisect
+import datetime
+import weakref
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+import config
+from models.db.rule_model import TransactionFilter
+from models.db.transaction_model import TransactionModel, TransactionType
+from models.types.timestamps import as_naive_utc
+from repositories.transaction_repository import TransactionRepository, WindowQuery
+
+settings = config.get_settings()
+
+
+class WindowRule(NamedTuple):
+    """
+    A count of a user's transactions matching `filter` within `minutes` of a
+    transaction. A rule fires once the count reaches `threshold`, so that's
+    all a counter needs to remember. Rules sharing a window and filter share
+    a WindowRule with the largest of their thresholds.
+    """
+
+    name: str
+    minutes: int
+    threshold: int
+    filter: TransactionFilter
+
+    def matches(self, amount: float, type: TransactionType, currency: str) -> bool:
+        return self.filter.matches(amount, type, currency)
+
+    def since(self, at: datetime.datetime) -> datetime.datetime:
+        return at - datetime.timedelta(minutes=self.minutes)
+
+    def as_query(self, at: datetime.datetime, open_ended=False) -> WindowQuery:
+        """
+        The window ending at `at`, or starting there and running on to the
+        newest transactions when `open_ended`.
+        """
+        return WindowQuery(
+            name=self.name,
+            since=self.since(at),
+            until=None if open_ended else at,
+            limit=self.threshold,
+            query=self.filter.query(),
+        )
+
+
+class _Ring(list):
+    """
+    (timestamp, _id) pairs, oldest first. Complete from `since` on, apart from
+    the older ones dropped once there are `threshold` newer.
+    """
+
+    __slots__ = ("since",)
+
+    def __init__(self, since: datetime.datetime):
+        super().__init__()
+        self.since = since
+
+
+class WindowCounters:
+    """
+    Per user sliding window counts for the windowed rules, kept in process so
+    the rules don't have to query Mongo for every transaction.
+
+    For each user and rule only the newest `threshold` matching transactions
+    are kept. The rule fires when the count in the window reaches `threshold`,
+    which is exactly when the oldest of those is still inside the window, so
+    the answer is the same as counting in Mongo while memory per user stays
+    fixed. Users are evicted least recently used first once `max_users` is
+    reached and are loaded from Mongo again the next time they're looked up.
+
+    Windows end at the transaction being evaluated. A transaction older than
+    ones already kept, or older than what was loaded, can't be answered from
+    memory and is looked up in Mongo instead.
+
+    The counts only see transactions written by this process, running several
+    workers against the same database needs a shared store instead.
+    """
+
+    def __init__(self, rules: List[WindowRule], max_users: int = 100_000):
+        self.rules = rules
+        self.max_users = max_users
+        self._users: "OrderedDict[str, Dict[str, _Ring]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def clear(self):
+        self._users.clear()
+
+    def set_rules(self, rules: List[WindowRule]):
+        """
+        Switches to a new set of windows. Windows are named after what they
+        count, so the counts of windows that are still there are kept.
+        """
+        names = {rule.name for rule in rules}
+        for rings in self._users.values():
+            for name in list(rings):
+                if name not in names:
+                    del rings[name]
+        self.rules = rules
+
+    async def counts(
+        self,
+        transaction_repo: TransactionRepository,
+        user_id: str,
+        rules: List[WindowRule],
+        at: Optional[datetime.datetime] = None,
+    ) -> Dict[str, List[datetime.datetime]]:
+        """
+        The timestamps of the user's newest matching transactions in each
+        rule's window ending at `at` (now by default), newest first and at
+        most the rule's threshold. Windows not loaded yet for the user are
+        loaded from Mongo together.
+        """
+        at = datetime.datetime.utcnow() if at is None else at
+        rings = self._touch(user_id)
+        missing = [rule for rule in rules if rule.name not in rings]
+        if missing:
+            # Created before loading so anything recorded while we wait on
+            # Mongo isn't lost, duplicates are dropped by _id. Loaded without
+            # an end so the ring holds the newest there are.
+            for rule in missing:
+                rings[rule.name] = _Ring(since=rule.since(at))
+            latest = await transaction_repo.get_latest_in_windows(
+                user_id=user_id,
+                windows=[rule.as_query(at, open_ended=True) for rule in missing],
+            )
+            for rule in missing:
+                for t in latest.get(rule.name, []):
+                    self._push(rings[rule.name], rule, t["timestamp"], t["_id"])
+
+        times = {}
+        late = []
+        for rule in rules:
+            ring = rings[rule.name]
+            since = rule.since(at)
+            if (ring and ring[-1][0] > at) or (
+                since < ring.since and len(ring) < rule.threshold
+            ):
+                late.append(rule)
+                continue
+            start = bisect.bisect_left(ring, (since,))
+            times[rule.name] = [timestamp for timestamp, _ in reversed(ring[start:])]
+
+        if late:
+            latest = await transaction_repo.get_latest_in_windows(
+                user_id=user_id, windows=[rule.as_query(at) for rule in late]
+            )
+            for rule in late:
+                times[rule.name] = [t["timestamp"] for t in latest.get(rule.name, [])]
+        return times
+
+    async def count(
+        self,
+        transaction_repo: TransactionRepository,
+        user_id: str,
+        rule: WindowRule,
+        at: Optional[datetime.datetime] = None,
+    ) -> int:
+        times = await self.counts(transaction_repo, user_id, [rule], at)
+        return len(times[rule.name])
+
+    def record(self, transaction: TransactionModel):
+        """
+        Counts a transaction that has just been written. Users we haven't
+        loaded yet are skipped, their first lookup will read it from Mongo.
+        """
+        rings = self._users.get(transaction.user_id)
+        if rings is None:
+            return
+        self._users.move_to_end(transaction.user_id)
+        timestamp = as_naive_utc(transaction.timestamp)
+        for rule in self.rules:
+            ring = rings.get(rule.name)
+            if ring is not None and rule.matches(
+                transaction.amount, transaction.type, transaction.currency
+            ):
+                self._push(ring, rule, timestamp, transaction.id)
+
+    def _touch(self, user_id: str) -> Dict[str, _Ring]:
+        rings = self._users.get(user_id)
+        if rings is None:
+            rings = self._users[user_id] = {}
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return rings
+
+    @staticmethod
+    def _push(
+        ring: _Ring, rule: WindowRule, timestamp: datetime.datetime, id: ObjectId
+    ):
+        if any(existing_id == id for _, existing_id in ring):
+            return
+        bisect.insort(ring, (timestamp, id))
+        if len(ring) > rule.threshold:
+            ring.pop(0)
+
+
+# id(database) -> (weak reference to the database, its counters). Keyed on
+# identity because databases compare equal by name.
+_window_counters: Dict[int, Tuple[weakref.ref, WindowCounters]] = {}
+
+
+def window_counters_for(
+    database: AsyncIOMotorDatabase, rules: List[WindowRule]
+) -> WindowCounters:
+    """
+    The counters mirror a single database, so each database gets its own.
+    They follow `rules` when the rules are reloaded.
+    """
+    key = id(database)
+    entry = _window_counters.get(key)
+    if entry is not None and entry[0]() is database:
+        if entry[1].rules != rules:
+            entry[1].set_rules(rules)
+        return entry[1]
+
+    counters = WindowCounters(
+        rules=rules, max_users=settings.RULE_WINDOW_COUNTERS_MAX_USERS
+    )
+    _window_counters[key] = (
+        weakref.ref(database, lambda _: _window_counters.pop(key, None)),
+        counters,
+    )
+    return counters
@@ -1,21 +1,73 @@
-from typing import Optional, List
+from typing import Optional, List, AsyncIterator
 
 from motor.motor_asyncio import AsyncIOMotorDatabase
 
-from db import db
+from connections import connections
 from models.db.transaction_model import TransactionModel
-from repositories.transaction_repository import TransactionRepository
+from models.types.page_cursor import decode_cursor, encode_cursor
+from repositories.partitioned_transaction_repository import transaction_repository_for
+from services.transaction.suspicious_transactions_cache import (
+    SuspiciousTransactionsCache,
+    suspicious_transactions_cache,
+)
 
 
 class GetSuspiciousTransactions:
 
-    def __init__(self, user_id: str, database: Optional[AsyncIOMotorDatabase] = None):
+    def __init__(
+        self,
+        user_id: str,
+        database: Optional[AsyncIOMotorDatabase] = None,
+        limit: Optional[int] = None,
+        after: Optional[str] = None,
+        cache: Optional[SuspiciousTransactionsCache] = None,
+    ):
         self.user_id = user_id
-        self.db = database or db
-        self.transaction_repo = TransactionRepository(db=self.db)
+        self.db = connections.db if database is None else database
+        self.transaction_repo = transaction_repository_for(self.db)
+        self.limit = limit
+        self.cache = cache or suspicious_transactions_cache
+        # Raises ValueError for a cursor we didn't hand out
+        self.after = decode_cursor(after) if after else None
+        # Set once called when there may be another page
+        self.next_cursor: Optional[str] = None
 
     async def __call__(self) -> List[dict]:
-        transactions = await self.transaction_repo.get_suspicious_transactions_for_user(
-            user_id=self.user_id
+        documents = await self._page()
+        return [TransactionModel.stored_to_json_dict(d) for d in documents]
+
+    async def _page(self) -> List[dict]:
+        # The documents are only read to be sent on, so they go straight to
+        # the response rather than through the models
+        documents = await self.transaction_repo.get_suspicious_documents_for_user(
+            user_id=self.user_id, limit=self.limit, after=self.after
+        )
+        if self.limit is not None and len(documents) == self.limit:
+            last = documents[-1]
+            self.next_cursor = encode_cursor(last["timestamp"], last["_id"])
+        return documents
+
+    async def as_json(self) -> bytes:
+        """
+        The response as JSON. Whole lists are read through the cache, pages
+        aren't cached.
+        """
+        if self.limit is not None or self.after is not None:
+            return TransactionModel.stored_list_to_json_bytes(await self._page())
+
+        version, body = await self.cache.get(self.user_id)
+        if body is None:
+            body = TransactionModel.stored_list_to_json_bytes(await self._page())
+            await self.cache.set(self.user_id, version, body)
+        return body
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """
+        Newline delimited JSON, one transaction per line, written as the
+        database cursor produces them.
+        """
+        documents = self.transaction_repo.iter_suspicious_documents_for_user(
+            user_id=self.user_id, after=self.after
         )
-        return [t.to_dict_json() for t in transactions]
+        async for document in documents:
+            yield TransactionModel.stored_to_json_bytes(document) + b"\n"
@@ -0,0 +1,81 @@
+import asyncio
+import json
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from redis.asyncio import Redis
+
+import config
+from connections import connections
+from models.db.transaction_model import TransactionModel
+
+settings = config.get_settings()
+
+
+def scoped_key(user_id: str, idempotency_key: str) -> str:
+    """
+    An idempotency key as it's kept in Redis, keys are only unique to a user.
+    JSON so a user_id with a colon in it can't match another user's key.
+    """
+    return json.dumps([user_id, idempotency_key], separators=(",", ":"))
+
+
+class IdempotencyCache:
+    """
+    The transaction written for each user's idempotency key, so a retry is
+    answered from Redis without looking in Mongo or running the rules again.
+    Mongo's unique index on the user and key is what keeps duplicates out,
+    this only saves the lookup. Keys are (user_id, idempotency_key) pairs.
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: int = 86_400,
+        redis: Optional[Redis] = None,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self._redis = redis
+
+    @property
+    def redis(self) -> Redis:
+        return connections.redis if self._redis is None else self._redis
+
+    @staticmethod
+    def _key(user_id: str, idempotency_key: str) -> str:
+        return f"transactions:idempotency:{scoped_key(user_id, idempotency_key)}"
+
+    async def get_many(
+        self, keys: List[Tuple[str, str]]
+    ) -> Dict[Tuple[str, str], TransactionModel]:
+        if not keys:
+            return {}
+        values = await self.redis.mget(*[self._key(*key) for key in keys])
+        return {
+            key: self._load(key[1], value)
+            for key, value in zip(keys, values)
+            if value is not None
+        }
+
+    async def set_many(self, transactions: Iterable[TransactionModel]):
+        await asyncio.gather(
+            *[
+                self.redis.set(
+                    self._key(t.user_id, t.idempotency_key),
+                    t.to_json_bytes(),
+                    ex=self.ttl_seconds,
+                )
+                for t in transactions
+                if t.idempotency_key is not None
+            ]
+        )
+
+    @staticmethod
+    def _load(idempotency_key: str, value: bytes) -> TransactionModel:
+        # Stored in the response format, which has id rather than _id and
+        # leaves the key out
+        fields = json.loads(value)
+        fields["_id"] = fields.pop("id")
+        return TransactionModel(**fields, idempotency_key=idempotency_key)
+
+
+def idempotency_cache_for(redis: Optional[Redis] = None) -> IdempotencyCache:
+    return IdempotencyCache(ttl_seconds=settings.IDEMPOTENCY_TTL_SECONDS, redis=redis)
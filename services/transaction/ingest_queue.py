@@ -0,0 +1,341 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+
+import config
+from connections import connections
+from metrics import ingest_enqueued, ingest_processed, ingest_queue_seconds
+from models.db.transaction_model import TransactionModel
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from services.transaction.idempotency_cache import scoped_key
+from services.transaction.new_transaction_batch import NewTransactionBatch
+
+logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+
+class IngestQueueFull(Exception):
+    pass
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class IngestQueue:
+    """
+    Transactions accepted by POST /transactions?mode=async, waiting on a
+    Redis Stream for the ingest workers to evaluate and write them.
+
+    Each transaction has an idempotency key, the client's or one made up for
+    it, and a status hash under the user and that key. Queueing is one script so a key is
+    only ever queued once and nothing is queued while the backlog is at
+    `max_length`. Entries are deleted once written, so the stream's length is
+    the backlog. Entries read by a worker that died are claimed by another
+    after `claim_idle_ms`, they're delivered at least once and the workers
+    skip keys that were already written.
+    """
+
+    ENQUEUE = """
+    local status = redis.call("hget", KEYS[2], "status")
+    if status then
+        return {status, 1}
+    end
+    if redis.call("xlen", KEYS[1]) >= tonumber(ARGV[1]) then
+        return {"full", 0}
+    end
+    local id = redis.call("xadd", KEYS[1], "*", "payload", ARGV[2])
+    redis.call("hset", KEYS[2], "status", "queued", "stream_id", id)
+    redis.call("expire", KEYS[2], ARGV[3])
+    return {"queued", 0}
+    """
+
+    def __init__(
+        self,
+        stream: str = "transactions:ingest",
+        group: str = "ingest_workers",
+        max_length: int = 100_000,
+        status_ttl_seconds: int = 86_400,
+        redis: Optional[Redis] = None,
+    ):
+        self.stream = stream
+        self.group = group
+        self.max_length = max_length
+        self.status_ttl_seconds = status_ttl_seconds
+        self._redis = redis
+
+    @property
+    def redis(self) -> Redis:
+        return connections.redis if self._redis is None else self._redis
+
+    def _status_key(self, user_id: str, idempotency_key: str) -> str:
+        return f"{self.stream}:status:{scoped_key(user_id, idempotency_key)}"
+
+    async def enqueue(self, transaction: NewTransactionPayload) -> dict:
+        """
+        Queues a transaction unless its key already was, returning its status.
+        Raises IngestQueueFull rather than queueing past `max_length`.
+        """
+        if transaction.idempotency_key is None:
+            transaction = transaction.model_copy(
+                update={"idempotency_key": uuid.uuid4().hex}
+            )
+        user_id, key = transaction.user_id, transaction.idempotency_key
+        status, duplicate = await self.redis.eval(
+            self.ENQUEUE,
+            2,
+            self.stream,
+            self._status_key(user_id, key),
+            self.max_length,
+            transaction.model_dump_json(),
+            self.status_ttl_seconds,
+        )
+        status = _text(status)
+        if status == "full":
+            ingest_enqueued.inc(result="rejected")
+            raise IngestQueueFull(f"{self.max_length} transactions already queued")
+        ingest_enqueued.inc(result="duplicate" if duplicate else "queued")
+        if duplicate:
+            return await self.status(user_id, key)
+        return self._status(user_id, key, status)
+
+    async def status(self, user_id: str, idempotency_key: str) -> Optional[dict]:
+        fields = await self.redis.hgetall(self._status_key(user_id, idempotency_key))
+        if not fields:
+            return None
+        fields = {_text(name): _text(value) for name, value in fields.items()}
+        return self._status(
+            user_id, idempotency_key, fields["status"], fields.get("transaction")
+        )
+
+    @staticmethod
+    def _status(
+        user_id: str,
+        idempotency_key: str,
+        status: str,
+        transaction: Optional[str] = None,
+    ) -> dict:
+        result = {
+            "user_id": user_id,
+            "idempotency_key": idempotency_key,
+            "status": status,
+        }
+        if transaction is not None:
+            result["transaction"] = json.loads(transaction)
+        return result
+
+    async def ensure_group(self):
+        try:
+            await self.redis.xgroup_create(
+                self.stream, self.group, id="0", mkstream=True
+            )
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def read(
+        self, consumer: str, count: int, block_ms: int, claim_idle_ms: int
+    ) -> List[Tuple[str, NewTransactionPayload]]:
+        """
+        Up to `count` entries for `consumer`, ones abandoned by other
+        consumers first. Waits up to `block_ms` for new ones.
+        """
+        entries = await self._claim(consumer, count, claim_idle_ms)
+        if not entries:
+            streams = await self.redis.xreadgroup(
+                self.group,
+                consumer,
+                {self.stream: ">"},
+                count=count,
+                block=block_ms,
+            )
+            entries = streams[0][1] if streams else []
+
+        # Claimed entries that were deleted come back empty, there's nothing
+        # left to do for them
+        gone = [id for id, fields in entries if not fields]
+        if gone:
+            await self.redis.xack(self.stream, self.group, *gone)
+        return [
+            (
+                _text(id),
+                NewTransactionPayload.model_validate_json(
+                    fields.get(b"payload", fields.get("payload"))
+                ),
+            )
+            for id, fields in entries
+            if fields
+        ]
+
+    async def _claim(self, consumer: str, count: int, claim_idle_ms: int):
+        # XAUTOCLAIM needs Redis 6.2, this works back to 5
+        pending = await self.redis.xpending_range(
+            self.stream, self.group, min="-", max="+", count=count
+        )
+        stale = [
+            entry["message_id"]
+            for entry in pending
+            if entry["time_since_delivered"] >= claim_idle_ms
+        ]
+        if not stale:
+            return []
+        return await self.redis.xclaim(
+            self.stream, self.group, consumer, claim_idle_ms, stale
+        )
+
+    async def complete(self, ids: List[str], transactions: List[TransactionModel]):
+        """
+        Records the written transactions against their users' keys and
+        removes their entries from the stream.
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for transaction in transactions:
+                key = self._status_key(transaction.user_id, transaction.idempotency_key)
+                pipe.hset(
+                    key,
+                    mapping={
+                        "status": "done",
+                        "transaction": transaction.to_json_bytes(),
+                    },
+                )
+                pipe.expire(key, self.status_ttl_seconds)
+            if ids:
+                pipe.xack(self.stream, self.group, *ids)
+                pipe.xdel(self.stream, *ids)
+            await pipe.execute()
+
+    async def lag(self) -> Dict[str, float]:
+        """
+        The backlog, how much of it is being worked on and how long the oldest
+        entry has waited.
+        """
+        length = await self.redis.xlen(self.stream)
+        try:
+            pending = (await self.redis.xpending(self.stream, self.group))["pending"]
+        except ResponseError:
+            # No workers have started yet
+            pending = 0
+        oldest = await self.redis.xrange(self.stream, count=1)
+        return {
+            "length": length,
+            "pending": pending,
+            "oldest_seconds": _age_seconds(_text(oldest[0][0])) if oldest else 0,
+        }
+
+
+def _age_seconds(stream_id: str) -> float:
+    # Stream ids start with the milliseconds they were added at
+    return max(time.time() - int(stream_id.split("-")[0]) / 1000, 0)
+
+
+class IngestWorker:
+    """
+    Takes batches off the queue, evaluates and writes them together like
+    POST /transactions/batch and marks them done. Keys already written, from
+    an earlier delivery or a resend, are marked done with the stored
+    transaction rather than written again.
+    """
+
+    def __init__(
+        self,
+        queue: "IngestQueue",
+        consumer: str,
+        database: Optional[AsyncIOMotorDatabase] = None,
+        redis: Optional[Redis] = None,
+        batch_size: int = 500,
+        block_ms: int = 1000,
+        claim_idle_ms: int = 30_000,
+    ):
+        self.queue = queue
+        self.consumer = consumer
+        self.db = connections.db if database is None else database
+        self.redis = connections.redis if redis is None else redis
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self._stopping = False
+
+    async def run_once(self) -> int:
+        entries = await self.queue.read(
+            self.consumer, self.batch_size, self.block_ms, self.claim_idle_ms
+        )
+        if entries:
+            await self.process(entries)
+        return len(entries)
+
+    async def process(self, entries: List[Tuple[str, NewTransactionPayload]]):
+        # Keys already written, or sent twice, get the stored transaction
+        # back rather than being written again
+        batch = NewTransactionBatch(
+            transactions=[transaction for _, transaction in entries],
+            database=self.db,
+            redis=self.redis,
+        )
+        transactions = await batch.create()
+        ingest_processed.inc(len(batch.inserted))
+
+        await self.queue.complete([id for id, _ in entries], transactions)
+        for id, _ in entries:
+            ingest_queue_seconds.observe(_age_seconds(id))
+
+    async def run(self):
+        await self.queue.ensure_group()
+        while not self._stopping:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # The entries stay pending and are claimed again later
+                logger.exception("Ingest worker %s failed a batch", self.consumer)
+                await asyncio.sleep(1)
+
+    def stop(self):
+        self._stopping = True
+
+
+class IngestWorkers:
+    """
+    Ingest workers run as tasks of the app, see commands.ingest_worker to run
+    them in their own processes instead.
+    """
+
+    def __init__(self, queue: IngestQueue, settings: config.Settings):
+        self.queue = queue
+        self.settings = settings
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self, database: AsyncIOMotorDatabase, count: int, consumer: str):
+        for i in range(count):
+            worker = IngestWorker(
+                queue=self.queue,
+                consumer=f"{consumer}-{i}",
+                database=database,
+                batch_size=self.settings.INGEST_BATCH_SIZE,
+                block_ms=self.settings.INGEST_BLOCK_MS,
+                claim_idle_ms=self.settings.INGEST_CLAIM_IDLE_MS,
+            )
+            self._tasks.append(asyncio.create_task(worker.run()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+ingest_queue = IngestQueue(
+    stream=settings.INGEST_STREAM,
+    group=settings.INGEST_GROUP,
+    max_length=settings.INGEST_MAX_QUEUED,
+    status_ttl_seconds=settings.INGEST_STATUS_TTL_SECONDS,
+)
+ingest_workers = IngestWorkers(ingest_queue, settings)
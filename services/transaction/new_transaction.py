@@ -1,12 +1,26 @@
-from typing import Optional
+from typing import Optional, Tuple
 
+from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import DuplicateKeyError
+from redis.asyncio import Redis
 
-from db import db
+import config
+from connections import connections
+from metrics import stage_seconds
 from models.db.transaction_model import TransactionModel
 from models.payloads.new_transaction_payload import NewTransactionPayload
-from repositories.transaction_repository import TransactionRepository
-from services.rules.process_rules import ProcessRules
+from repositories.partitioned_transaction_repository import transaction_repository_for
+from repositories.risk_summary_repository import RiskSummaryRepository
+from services.rules.process_rules import ProcessRules, get_window_counters
+from services.transaction.idempotency_cache import idempotency_cache_for
+from services.transaction.suspicious_feed import SuspiciousFeed, suspicious_feed
+from services.transaction.suspicious_transactions_cache import (
+    suspicious_transactions_cache,
+)
+from services.transaction.user_locks import NoUserLocks, user_locks
+
+settings = config.get_settings()
 
 
 class NewTransaction:
@@ -14,20 +28,83 @@ class NewTransaction:
         self,
         transaction: NewTransactionPayload,
         database: Optional[AsyncIOMotorDatabase] = None,
+        redis: Optional[Redis] = None,
+        locks: Optional[NoUserLocks] = None,
+        feed: Optional[SuspiciousFeed] = None,
     ):
         self.transaction = transaction
-        self.db = database or db
-        self.transaction_repo = TransactionRepository(db=self.db)
+        self.db = connections.db if database is None else database
+        self.redis = connections.redis if redis is None else redis
+        self.locks = user_locks if locks is None else locks
+        self.feed = suspicious_feed if feed is None else feed
+        self.transaction_repo = transaction_repository_for(self.db)
+        self.risk_summary_repo = RiskSummaryRepository(db=self.db)
+        self.idempotency = idempotency_cache_for(self.redis)
 
     async def __call__(self) -> dict:
-        suspicious_reasons = await ProcessRules(
-            transaction=self.transaction, database=self.db
-        )()
-        transaction = await self.transaction_repo.insert_transaction(
-            {
-                **self.transaction.model_dump(),
-                "is_suspicious": len(suspicious_reasons) != 0,
-                "suspicious_reasons": suspicious_reasons,
-            }
-        )
+        transaction = await self.create()
         return transaction.to_dict_json()
+
+    async def create(self) -> TransactionModel:
+        key = self.transaction.idempotency_key
+        if key is not None:
+            # Keys are only unique to a user
+            key = (self.transaction.user_id, key)
+            # A retry, answered without the lock or the rules
+            stored = (await self.idempotency.get_many([key])).get(key)
+            if stored is not None:
+                return stored
+
+        # Counting the user's windows and writing this transaction happen
+        # under the user's lock, so concurrent transactions from the same user
+        # each see the ones before them
+        async with self.locks.hold([self.transaction.user_id]):
+            if key is not None:
+                stored = await self._stored(key)
+                if stored is not None:
+                    return stored
+            id = ObjectId()
+            process_rules = ProcessRules(
+                transaction=self.transaction,
+                database=self.db,
+                redis=self.redis,
+                id=id,
+            )
+            with stage_seconds.time(stage="rules"):
+                suspicious_reasons = await process_rules()
+            with stage_seconds.time(stage="mongo_insert"):
+                try:
+                    transaction = await self.transaction_repo.insert_transaction(
+                        {
+                            "_id": id,
+                            **self.transaction.model_dump(exclude_none=True),
+                            "is_suspicious": len(suspicious_reasons) != 0,
+                            "suspicious_reasons": suspicious_reasons,
+                        }
+                    )
+                except DuplicateKeyError:
+                    await process_rules.forget()
+                    if key is None:
+                        raise
+                    # The same key was written by a request the lock didn't
+                    # cover, with the locks off
+                    return await self._stored(key)
+                except Exception:
+                    await process_rules.forget()
+                    raise
+            get_window_counters(self.db, process_rules.plan).record(transaction)
+        if transaction.is_suspicious:
+            await suspicious_transactions_cache.invalidate(transaction.user_id)
+            if settings.RISK_SUMMARY_ENABLED:
+                await self.risk_summary_repo.increment([transaction])
+            await self.feed.publish([transaction])
+        if key is not None:
+            await self.idempotency.set_many([transaction])
+        return transaction
+
+    async def _stored(self, key: Tuple[str, str]) -> Optional[TransactionModel]:
+        stored = await self.transaction_repo.get_transactions_by_idempotency_keys([key])
+        if stored:
+            await self.idempotency.set_many(stored)
+            return stored[0]
+        return None
@@ -0,0 +1,186 @@
+import asyncio
+from typing import Optional, Iterable, List, Dict, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from redis.asyncio import Redis
+
+import config
+from connections import connections
+from models.db.transaction_model import TransactionModel
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from repositories.risk_summary_repository import RiskSummaryRepository
+from repositories.partitioned_transaction_repository import transaction_repository_for
+from services.rules.process_rules import get_window_counters
+from services.rules.process_rules_batch import ProcessRulesBatch
+from services.rules.redis_windows import redis_windows_for
+from services.rules.rule_engine import rule_engine
+from services.transaction.idempotency_cache import idempotency_cache_for
+from services.transaction.suspicious_feed import SuspiciousFeed, suspicious_feed
+from services.transaction.suspicious_transactions_cache import (
+    SuspiciousTransactionsCache,
+    suspicious_transactions_cache,
+)
+from services.transaction.user_locks import NoUserLocks, user_locks
+
+settings = config.get_settings()
+
+
+class NewTransactionBatch:
+    def __init__(
+        self,
+        transactions: List[NewTransactionPayload],
+        database: Optional[AsyncIOMotorDatabase] = None,
+        redis: Optional[Redis] = None,
+        cache: Optional[SuspiciousTransactionsCache] = None,
+        locks: Optional[NoUserLocks] = None,
+        feed: Optional[SuspiciousFeed] = None,
+        window_store: Optional[str] = None,
+    ):
+        self.transactions = transactions
+        self.db = connections.db if database is None else database
+        self.redis = connections.redis if redis is None else redis
+        self.cache = suspicious_transactions_cache if cache is None else cache
+        self.locks = user_locks if locks is None else locks
+        self.feed = suspicious_feed if feed is None else feed
+        self.transaction_repo = transaction_repository_for(self.db)
+        self.risk_summary_repo = RiskSummaryRepository(db=self.db)
+        # RULE_WINDOW_STORE unless given, replays keep their transactions out
+        # of the windows in Redis
+        window_store = (
+            settings.RULE_WINDOW_STORE if window_store is None else window_store
+        )
+        self.redis_windows_enabled = (
+            settings.RULE_WINDOW_COUNTERS_ENABLED and window_store == "redis"
+        )
+        self.idempotency = idempotency_cache_for(self.redis)
+        # The transactions create() wrote, rather than found already stored
+        self.inserted: List[TransactionModel] = []
+
+    async def __call__(self) -> List[dict]:
+        transactions = await self.create()
+        return [t.to_dict_json() for t in transactions]
+
+    async def create(self) -> List[TransactionModel]:
+        keys = [
+            self._key(position)
+            for position, t in enumerate(self.transactions)
+            if t.idempotency_key
+        ]
+        # Retries answered from Redis don't need the rules or the locks
+        stored = await self.idempotency.get_many(keys)
+        new = self._new_positions(range(len(self.transactions)), stored)
+
+        # Group positions by user so each user's history is fetched once, the
+        # users themselves are independent so their rules can run together
+        by_user = self._by_user(new)
+
+        # Every user in the batch is held until the batch is written, so
+        # single transactions for them wait rather than miss the batch
+        inserted = self.inserted = []
+        async with self.locks.hold(by_user):
+            unstored = [k for k in keys if k not in stored]
+            if unstored:
+                stored.update(await self._stored(unstored))
+                new = self._new_positions(new, stored)
+                by_user = self._by_user(new)
+
+            # The whole batch is evaluated against the same rules
+            plan = rule_engine.plan
+            user_reasons = await asyncio.gather(
+                *[
+                    ProcessRulesBatch(
+                        user_id=user_id,
+                        transactions=[self.transactions[p] for p in positions],
+                        database=self.db,
+                        redis=self.redis,
+                        plan=plan,
+                    )()
+                    for user_id, positions in by_user.items()
+                ]
+            )
+
+            suspicious_reasons: Dict[int, list] = {}
+            for positions, reasons in zip(by_user.values(), user_reasons):
+                for position, reason in zip(positions, reasons):
+                    suspicious_reasons[position] = reason
+
+            written = await self.transaction_repo.insert_new_transactions(
+                [
+                    {
+                        **self.transactions[p].model_dump(exclude_none=True),
+                        "is_suspicious": len(suspicious_reasons[p]) != 0,
+                        "suspicious_reasons": suspicious_reasons[p],
+                    }
+                    for p in new
+                ]
+            )
+            results: Dict[int, TransactionModel] = {}
+            lost = []
+            for position, transaction in zip(new, written):
+                if transaction is None:
+                    # Written by a request the locks didn't cover
+                    lost.append(self._key(position))
+                else:
+                    results[position] = transaction
+                    inserted.append(transaction)
+            if lost:
+                stored.update(await self._stored(lost))
+
+            window_counters = get_window_counters(self.db, plan)
+            for transaction in inserted:
+                window_counters.record(transaction)
+            if self.redis_windows_enabled:
+                await redis_windows_for(plan.windows, self.redis).record(inserted)
+        for user_id in {t.user_id for t in inserted if t.is_suspicious}:
+            await self.cache.invalidate(user_id)
+        if settings.RISK_SUMMARY_ENABLED:
+            await self.risk_summary_repo.increment(inserted)
+        await self.feed.publish(inserted)
+        await self.idempotency.set_many(inserted)
+
+        # Resent keys get the transaction stored for them, including keys sent
+        # more than once in this batch
+        stored.update(
+            {(t.user_id, t.idempotency_key): t for t in inserted if t.idempotency_key}
+        )
+        return [
+            results[position] if position in results else stored[self._key(position)]
+            for position in range(len(self.transactions))
+        ]
+
+    def _key(self, position: int) -> Optional[Tuple[str, str]]:
+        # Keys are only unique to a user
+        transaction = self.transactions[position]
+        if transaction.idempotency_key is None:
+            return None
+        return transaction.user_id, transaction.idempotency_key
+
+    def _new_positions(
+        self,
+        positions: Iterable[int],
+        stored: Dict[Tuple[str, str], TransactionModel],
+    ) -> List[int]:
+        # The first of each key that isn't stored yet, and everything without
+        # a key
+        new, seen = [], set()
+        for position in positions:
+            key = self._key(position)
+            if key is None:
+                new.append(position)
+            elif key not in stored and key not in seen:
+                seen.add(key)
+                new.append(position)
+        return new
+
+    def _by_user(self, positions: List[int]) -> Dict[str, List[int]]:
+        by_user: Dict[str, List[int]] = {}
+        for position in positions:
+            by_user.setdefault(self.transactions[position].user_id, []).append(position)
+        return by_user
+
+    async def _stored(
+        self, keys: List[Tuple[str, str]]
+    ) -> Dict[Tuple[str, str], TransactionModel]:
+        stored = await self.transaction_repo.get_transactions_by_idempotency_keys(keys)
+        await self.idempotency.set_many(stored)
+        return {(t.user_id, t.idempotency_key): t for t in stored}
@@ -0,0 +1,99 @@
+import time
+from typing import Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from connections import connections
+from repositories.partitioned_transaction_repository import (
+    PartitionedTransactionRepository,
+)
+from repositories.partitions import partitions_for
+
+
+class IncompleteMove(Exception):
+    pass
+
+
+class RebalancePartitions:
+    """
+    Moves each user's transactions to the partition the ring gives them now,
+    after partitions have been added. Run it while the app keeps going with
+    MONGO_PARTITIONS_PREVIOUS set to the partitions from before: new
+    transactions are written to the new partition and a user's reads go to
+    both until they've been moved.
+
+    A user is copied a batch at a time and only deleted from the old
+    partition once all of it is across, so it can be stopped and run again.
+    A transaction the new partition wouldn't take (its user already has one
+    there with the same idempotency key) raises IncompleteMove and leaves
+    the user in both.
+    """
+
+    def __init__(
+        self,
+        database: Optional[AsyncIOMotorDatabase] = None,
+        batch_size: int = 1000,
+        dry_run: bool = False,
+    ):
+        self.db = connections.db if database is None else database
+        partitions = partitions_for(self.db)
+        if partitions is None:
+            raise ValueError("The database's transactions aren't partitioned")
+        self.partitions = partitions
+        self.transaction_repo = PartitionedTransactionRepository(partitions)
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+
+    async def __call__(self) -> dict:
+        started = time.perf_counter()
+        users = 0
+        moved: Dict[str, int] = {}
+        for name, repository in self.transaction_repo.repositories.items():
+            # Listed before any are moved, so deleting doesn't disturb the cursor
+            user_ids = [
+                user_id
+                async for user_id in repository.iter_user_ids()
+                if self.partitions.owner(user_id) != name
+            ]
+            for user_id in user_ids:
+                owner = self.partitions.owner(user_id)
+                count = await self._move(user_id, name, owner)
+                users += 1
+                moved[f"{name}->{owner}"] = moved.get(f"{name}->{owner}", 0) + count
+
+        return {
+            "users": users,
+            "transactions": moved,
+            "seconds": time.perf_counter() - started,
+        }
+
+    async def _move(self, user_id: str, source: str, target: str) -> int:
+        source_repo = self.transaction_repo.repositories[source]
+        target_repo = self.transaction_repo.repositories[target]
+        count = 0
+        batch: List[dict] = []
+        # Only this user, a range from their id up to the next possible one
+        async for t in source_repo.iter_user_histories(
+            from_user=user_id, to_user=user_id + "\0", batch_size=self.batch_size
+        ):
+            batch.append(t)
+            if len(batch) >= self.batch_size:
+                count += await self._copy(target_repo, batch)
+                batch = []
+        count += await self._copy(target_repo, batch)
+        if not self.dry_run:
+            await source_repo.delete_user_transactions(user_id)
+        return count
+
+    async def _copy(self, target_repo, batch: List[dict]) -> int:
+        if not self.dry_run:
+            await target_repo.copy_transactions(batch)
+            # Duplicate keys are skipped by the copy, so make sure every one of
+            # them is across before the source can be deleted
+            copied = await target_repo.count_transactions([t["_id"] for t in batch])
+            if copied != len(batch):
+                raise IncompleteMove(
+                    f"{len(batch) - copied} of {batch[0]['user_id']}'s "
+                    "transactions weren't copied"
+                )
+        return len(batch)
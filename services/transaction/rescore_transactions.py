@@ -0,0 +1,335 @@
+import asyncio
+import concurrent.futures
+import datetime
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+import config
+from connections import connections
+from models.db.rule_model import RuleSetModel
+from models.db.transaction_model import (
+    SCANNER_REASONS,
+    SuspiciousReasonsType,
+    TransactionType,
+)
+from repositories.partitioned_transaction_repository import transaction_repository_for
+from services.rules.rule_plan import FlagRange, RulePlan
+from services.transaction.risk_summary import RebuildRiskSummaries
+from services.transaction.suspicious_transactions_cache import (
+    SuspiciousTransactionsCache,
+    suspicious_transactions_cache,
+)
+
+settings = config.get_settings()
+
+
+class UserHistoryScorer:
+    """
+    Evaluates the rules over one user's transactions at a time, oldest first,
+    with the same verdicts as ingesting them one at a time. Each window is a
+    deque of the matching timestamps that slides forward as the transactions
+    do, so every transaction costs the same whatever the history.
+    """
+
+    def __init__(self, plan: RulePlan):
+        self.plan = plan
+        self.start_user()
+
+    def start_user(self):
+        self._windows: Dict[str, Deque[datetime.datetime]] = {
+            window.name: deque() for window in self.plan.windows
+        }
+        self._flags: Dict[str, FlagRange] = {}
+
+    def __call__(
+        self,
+        amount: float,
+        type: TransactionType,
+        currency: str,
+        at: datetime.datetime,
+    ) -> List[SuspiciousReasonsType]:
+        plan = self.plan
+        for window in plan.windows:
+            timestamps = self._windows[window.name]
+            since = window.since(at)
+            while timestamps and timestamps[0] < since:
+                timestamps.popleft()
+
+        flagged = plan.flagged_at(self._flags, at)
+        times = {
+            window.name: list(
+                itertools.islice(reversed(self._windows[window.name]), window.threshold)
+            )
+            for window in plan.windows_needed(amount, type, currency, flagged)
+        }
+        reasons, fired = plan.evaluate(amount, type, currency, flagged, times)
+        for rule in fired:
+            self._flags[rule.name] = plan.flag_range(rule, at, times)
+
+        for window in plan.windows:
+            if window.matches(amount, type, currency):
+                self._windows[window.name].append(at)
+        return reasons
+
+
+class RescoreTransactions:
+    """
+    Evaluates the stored transactions of a range of users against `plan` in
+    a single pass and writes back the verdicts that changed.
+
+    Flags are worked out from the history rather than read from Redis, so
+    the live flags are left alone. Transactions with the same timestamp are
+    taken in the order the index holds them, which isn't always the order
+    they arrived in. The users whose verdicts changed have their cached
+    responses invalidated and their risk summaries rebuilt. The reasons the
+    pattern scanner added are kept.
+    """
+
+    PROJECTION = {
+        "user_id": 1,
+        "amount": 1,
+        "type": 1,
+        "currency": 1,
+        "timestamp": 1,
+        "is_suspicious": 1,
+        "suspicious_reasons": 1,
+    }
+
+    def __init__(
+        self,
+        plan: RulePlan,
+        database: Optional[AsyncIOMotorDatabase] = None,
+        from_user: Optional[str] = None,
+        to_user: Optional[str] = None,
+        batch_size: int = 1000,
+        cache: Optional[SuspiciousTransactionsCache] = None,
+    ):
+        self.plan = plan
+        self.db = connections.db if database is None else database
+        self.from_user = from_user
+        self.to_user = to_user
+        self.batch_size = batch_size
+        self.cache = cache or suspicious_transactions_cache
+        self.transaction_repo = transaction_repository_for(self.db)
+
+    async def __call__(self) -> Dict[str, int]:
+        scorer = UserHistoryScorer(self.plan)
+        user_id = None
+        scanned = 0
+        updated = 0
+        changes: List[Tuple[object, List[SuspiciousReasonsType]]] = []
+        changed_users: Set[str] = set()
+        async for t in self.transaction_repo.iter_user_histories(
+            from_user=self.from_user,
+            to_user=self.to_user,
+            projection=self.PROJECTION,
+            batch_size=self.batch_size,
+        ):
+            if t["user_id"] != user_id:
+                user_id = t["user_id"]
+                scorer.start_user()
+            reasons = scorer(t["amount"], t["type"], t.get("currency"), t["timestamp"])
+            scanned += 1
+            # The pattern scanner's reasons are kept after the rules' ones
+            stored = t.get("suspicious_reasons") or []
+            kept = [r for r in stored if r in SCANNER_REASONS]
+            if [r.value for r in reasons] + kept != t.get("suspicious_reasons") or bool(
+                reasons or kept
+            ) != t.get("is_suspicious"):
+                changes.append(
+                    (t["_id"], reasons + [SuspiciousReasonsType(r) for r in kept])
+                )
+                changed_users.add(user_id)
+            if len(changes) >= self.batch_size:
+                updated += await self._write(changes, changed_users)
+                changes = []
+                changed_users = set()
+        updated += await self._write(changes, changed_users)
+        return {"scanned": scanned, "updated": updated}
+
+    async def _write(self, changes, user_ids: Set[str]) -> int:
+        # A user can run over more than one batch, they're brought up to date
+        # after each so an interrupted range leaves nothing stale behind
+        updated = await self.transaction_repo.update_verdicts(changes)
+        if user_ids and settings.RISK_SUMMARY_ENABLED:
+            await RebuildRiskSummaries(
+                database=self.db,
+                user_ids=sorted(user_ids),
+                batch_size=self.batch_size,
+            )()
+        for user_id in user_ids:
+            await self.cache.invalidate(user_id)
+        return updated
+
+
+def rescore_users(
+    rule_set: str,
+    database: str,
+    from_user: Optional[str],
+    to_user: Optional[str],
+    batch_size: int,
+) -> Dict[str, int]:
+    """
+    RescoreTransactions in a worker process, with its own clients.
+    """
+
+    async def run():
+        try:
+            return await RescoreTransactions(
+                plan=RulePlan(RuleSetModel.model_validate_json(rule_set)),
+                database=connections.database(database),
+                from_user=from_user,
+                to_user=to_user,
+                batch_size=batch_size,
+            )()
+        finally:
+            await connections.close()
+
+    return asyncio.run(run())
+
+
+class RescoreJob:
+    """
+    Rescores every stored transaction, users split into ranges of
+    `users_per_range` that run across `workers` processes (in this one when
+    `workers` is 0).
+
+    Finished ranges are recorded in the `checkpoint` file, running the job
+    again with the same rules carries on from there. Workers connect to
+    `database` by name on the configured MongoDB.
+    """
+
+    def __init__(
+        self,
+        rule_set: RuleSetModel,
+        database: Optional[AsyncIOMotorDatabase] = None,
+        checkpoint: Optional[str] = None,
+        workers: int = 0,
+        users_per_range: int = 1000,
+        batch_size: int = 1000,
+    ):
+        self.rule_set = rule_set
+        self.db = connections.db if database is None else database
+        self.checkpoint = checkpoint
+        self.workers = workers
+        self.users_per_range = users_per_range
+        self.batch_size = batch_size
+        self.transaction_repo = transaction_repository_for(self.db)
+
+    async def __call__(self) -> Dict[str, float]:
+        rules = self.rule_set.model_dump_json(exclude={"version"})
+        digest = hashlib.sha1(rules.encode()).hexdigest()
+        state = self._load_checkpoint()
+        if state is not None and state["rules"] != digest:
+            raise ValueError(
+                f"{self.checkpoint} was made with different rules, remove it to "
+                "start again"
+            )
+        if state is None:
+            state = {
+                "rules": digest,
+                "boundaries": await self._boundaries(),
+                "done": [],
+                "scanned": 0,
+                "updated": 0,
+            }
+            self._save_checkpoint(state)
+
+        # Ranges run from one boundary to the next, open at both ends so
+        # users that turn up while the job runs are included
+        edges = [None, *state["boundaries"], None]
+        ranges = [
+            (i, edges[i], edges[i + 1])
+            for i in range(len(edges) - 1)
+            if i not in state["done"]
+        ]
+
+        started = time.perf_counter()
+        scanned = 0
+        async for i, result in self._run(rules, ranges):
+            scanned += result["scanned"]
+            state["scanned"] += result["scanned"]
+            state["updated"] += result["updated"]
+            state["done"].append(i)
+            self._save_checkpoint(state)
+        seconds = time.perf_counter() - started
+
+        return {
+            "ranges": len(edges) - 1,
+            "scanned": state["scanned"],
+            "updated": state["updated"],
+            "seconds": round(seconds, 3),
+            "docs_per_second": round(scanned / seconds, 1) if seconds else 0,
+        }
+
+    async def _run(self, rules: str, ranges):
+        # Yields each range as it finishes so the checkpoint keeps up
+        if not self.workers:
+            plan = RulePlan(self.rule_set)
+            for i, from_user, to_user in ranges:
+                result = await RescoreTransactions(
+                    plan=plan,
+                    database=self.db,
+                    from_user=from_user,
+                    to_user=to_user,
+                    batch_size=self.batch_size,
+                )()
+                yield i, result
+            return
+
+        loop = asyncio.get_running_loop()
+        # Spawned so the workers don't inherit this process's clients
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as pool:
+            pending = {
+                loop.run_in_executor(
+                    pool,
+                    rescore_users,
+                    rules,
+                    self.db.name,
+                    from_user,
+                    to_user,
+                    self.batch_size,
+                ): i
+                for i, from_user, to_user in ranges
+            }
+            while pending:
+                finished, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in finished:
+                    yield pending.pop(future), future.result()
+
+    async def _boundaries(self) -> List[str]:
+        boundaries = []
+        position = 0
+        async for user_id in self.transaction_repo.iter_user_ids():
+            if position and position % self.users_per_range == 0:
+                boundaries.append(user_id)
+            position += 1
+        return boundaries
+
+    def _load_checkpoint(self) -> Optional[dict]:
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return None
+        with open(self.checkpoint) as f:
+            return json.load(f)
+
+    def _save_checkpoint(self, state: dict):
+        if self.checkpoint is None:
+            return
+        # Written aside and moved over so a crash never leaves half a file
+        temporary = f"{self.checkpoint}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(state, f)
+        os.replace(temporary, self.checkpoint)
@@ -0,0 +1,94 @@
+import datetime
+import time
+from typing import List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from connections import connections
+from models.db.risk_summary_model import RiskSummaryModel
+from repositories.partitioned_transaction_repository import transaction_repository_for
+from repositories.risk_summary_repository import (
+    RiskSummaryRepository,
+    currency_field,
+)
+
+
+class GetRiskSummary:
+    def __init__(self, user_id: str, database: Optional[AsyncIOMotorDatabase] = None):
+        self.user_id = user_id
+        self.db = connections.db if database is None else database
+        self.risk_summary_repo = RiskSummaryRepository(db=self.db)
+
+    async def __call__(self) -> RiskSummaryModel:
+        return await self.risk_summary_repo.get(self.user_id)
+
+
+class RebuildRiskSummaries:
+    """
+    Recomputes the users' summaries from their stored transactions, after
+    rescoring or if the increments were ever missed. Transactions written
+    while it runs can be counted twice or not at all for the users being
+    rebuilt, so it's best run while ingestion is quiet.
+    """
+
+    def __init__(
+        self,
+        database: Optional[AsyncIOMotorDatabase] = None,
+        user_ids: Optional[List[str]] = None,
+        batch_size: int = 1000,
+    ):
+        self.db = connections.db if database is None else database
+        self.user_ids = user_ids
+        self.batch_size = batch_size
+        self.transaction_repo = transaction_repository_for(self.db)
+        self.risk_summary_repo = RiskSummaryRepository(db=self.db)
+
+    async def __call__(self) -> dict:
+        started = time.perf_counter()
+        rebuilt_at = datetime.datetime.utcnow()
+        users = 0
+        batch: List[dict] = []
+        summary: Optional[dict] = None
+        async for rollup in self.transaction_repo.iter_risk_rollups(self.user_ids):
+            group = rollup["_id"]
+            if summary is None or summary["_id"] != group["user_id"]:
+                if summary is not None:
+                    batch.append(summary)
+                summary = self._empty(group["user_id"])
+                users += 1
+                if len(batch) >= self.batch_size:
+                    await self.risk_summary_repo.replace(batch, rebuilt_at)
+                    batch = []
+            self._add(summary, group, rollup["count"], rollup["volume"])
+        if summary is not None:
+            batch.append(summary)
+        await self.risk_summary_repo.replace(batch, rebuilt_at)
+        deleted = await self.risk_summary_repo.delete_not_updated_since(
+            rebuilt_at, self.user_ids
+        )
+
+        return {
+            "users": users,
+            "deleted": deleted,
+            "seconds": time.perf_counter() - started,
+        }
+
+    @staticmethod
+    def _empty(user_id: str) -> dict:
+        return RiskSummaryModel(user_id=user_id).model_dump(by_alias=True)
+
+    @staticmethod
+    def _add(summary: dict, group: dict, count: int, volume: float):
+        # The same fields the increments touch, see RiskSummaryRepository
+        currency = currency_field(group["currency"])
+        day = summary["days"].setdefault(
+            group["day"],
+            {"suspicious_transactions": 0, "flagged_volume": {}, "reasons": {}},
+        )
+        for totals in (summary, day):
+            totals["suspicious_transactions"] += count
+            totals["flagged_volume"][currency] = (
+                totals["flagged_volume"].get(currency, 0) + volume
+            )
+            for reason in group["reasons"]:
+                totals["reasons"][reason] = totals["reasons"].get(reason, 0) + count
@@ -0,0 +1,322 @@
+import asyncio
+import logging
+from collections import deque
+from typing import (
+    AsyncIterator,
+    Deque,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from redis.asyncio import Redis
+
+import config
+from connections import connections
+from metrics import suspicious_feed_events
+from models.db.transaction_model import TransactionModel
+
+logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def event_order(id: str) -> Tuple[int, int]:
+    """
+    Event ids in the order they were published. Stream ids are
+    "<milliseconds>-<sequence>", the process feed's are a count. Raises
+    ValueError for anything else.
+    """
+    first, _, second = id.partition("-")
+    return int(first), int(second or 0)
+
+
+class FeedEvent(NamedTuple):
+    # "transaction" events carry the transaction as JSON. "gap" is sent when
+    # a subscriber resumes from further back than the backlog goes, and
+    # "dropped" before a subscriber that fell behind is disconnected.
+    id: str
+    user_id: str
+    data: bytes
+    event: str = "transaction"
+
+    def to_server_sent_event(self) -> bytes:
+        lines = []
+        if self.id:
+            lines.append(b"id: " + self.id.encode())
+        lines.append(b"event: " + self.event.encode())
+        lines.append(b"data: " + self.data)
+        return b"\n".join(lines) + b"\n\n"
+
+
+class FeedSubscription:
+    """
+    A subscriber's buffered events, for every user or the ones given. It's
+    dropped once it's `buffer` events behind, the events already buffered
+    are still delivered.
+    """
+
+    def __init__(
+        self,
+        user_ids: Optional[Iterable[str]],
+        after: Optional[Tuple[int, int]],
+        buffer: int,
+    ):
+        self.user_ids: Optional[Set[str]] = None if user_ids is None else set(user_ids)
+        self.after = after
+        self.queue: asyncio.Queue = asyncio.Queue(buffer)
+        self.dropped = False
+
+    def wants(self, event: FeedEvent) -> bool:
+        return self.user_ids is None or event.user_id in self.user_ids
+
+    def offer(self, event: FeedEvent) -> bool:
+        # False once it's been dropped
+        if not self.wants(event):
+            return True
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped = True
+            return False
+        return True
+
+
+class SuspiciousFeed:
+    """
+    Pushes suspicious transactions to subscribers as they're written, so
+    dashboards don't have to poll GET /transactions/suspicious/{user_id}.
+
+    With "process" transactions go straight to this worker's subscribers and
+    the last `backlog` are kept in memory. With "redis" they're added to a
+    Redis Stream capped at `backlog` instead, and while a worker has
+    subscribers one task follows the stream for all of them, so they see
+    every worker's transactions for one blocking read per worker.
+
+    Event ids only go up, a subscriber can resume after the last one it got
+    while that's still in the backlog. From further back it's sent a "gap"
+    event first, and should read the users' suspicious transactions again.
+    """
+
+    def __init__(
+        self,
+        mode: str = "process",
+        stream: str = "transactions:suspicious",
+        backlog: int = 10_000,
+        buffer: int = 1000,
+        block_ms: int = 1000,
+        redis: Optional[Redis] = None,
+    ):
+        self.mode = mode
+        self.stream = stream
+        self.backlog = backlog
+        self.buffer = buffer
+        self.block_ms = block_ms
+        self._redis = redis
+        self._subscriptions: Set[FeedSubscription] = set()
+        # "process" only
+        self._events: Deque[FeedEvent] = deque(maxlen=backlog)
+        self._sequence = 0
+        # "redis" only
+        self._reader: Optional[asyncio.Task] = None
+        self._reader_started: Optional[asyncio.Future] = None
+
+    @property
+    def redis(self) -> Redis:
+        return connections.redis if self._redis is None else self._redis
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscriptions)
+
+    async def publish(self, transactions: Iterable[TransactionModel]):
+        """
+        Sends the suspicious ones to the subscribers. The transactions are
+        already written, so a failure is logged rather than raised.
+        """
+        if not self.enabled:
+            return
+        suspicious = [t for t in transactions if t.is_suspicious]
+        if not suspicious:
+            return
+        suspicious_feed_events.inc(len(suspicious), event="published")
+        if self.mode == "process":
+            for t in suspicious:
+                self._sequence += 1
+                event = FeedEvent(str(self._sequence), t.user_id, t.to_json_bytes())
+                self._events.append(event)
+                self._deliver(event)
+            return
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for t in suspicious:
+                    pipe.xadd(
+                        self.stream,
+                        {"user_id": t.user_id, "data": t.to_json_bytes()},
+                        maxlen=self.backlog,
+                        approximate=True,
+                    )
+                await pipe.execute()
+        except Exception:
+            logger.exception("Couldn't publish %s to the feed", len(suspicious))
+
+    def subscribe(
+        self,
+        user_ids: Optional[Iterable[str]] = None,
+        last_id: Optional[str] = None,
+    ) -> FeedSubscription:
+        """
+        A subscription for `events`, resuming after `last_id` when given.
+        Raises ValueError for an id the feed didn't hand out.
+        """
+        after = event_order(last_id) if last_id else None
+        return FeedSubscription(user_ids, after, self.buffer)
+
+    async def events(
+        self,
+        subscription: FeedSubscription,
+        heartbeat_seconds: Optional[float] = None,
+    ) -> AsyncIterator[Optional[FeedEvent]]:
+        """
+        The subscription's events until it's dropped, None whenever
+        `heartbeat_seconds` pass without one so the connection can be kept
+        open.
+        """
+        self._subscriptions.add(subscription)
+        try:
+            await self._start_reading()
+            last = subscription.after
+            if last is not None:
+                backlog, complete = await self._published_after(last)
+                if not complete:
+                    yield FeedEvent(id="", user_id="", data=b"{}", event="gap")
+                for event in backlog:
+                    if subscription.wants(event):
+                        yield event
+                    last = event_order(event.id)
+
+            while not (subscription.dropped and subscription.queue.empty()):
+                try:
+                    # Not wait_for, which can swallow the cancellation of a
+                    # subscriber that's gone if an event arrives with it
+                    async with asyncio.timeout(heartbeat_seconds):
+                        event = await subscription.queue.get()
+                except TimeoutError:
+                    yield None
+                    continue
+                # Events published while the backlog was read come twice
+                order = event_order(event.id)
+                if last is not None and order <= last:
+                    continue
+                last = order
+                yield event
+            yield FeedEvent(id="", user_id="", data=b"{}", event="dropped")
+        finally:
+            self._subscriptions.discard(subscription)
+            if not self._subscriptions:
+                await self._stop_reading()
+
+    def _deliver(self, event: FeedEvent):
+        for subscription in list(self._subscriptions):
+            if not subscription.offer(event):
+                self._subscriptions.discard(subscription)
+                suspicious_feed_events.inc(event="dropped")
+
+    async def _published_after(
+        self, after: Tuple[int, int]
+    ) -> Tuple[List[FeedEvent], bool]:
+        """
+        The events in the backlog after `after`, and whether it still has
+        every one of them.
+        """
+        if self.mode == "process":
+            events = [e for e in self._events if event_order(e.id) > after]
+            oldest = event_order(self._events[0].id) if self._events else None
+            complete = after[0] <= self._sequence and (
+                oldest is None or oldest[0] <= after[0] + 1
+            )
+            return events, complete
+
+        start = f"{after[0]}-{after[1]}"
+        entries = await self.redis.xrange(self.stream, min=start, max="+")
+        events = [self._event(id, fields) for id, fields in entries]
+        events = [e for e in events if event_order(e.id) > after]
+        oldest = await self.redis.xrange(self.stream, count=1)
+        newest = await self.redis.xrevrange(self.stream, count=1)
+        complete = bool(oldest) and (
+            event_order(_text(oldest[0][0]))
+            <= after
+            <= event_order(_text(newest[0][0]))
+        )
+        return events, complete
+
+    @staticmethod
+    def _event(id, fields: dict) -> FeedEvent:
+        return FeedEvent(
+            id=_text(id),
+            user_id=_text(fields.get(b"user_id", fields.get("user_id"))),
+            data=fields.get(b"data", fields.get("data")),
+        )
+
+    async def _start_reading(self):
+        if self.mode != "redis":
+            return
+        if self._reader is None:
+            self._reader_started = asyncio.get_running_loop().create_future()
+            self._reader = asyncio.create_task(self._read(self._reader_started))
+        # Once it knows where it's reading from, so nothing published between
+        # there and the subscriber reading the backlog is missed
+        await asyncio.shield(self._reader_started)
+
+    async def _read(self, started: asyncio.Future):
+        last = None
+        while True:
+            try:
+                if last is None:
+                    newest = await self.redis.xrevrange(self.stream, count=1)
+                    last = _text(newest[0][0]) if newest else "0-0"
+                    started.set_result(last)
+                streams = await self.redis.xread(
+                    {self.stream: last}, count=500, block=self.block_ms
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Suspicious feed reader failed")
+                await asyncio.sleep(1)
+                continue
+            for _, entries in streams or []:
+                for id, fields in entries:
+                    event = self._event(id, fields)
+                    last = event.id
+                    self._deliver(event)
+
+    async def _stop_reading(self):
+        reader, self._reader = self._reader, None
+        if reader is not None:
+            reader.cancel()
+            self._reader_started.cancel()
+            await asyncio.gather(reader, return_exceptions=True)
+
+    async def stop(self):
+        await self._stop_reading()
+
+
+suspicious_feed = SuspiciousFeed(
+    mode=settings.SUSPICIOUS_FEED,
+    stream=settings.SUSPICIOUS_FEED_STREAM,
+    backlog=settings.SUSPICIOUS_FEED_BACKLOG,
+    buffer=settings.SUSPICIOUS_FEED_BUFFER,
+    block_ms=settings.SUSPICIOUS_FEED_BLOCK_MS,
+)
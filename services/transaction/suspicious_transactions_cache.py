@@ -0,0 +1,113 @@
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import config
+from connections import connections
+
+settings = config.get_settings()
+
+
+class SuspiciousTransactionsCache:
+    """
+    Serialized suspicious transaction responses per user, held in process and
+    in Redis so polling the same users doesn't query Mongo every time.
+
+    Each user has a version in Redis that is bumped whenever a suspicious
+    transaction is written for them. Entries are stored against the version
+    they were read at, so an entry written around an insert is never served
+    and the in process copies of every worker go stale together.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10_000,
+        max_body_bytes: int = 1_000_000,
+        ttl_seconds: int = 300,
+        redis=None,
+    ):
+        self.max_entries = max_entries
+        self.max_body_bytes = max_body_bytes
+        self.ttl_seconds = ttl_seconds
+        self._redis = redis
+        # user_id -> (version, body)
+        self._local: "OrderedDict[str, Tuple[int, bytes]]" = OrderedDict()
+        self.hits_local = 0
+        self.hits_redis = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def redis(self):
+        # Looked up when used so it's the client of the running app
+        return connections.redis if self._redis is None else self._redis
+
+    async def get(self, user_id: str) -> Tuple[int, Optional[bytes]]:
+        """
+        The current version for the user and the cached body, or None. The
+        version is needed to set the body after a miss.
+        """
+        version = int(await self.redis.get(self._version_key(user_id)) or 0)
+
+        local = self._local.get(user_id)
+        if local is not None and local[0] == version:
+            self._local.move_to_end(user_id)
+            self.hits_local += 1
+            return version, local[1]
+
+        body = await self.redis.get(self._body_key(user_id, version))
+        if body is not None:
+            self.hits_redis += 1
+            self._set_local(user_id, version, body)
+            return version, body
+
+        self.misses += 1
+        return version, None
+
+    async def set(self, user_id: str, version: int, body: bytes):
+        if len(body) > self.max_body_bytes:
+            return
+        await self.redis.set(
+            self._body_key(user_id, version), body, ex=self.ttl_seconds
+        )
+        self._set_local(user_id, version, body)
+
+    async def invalidate(self, user_id: str):
+        await self.redis.incr(self._version_key(user_id))
+        self._local.pop(user_id, None)
+        self.invalidations += 1
+
+    def clear(self):
+        self._local.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits_local": self.hits_local,
+            "hits_redis": self.hits_redis,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "entries": len(self._local),
+        }
+
+    def _set_local(self, user_id: str, version: int, body: bytes):
+        self._local[user_id] = (version, body)
+        self._local.move_to_end(user_id)
+        while len(self._local) > self.max_entries:
+            self._local.popitem(last=False)
+            self.evictions += 1
+
+    @staticmethod
+    def _version_key(user_id: str) -> str:
+        return f"suspicious_transactions_version{user_id}"
+
+    @staticmethod
+    def _body_key(user_id: str, version: int) -> str:
+        return f"suspicious_transactions{user_id}:{version}"
+
+
+suspicious_transactions_cache = SuspiciousTransactionsCache(
+    max_entries=settings.SUSPICIOUS_CACHE_MAX_ENTRIES,
+    max_body_bytes=settings.SUSPICIOUS_CACHE_MAX_BODY_BYTES,
+    ttl_seconds=settings.SUSPICIOUS_CACHE_TTL_SECONDS,
+)
@@ -0,0 +1,173 @@
+import asyncio
+import contextlib
+import time
+import uuid
+from typing import AsyncIterator, Dict, Iterable, List
+
+import config
+from connections import connections
+from metrics import lock_wait_seconds
+
+settings = config.get_settings()
+
+
+class UserLockTimeout(TimeoutError):
+    pass
+
+
+class NoUserLocks:
+    """
+    Lets every write through at once. Concurrent transactions from the same
+    user don't see each other so the windowed rules can under count.
+    """
+
+    @contextlib.asynccontextmanager
+    async def hold(self, user_ids: Iterable[str]) -> AsyncIterator[None]:
+        yield
+
+
+class ProcessUserLocks(NoUserLocks):
+    """
+    One lock per user, so a user's transactions are evaluated and written one
+    at a time while other users' go ahead. Locks only exist while they're
+    held or waited on. Only covers the transactions of this process.
+    """
+
+    backend = "process"
+
+    def __init__(self, timeout_seconds: float = 5.0):
+        self.timeout_seconds = timeout_seconds
+        # user_id -> (lock, how many hold or wait on it)
+        self._locks: Dict[str, List] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, user_ids: Iterable[str]) -> AsyncIterator[None]:
+        """
+        Holds the locks of every user given. They're taken in order so two
+        batches sharing users can't each wait on the other.
+        """
+        held = []
+        started = time.perf_counter()
+        deadline = time.monotonic() + self.timeout_seconds
+        try:
+            for user_id in sorted(set(user_ids)):
+                await self._acquire(user_id, deadline)
+                held.append(user_id)
+            lock_wait_seconds.observe(
+                time.perf_counter() - started, backend=self.backend
+            )
+            yield
+        finally:
+            for user_id in reversed(held):
+                await self._release(user_id)
+
+    async def _acquire(self, user_id: str, deadline: float):
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            await asyncio.wait_for(
+                entry[0].acquire(), max(deadline - time.monotonic(), 0)
+            )
+        except BaseException as e:
+            self._forget(user_id, entry)
+            if isinstance(e, asyncio.TimeoutError):
+                raise UserLockTimeout(f"Timed out waiting on {user_id}") from None
+            raise
+
+    async def _release(self, user_id: str):
+        entry = self._locks[user_id]
+        entry[0].release()
+        self._forget(user_id, entry)
+
+    def _forget(self, user_id: str, entry: List):
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[user_id]
+
+
+class RedisUserLocks(ProcessUserLocks):
+    """
+    Per user locks shared by every worker, a Redis key per user held with
+    SET NX. Requests within a worker queue on the process lock first so only
+    one of them at a time polls Redis. The key expires after `ttl_seconds`
+    in case its worker dies holding it.
+    """
+
+    backend = "redis"
+
+    # Only the holder's token deletes the key, an expired lock taken by
+    # someone else is left alone
+    RELEASE = """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("del", KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(
+        self,
+        timeout_seconds: float = 5.0,
+        ttl_seconds: float = 10.0,
+        poll_seconds: float = 0.005,
+        redis=None,
+    ):
+        super().__init__(timeout_seconds=timeout_seconds)
+        self.ttl_seconds = ttl_seconds
+        self.poll_seconds = poll_seconds
+        self._redis = redis
+        self._tokens: Dict[str, str] = {}
+
+    @property
+    def redis(self):
+        return connections.redis if self._redis is None else self._redis
+
+    @staticmethod
+    def _key(user_id: str) -> str:
+        return f"user_lock{user_id}"
+
+    async def _acquire(self, user_id: str, deadline: float):
+        await super()._acquire(user_id, deadline)
+        token = uuid.uuid4().hex
+        poll = self.poll_seconds
+        try:
+            while not await self.redis.set(
+                self._key(user_id),
+                token,
+                nx=True,
+                px=int(self.ttl_seconds * 1000),
+            ):
+                if time.monotonic() + poll > deadline:
+                    raise UserLockTimeout(f"Timed out waiting on {user_id}")
+                await asyncio.sleep(poll)
+                poll = min(poll * 2, 0.1)
+        except BaseException:
+            await super()._release(user_id)
+            raise
+        self._tokens[user_id] = token
+
+    async def _release(self, user_id: str):
+        try:
+            await self.redis.eval(
+                self.RELEASE, 1, self._key(user_id), self._tokens.pop(user_id)
+            )
+        finally:
+            await super()._release(user_id)
+
+
+def user_locks_for(settings: config.Settings) -> NoUserLocks:
+    if settings.USER_LOCKS == "redis":
+        return RedisUserLocks(
+            timeout_seconds=settings.USER_LOCK_TIMEOUT_SECONDS,
+            ttl_seconds=settings.USER_LOCK_TTL_SECONDS,
+        )
+    if settings.USER_LOCKS == "process":
+        return ProcessUserLocks(timeout_seconds=settings.USER_LOCK_TIMEOUT_SECONDS)
+    return NoUserLocks()
+
+
+user_locks = user_locks_for(settings)
@@ -0,0 +1,54 @@
+import inspect
+
+from services.transaction.replay_transactions import ReplayStore
+from benchmarks.mongomock_compat import allow_bulk_write_sort, keep_partial_indexes
+
+allow_bulk_write_sort()
+keep_partial_indexes()
+
+
+class PipelineStore(ReplayStore):
+    """
+    ReplayStore with pipelines, for the fakes of the Redis features built on
+    it. A pipeline queues calls to the store's own commands and runs them in
+    order on execute. Expiry is ignored, as it is by ReplayStore.
+    """
+
+    def pipeline(self, transaction=True):
+        return _Pipeline(self)
+
+    async def expire(self, key, seconds):
+        pass
+
+    async def pexpire(self, key, ms):
+        pass
+
+
+class _Pipeline:
+    def __init__(self, store: PipelineStore):
+        self.store = store
+        self.calls = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    def __getattr__(self, name):
+        command = getattr(self.store, name)
+
+        def queue(*args, **kwargs):
+            self.calls.append((command, args, kwargs))
+
+        return queue
+
+    async def execute(self) -> list:
+        results = []
+        for command, args, kwargs in self.calls:
+            result = command(*args, **kwargs)
+            if inspect.isawaitable(result):
+                result = await result
+            results.append(result)
+        self.calls = []
+        return results
@@ -0,0 +1,66 @@
+import unittest
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+
+from config import Settings
+from connections import Connections
+
+
+class TestConnections(unittest.IsolatedAsyncioTestCase):
+
+    def test_clients_are_created_when_first_used(self):
+        connections = Connections(settings=Settings())
+
+        self.assertIsNone(connections._mongo_client)
+        self.assertIsNone(connections._redis)
+
+        redis = connections.redis
+        pool = redis.connection_pool
+        self.assertIs(connections.redis, redis)
+        self.assertEqual(pool.max_connections, Settings().REDIS_MAX_CONNECTIONS)
+        self.assertEqual(
+            pool.connection_kwargs["socket_connect_timeout"],
+            Settings().REDIS_SOCKET_CONNECT_TIMEOUT,
+        )
+        self.assertEqual(
+            connections.stats()["redis"],
+            {"max": Settings().REDIS_MAX_CONNECTIONS, "open": 0, "in_use": 0},
+        )
+
+    async def test_warm_up_close_and_drain(self):
+        mongo_client = AsyncMongoMockClient()
+        redis = mock.AsyncMock()
+        connections = Connections(
+            settings=Settings(CONNECTIONS_DRAIN_SECONDS=0.2),
+            mongo_client=mongo_client,
+            redis=redis,
+        )
+        db = connections.db
+        self.assertIs(connections.db, db)
+
+        await connections.start()
+        redis.ping.assert_awaited_once()
+
+        # A connection that's never returned only holds shutdown up to the
+        # drain timeout
+        connections.mongo_pool.in_use = 1
+        with self.assertLogs("connections", level="WARNING"):
+            await connections.close()
+
+        redis.aclose.assert_awaited_once()
+        self.assertIsNone(connections._mongo_client)
+        self.assertIsNone(connections._redis)
+        self.assertIsNone(connections._db)
+
+    async def test_warm_up_doesnt_fail_startup(self):
+        redis = mock.AsyncMock()
+        redis.ping.side_effect = ConnectionError()
+        connections = Connections(
+            settings=Settings(),
+            mongo_client=AsyncMongoMockClient(),
+            redis=redis,
+        )
+
+        with self.assertLogs("connections", level="WARNING"):
+            await connections.start()
@@ -0,0 +1,105 @@
+import datetime
+import unittest
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+
+from benchmarks.synthetic import SyntheticStream
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from repositories.transaction_repository import TransactionRepository, settings
+from services.rules.rule_plan import DEFAULT_RULE_SET, RulePlan
+from services.transaction.new_transaction import NewTransaction
+from services.transaction.new_transaction_batch import NewTransactionBatch
+from services.transaction.replay_transactions import ReplayStore
+from tests.unit.test_replay import _verdicts
+
+PLAN = RulePlan(DEFAULT_RULE_SET)
+HOT_SECONDS = 6 * 3600
+
+
+def _payloads(hours_ago: int, count: int):
+    stream = SyntheticStream(
+        users=3,
+        interval_seconds=30,
+        small_fraction=0.6,
+        end=datetime.datetime.utcnow() - datetime.timedelta(hours=hours_ago),
+        seed=hours_ago,
+    )
+    return [NewTransactionPayload(**t) for t in stream.transactions(count)]
+
+
+@mock.patch.object(settings, "RULE_WINDOW_COUNTERS_ENABLED", False)
+@mock.patch("connections.connections.redis")
+class TestHotTier(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        # A day old history, then a recent stream one at a time and in a batch
+        self.old = _payloads(hours_ago=24, count=60)
+        self.recent = _payloads(hours_ago=0, count=120)
+
+    async def _ingest(self, db):
+        store = ReplayStore()
+        await NewTransactionBatch(
+            transactions=self.old, database=db, redis=store
+        ).create()
+        for payload in self.recent[:60]:
+            await NewTransaction(transaction=payload, database=db, redis=store)()
+        await NewTransactionBatch(
+            transactions=self.recent[60:], database=db, redis=store
+        ).create()
+
+    async def test_rules_read_the_hot_tier(self, _redis):
+        single_db = AsyncMongoMockClient()["tests"]
+        await self._ingest(single_db)
+
+        db = AsyncMongoMockClient()["tests"]
+        with mock.patch.object(
+            settings, "TRANSACTION_HOT_TIER", True
+        ), mock.patch.object(settings, "TRANSACTION_HOT_SECONDS", HOT_SECONDS):
+            await self._ingest(db)
+            repo = TransactionRepository(db=db)
+
+        # Everything is in the full history, only the recent ones are hot
+        self.assertEqual(await _verdicts(db), await _verdicts(single_db))
+        self.assertEqual(
+            await db["transaction_hot"].count_documents({}), len(self.recent)
+        )
+
+        # Recent windows are answered from the hot tier alone, the full history
+        # from the archive
+        user_id = self.recent[-1].user_id
+        at = self.recent[-1].timestamp
+        queries = [window.as_query(at) for window in PLAN.windows]
+        expected = await repo.get_latest_in_windows(user_id=user_id, windows=queries)
+        await db["transaction"].delete_many(
+            {"timestamp": {"$gte": self.recent[0].timestamp}}
+        )
+        self.assertEqual(
+            await repo.get_latest_in_windows(user_id=user_id, windows=queries),
+            expected,
+        )
+        self.assertTrue(any(expected.values()))
+        self.assertEqual(
+            await repo.get_transactions_for_user_between(
+                user_id=user_id,
+                since=self.old[0].timestamp,
+                until=self.old[-1].timestamp,
+            ),
+            await db["transaction"].find({"user_id": user_id}).to_list(None),
+        )
+
+    async def test_filling_the_hot_tier(self, _redis):
+        db = AsyncMongoMockClient()["tests"]
+        await self._ingest(db)
+        repo = TransactionRepository(db=db, hot_seconds=HOT_SECONDS)
+        await repo.ensure_indexes()
+
+        self.assertEqual(await repo.fill_hot_tier(batch_size=50), len(self.recent))
+        # Copying them again is harmless
+        self.assertEqual(await repo.fill_hot_tier(batch_size=50), len(self.recent))
+        self.assertEqual(
+            await db["transaction_hot"].count_documents({}), len(self.recent)
+        )
+        self.assertEqual(await repo.missing_indexes(), [])
+        ttl = (await db["transaction_hot"].index_information())["hot_timestamp_ttl"]
+        self.assertEqual(ttl["expireAfterSeconds"], HOT_SECONDS)
@@ -0,0 +1,173 @@
+import asyncio
+import datetime
+import unittest
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from repositories.transaction_repository import TransactionRepository
+from services.rules.process_rules import ProcessRules
+from services.transaction.new_transaction import NewTransaction
+from services.transaction.new_transaction_batch import NewTransactionBatch
+from services.transaction.replay_transactions import ReplayStore
+from services.transaction.user_locks import NoUserLocks, ProcessUserLocks
+from tests.unit.test_user_locks import SlowStore
+
+
+def _payload(key, user_id="user1234", amount="50", seconds_ago=0):
+    return NewTransactionPayload(
+        user_id=user_id,
+        amount=amount,
+        currency="USD",
+        timestamp=datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds_ago),
+        type="TRANSFER",
+        idempotency_key=key,
+    )
+
+
+@mock.patch("connections.connections.redis")
+class TestIdempotency(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.db = AsyncMongoMockClient()["tests"]
+        await TransactionRepository(db=self.db).ensure_indexes()
+
+    async def test_a_retry_returns_the_stored_transaction(self, _redis):
+        store = ReplayStore()
+        payload = _payload("retried", amount="20000")
+
+        first = await NewTransaction(
+            transaction=payload, database=self.db, redis=store
+        ).create()
+        with mock.patch(
+            "services.transaction.new_transaction.ProcessRules", wraps=ProcessRules
+        ) as process_rules:
+            retried = await NewTransaction(
+                transaction=payload, database=self.db, redis=store
+            ).create()
+            # Redis has gone, Mongo still has it
+            forgotten = await NewTransaction(
+                transaction=payload, database=self.db, redis=ReplayStore()
+            ).create()
+        process_rules.assert_not_called()
+
+        self.assertEqual(first.to_json_bytes(), retried.to_json_bytes())
+        self.assertEqual(first.to_json_bytes(), forgotten.to_json_bytes())
+        self.assertEqual(await self.db["transaction"].count_documents({}), 1)
+
+    async def test_concurrent_duplicates_write_once(self, _redis):
+        for locks in (ProcessUserLocks(), NoUserLocks()):
+            await self.db["transaction"].delete_many({})
+            # Several of the same transaction, and the same key under other
+            # users which is theirs to use as well
+            payloads = [_payload(f"{locks}")] * 6 + [
+                _payload(f"{locks}", user_id=f"user{i}") for i in range(4)
+            ]
+
+            transactions = await asyncio.gather(
+                *[
+                    NewTransaction(
+                        transaction=payload,
+                        database=self.db,
+                        redis=SlowStore(),
+                        locks=locks,
+                    ).create()
+                    for payload in payloads
+                ]
+            )
+
+            self.assertEqual(await self.db["transaction"].count_documents({}), 5)
+            self.assertEqual(len({t.id for t in transactions[:6]}), 1)
+            self.assertEqual(len({t.id for t in transactions}), 5)
+            self.assertEqual(
+                [t.user_id for t in transactions], [p.user_id for p in payloads]
+            )
+
+    async def test_users_sharing_a_key_get_their_own_transactions(self, _redis):
+        store = ReplayStore()
+        mine = await NewTransaction(
+            transaction=_payload("shared", amount="20000"),
+            database=self.db,
+            redis=store,
+        ).create()
+        theirs = await NewTransaction(
+            transaction=_payload("shared", user_id="user5678"),
+            database=self.db,
+            redis=store,
+        ).create()
+        self.assertNotEqual(theirs.id, mine.id)
+        self.assertEqual(theirs.user_id, "user5678")
+        self.assertEqual(theirs.amount, 50.0)
+
+        # Retries, from Redis, from Mongo and in a batch with a third user
+        for redis in (store, ReplayStore()):
+            batch = NewTransactionBatch(
+                transactions=[
+                    _payload("shared", amount="20000"),
+                    _payload("shared", user_id="user5678"),
+                    _payload("shared", user_id="user9012", amount="70"),
+                ],
+                database=self.db,
+                redis=redis,
+            )
+            retried = await batch.create()
+            self.assertEqual([t.id for t in retried[:2]], [mine.id, theirs.id])
+            self.assertEqual(retried[2].user_id, "user9012")
+            self.assertEqual(retried[2].amount, 70.0)
+        self.assertEqual(len(batch.inserted), 0)
+        self.assertEqual(await self.db["transaction"].count_documents({}), 3)
+
+    async def test_duplicates_without_a_key_are_raised(self, _redis):
+        store = ReplayStore()
+        first = await NewTransaction(
+            transaction=_payload(None), database=self.db, redis=store
+        ).create()
+        with mock.patch(
+            "services.transaction.new_transaction.ObjectId", return_value=first.id
+        ), self.assertRaises(DuplicateKeyError):
+            await NewTransaction(
+                transaction=_payload(None), database=self.db, redis=store
+            ).create()
+
+        repository = TransactionRepository(db=self.db)
+        document = await self.db["transaction"].find_one({"_id": first.id})
+        with self.assertRaises(BulkWriteError):
+            await repository.insert_new_transactions([document])
+        self.assertEqual(await self.db["transaction"].count_documents({}), 1)
+
+    async def test_a_batch_writes_each_key_once(self, _redis):
+        store = ReplayStore()
+        stored = await NewTransaction(
+            transaction=_payload("a", seconds_ago=10), database=self.db, redis=store
+        ).create()
+
+        payloads = [
+            _payload("a", seconds_ago=10),
+            _payload("b", seconds_ago=5),
+            _payload(None, seconds_ago=4),
+            _payload("b", seconds_ago=5),
+            _payload("c", seconds_ago=3),
+        ]
+        batch = NewTransactionBatch(
+            transactions=payloads, database=self.db, redis=store
+        )
+        transactions = await batch.create()
+
+        self.assertEqual(transactions[0].id, stored.id)
+        self.assertEqual(transactions[1].id, transactions[3].id)
+        self.assertEqual(
+            [t.idempotency_key for t in transactions], ["a", "b", None, "b", "c"]
+        )
+        self.assertEqual(len(batch.inserted), 3)
+        self.assertEqual(await self.db["transaction"].count_documents({}), 4)
+
+        # Resending the whole batch writes nothing
+        again = await NewTransactionBatch(
+            transactions=payloads[:2] + payloads[3:], database=self.db, redis=store
+        ).create()
+        self.assertEqual(
+            [t.id for t in again], [t.id for t in transactions[:2] + transactions[3:]]
+        )
+        self.assertEqual(await self.db["transaction"].count_documents({}), 4)
@@ -0,0 +1,55 @@
+import unittest
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+
+from config import Settings
+from connections import Connections
+from main import remodemo_app
+from repositories.transaction_repository import TransactionRepository
+
+
+class TestIndexes(unittest.IsolatedAsyncioTestCase):
+
+    async def test_missing_indexes_are_created(self):
+        db = AsyncMongoMockClient()["tests"]
+        repo = TransactionRepository(db=db)
+
+        self.assertEqual(
+            len(await repo.missing_indexes()), len(TransactionRepository.INDEXES)
+        )
+
+        await repo.ensure_indexes()
+
+        self.assertEqual(await repo.missing_indexes(), [])
+        self.assertIn(
+            "user_id_timestamp_id_suspicious",
+            await db["transaction"].index_information(),
+        )
+
+    async def test_replaced_indexes_are_dropped(self):
+        db = AsyncMongoMockClient()["tests"]
+        await db["transaction"].create_index(
+            "idempotency_key", name="idempotency_key_unique", unique=True, sparse=True
+        )
+
+        await TransactionRepository(db=db).ensure_indexes()
+
+        indexes = await db["transaction"].index_information()
+        self.assertNotIn("idempotency_key_unique", indexes)
+        self.assertIn("user_id_idempotency_key_unique", indexes)
+
+    async def test_lifespan_ensures_indexes(self):
+        db = AsyncMongoMockClient()["tests"]
+
+        app = remodemo_app()
+        connections = Connections(
+            settings=Settings(MONGO_DATABASE="tests", CONNECTIONS_WARM_UP=False),
+            mongo_client=db.client,
+            redis=mock.AsyncMock(),
+        )
+        with mock.patch("main.connections", connections):
+            async with app.router.lifespan_context(app):
+                self.assertIs(app.state.connections, connections)
+
+        self.assertEqual(await TransactionRepository(db=db).missing_indexes(), [])
@@ -0,0 +1,211 @@
+import datetime
+import time
+import unittest
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from services.transaction.ingest_queue import (
+    IngestQueue,
+    IngestQueueFull,
+    IngestWorker,
+)
+from services.transaction.new_transaction import NewTransaction
+from services.transaction.replay_transactions import ReplayStore
+from tests.unit.conftest import PipelineStore
+
+
+class StreamStore(PipelineStore):
+    """
+    The stream, consumer group and hash commands the ingest queue uses, with
+    the enqueue script done by hand.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.stream = {}
+        self.last_delivered = "0-0"
+        # id -> (consumer, delivered at)
+        self.pending = {}
+        self.hashes = {}
+        self._sequence = 0
+
+    async def eval(self, script, numkeys, stream, status_key, max_length, payload, ttl):
+        assert script == IngestQueue.ENQUEUE
+        if "status" in self.hashes.get(status_key, {}):
+            return [self.hashes[status_key]["status"], 1]
+        if len(self.stream) >= int(max_length):
+            return [b"full", 0]
+        self._sequence += 1
+        id = f"{int(time.time() * 1000)}-{self._sequence}"
+        self.stream[id] = {b"payload": payload.encode()}
+        self.hashes[status_key] = {"status": b"queued", "stream_id": id.encode()}
+        return [b"queued", 0]
+
+    async def hgetall(self, key):
+        return {
+            name.encode(): value for name, value in self.hashes.get(key, {}).items()
+        }
+
+    async def xgroup_create(self, stream, group, id="0", mkstream=False):
+        pass
+
+    async def xreadgroup(self, group, consumer, streams, count=None, block=None):
+        new = [id for id in self.stream if id not in self.pending][:count]
+        for id in new:
+            self.pending[id] = (consumer, time.monotonic())
+        return [[b"stream", [(id.encode(), self.stream[id]) for id in new]]]
+
+    async def xpending_range(self, stream, group, min, max, count):
+        now = time.monotonic()
+        return [
+            {
+                "message_id": id.encode(),
+                "consumer": consumer,
+                "time_since_delivered": int((now - delivered) * 1000),
+            }
+            for id, (consumer, delivered) in list(self.pending.items())[:count]
+        ]
+
+    async def xclaim(self, stream, group, consumer, min_idle_time, ids):
+        claimed = []
+        for id in [_id.decode() for _id in ids]:
+            self.pending[id] = (consumer, time.monotonic())
+            claimed.append((id.encode(), self.stream.get(id)))
+        return claimed
+
+    async def xack(self, stream, group, *ids):
+        for id in ids:
+            self.pending.pop(id if isinstance(id, str) else id.decode(), None)
+
+    async def xdel(self, stream, *ids):
+        for id in ids:
+            self.stream.pop(id, None)
+
+    async def xlen(self, stream):
+        return len(self.stream)
+
+    async def xpending(self, stream, group):
+        return {"pending": len(self.pending)}
+
+    async def xrange(self, stream, count=None):
+        return [(id.encode(), fields) for id, fields in self.stream.items()][:count]
+
+    async def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update(mapping)
+
+
+def _payloads(count=6):
+    now = datetime.datetime.utcnow()
+    return [
+        NewTransactionPayload(
+            user_id="user1234",
+            amount="50",
+            currency="USD",
+            timestamp=now - datetime.timedelta(seconds=count - i),
+            type="TRANSFER",
+            idempotency_key=f"key{i}",
+        )
+        for i in range(count)
+    ]
+
+
+@mock.patch("connections.connections.redis")
+class TestIngestQueue(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.store = StreamStore()
+        self.queue = IngestQueue(max_length=10, redis=self.store)
+        self.db = AsyncMongoMockClient()["tests"]
+
+    def _worker(self, consumer="worker1", claim_idle_ms=30_000):
+        return IngestWorker(
+            queue=self.queue,
+            consumer=consumer,
+            database=self.db,
+            redis=self.store,
+            block_ms=0,
+            claim_idle_ms=claim_idle_ms,
+        )
+
+    async def test_queued_transactions_get_the_sync_verdicts(self, _redis):
+        payloads = _payloads()
+        for payload in payloads:
+            status = await self.queue.enqueue(payload)
+            self.assertEqual(status["status"], "queued")
+        # Resending a key doesn't queue it again
+        status = await self.queue.enqueue(payloads[0])
+        self.assertEqual(
+            status,
+            {"user_id": "user1234", "idempotency_key": "key0", "status": "queued"},
+        )
+        self.assertEqual((await self.queue.lag())["length"], 6)
+
+        self.assertEqual(await self._worker().run_once(), 6)
+
+        sync_db = AsyncMongoMockClient()["tests"]
+        sync_store = ReplayStore()
+        for payload in payloads:
+            expected = await NewTransaction(
+                transaction=payload, database=sync_db, redis=sync_store
+            )()
+            status = await self.queue.status(payload.user_id, payload.idempotency_key)
+            self.assertEqual(status["status"], "done")
+            self.assertEqual(
+                status["transaction"]["suspicious_reasons"],
+                expected["suspicious_reasons"],
+            )
+        self.assertEqual(await self.db["transaction"].count_documents({}), 6)
+        self.assertEqual(
+            await self.queue.lag(), {"length": 0, "pending": 0, "oldest_seconds": 0}
+        )
+
+        # A key that's done stays done
+        status = await self.queue.enqueue(payloads[0])
+        self.assertEqual(status["status"], "done")
+
+    async def test_a_full_queue_turns_transactions_away(self, _redis):
+        payloads = _payloads(12)
+        for payload in payloads[:10]:
+            await self.queue.enqueue(payload)
+        with self.assertRaises(IngestQueueFull):
+            await self.queue.enqueue(payloads[10])
+
+        await self._worker().run_once()
+        status = await self.queue.enqueue(payloads[10])
+        self.assertEqual(status["status"], "queued")
+
+    async def test_abandoned_entries_are_redelivered_once_written(self, _redis):
+        for payload in _payloads():
+            await self.queue.enqueue(payload)
+
+        # The first worker writes the transactions but dies before marking
+        # them done
+        crashed = self._worker("worker1")
+        with mock.patch.object(self.queue, "complete", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                await crashed.run_once()
+        self.assertEqual((await self.queue.lag())["pending"], 6)
+
+        await self._worker("worker2", claim_idle_ms=0).run_once()
+
+        self.assertEqual(await self.db["transaction"].count_documents({}), 6)
+        self.assertEqual(
+            (await self.queue.status("user1234", "key5"))["status"], "done"
+        )
+        self.assertEqual((await self.queue.lag())["length"], 0)
+
+    async def test_keys_are_only_shared_by_the_same_user(self, _redis):
+        mine, theirs = _payloads(1)[0], _payloads(1)[0].model_copy(
+            update={"user_id": "user5678", "amount": 60.0}
+        )
+        await self.queue.enqueue(mine)
+        status = await self.queue.enqueue(theirs)
+        self.assertEqual(status["status"], "queued")
+
+        self.assertEqual(await self._worker().run_once(), 2)
+        for payload in (mine, theirs):
+            status = await self.queue.status(payload.user_id, "key0")
+            self.assertEqual(status["transaction"]["user_id"], payload.user_id)
+            self.assertEqual(status["transaction"]["amount"], payload.amount)
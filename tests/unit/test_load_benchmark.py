@@ -0,0 +1,64 @@
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from collections import Counter
+
+from benchmarks.synthetic import SyntheticStream
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class TestLoadBenchmark(unittest.TestCase):
+
+    def test_synthetic_stream_is_repeatable_and_skewed(self):
+        end = datetime.datetime(2024, 11, 18, tzinfo=datetime.timezone.utc)
+        first = list(SyntheticStream(users=100, seed=3, end=end).transactions(2000))
+        second = list(SyntheticStream(users=100, seed=3, end=end).transactions(2000))
+        self.assertEqual(first, second)
+
+        users = Counter(t["user_id"] for t in first)
+        self.assertGreater(users["user0"], users["user50"] * 10)
+        self.assertEqual(
+            [t["timestamp"] for t in first], sorted(t["timestamp"] for t in first)
+        )
+
+        uniform = Counter(
+            t["user_id"] for t in SyntheticStream(users=10, skew=0).transactions(2000)
+        )
+        self.assertLess(max(uniform.values()), 2000 / 10 * 1.5)
+
+    def test_in_process_run_reports_and_saves(self):
+        # Run as it's run from the command line, without the tests' patches
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "baseline.json")
+            subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "benchmarks.load",
+                    "--mode=inprocess",
+                    "--requests=40",
+                    "--queries=20",
+                    "--concurrency=4",
+                    "--users=5",
+                    f"--save={path}",
+                ],
+                cwd=ROOT,
+                check=True,
+                capture_output=True,
+                timeout=120,
+            )
+            with open(path) as f:
+                report = json.load(f)
+
+        ingest = report["results"]["inprocess"]["ingest"]
+        self.assertEqual(ingest["requests"], 40)
+        self.assertEqual(ingest["errors"], 0)
+        self.assertEqual(ingest["mongo_ops_per_request"]["insert_one"], 1)
+        self.assertEqual(ingest["redis_ops_per_request"]["mget"], 1)
+        self.assertLessEqual(ingest["p50_ms"], ingest["p99_ms"])
+        self.assertEqual(report["results"]["inprocess"]["query"]["errors"], 0)
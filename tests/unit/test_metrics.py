@@ -0,0 +1,105 @@
+import datetime
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+
+import metrics
+from metrics import Counter, Histogram, Registry
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from services.rules.process_rules import ProcessRules
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+
+    def test_render_prometheus_text(self):
+        registry = Registry()
+        hits = registry.register(Counter("hits_total", "Hits", labelnames=["key"]))
+        seconds = registry.register(
+            Histogram("stage_seconds", "Stages", ["stage"], buckets=(0.1, 1.0))
+        )
+
+        hits.inc(key="a")
+        hits.inc(2, key="a")
+        seconds.observe(0.05, stage="rules")
+        seconds.observe(0.5, stage="rules")
+        seconds.observe(5, stage="rules")
+
+        lines = registry.render().splitlines()
+        self.assertIn("# TYPE hits_total counter", lines)
+        self.assertIn('hits_total{key="a"} 3', lines)
+        self.assertIn("# TYPE stage_seconds histogram", lines)
+        self.assertIn('stage_seconds_bucket{stage="rules",le="0.1"} 1', lines)
+        self.assertIn('stage_seconds_bucket{stage="rules",le="1.0"} 2', lines)
+        self.assertIn('stage_seconds_bucket{stage="rules",le="+Inf"} 3', lines)
+        self.assertIn('stage_seconds_sum{stage="rules"} 5.55', lines)
+        self.assertIn('stage_seconds_count{stage="rules"} 3', lines)
+
+    @mock.patch("connections.connections.redis")
+    async def test_rules_record_hits_and_flag_lookups(self, _redis):
+        _redis.mget.return_value = [None, b"1"]
+        db = AsyncMongoMockClient()["tests"]
+        rapid_hits = metrics.rule_hits.value(reason="RAPID_TRANSFERS")
+        small_misses = metrics.rule_flag_cache.value(
+            key="small_transactions", result="miss"
+        )
+        rapid_flag_hits = metrics.rule_flag_cache.value(
+            key="rapid_transfers", result="hit"
+        )
+        mget_timings = metrics.redis_seconds.count(command="mget")
+
+        await ProcessRules(
+            transaction=NewTransactionPayload(
+                user_id="user1234",
+                amount="10001",
+                currency="USD",
+                timestamp=datetime.datetime.utcnow(),
+                type="TRANSFER",
+            ),
+            database=db,
+        )()
+
+        self.assertEqual(
+            metrics.rule_hits.value(reason="RAPID_TRANSFERS"), rapid_hits + 1
+        )
+        self.assertEqual(
+            metrics.rule_flag_cache.value(key="small_transactions", result="miss"),
+            small_misses + 1,
+        )
+        self.assertEqual(
+            metrics.rule_flag_cache.value(key="rapid_transfers", result="hit"),
+            rapid_flag_hits + 1,
+        )
+        self.assertEqual(metrics.redis_seconds.count(command="mget"), mget_timings + 1)
+
+    async def test_sampled_slow_requests_are_logged(self):
+        scope = {
+            "type": "http",
+            "method": "POST",
+            "path": "/transactions",
+            "route": SimpleNamespace(path="/transactions"),
+        }
+
+        async def app(scope, receive, send):
+            metrics.stage_seconds.observe(0.25, stage="mongo_insert")
+            await send({"type": "http.response.start", "status": 201})
+
+        send = mock.AsyncMock()
+        with mock.patch.multiple(
+            metrics.settings,
+            METRICS_TRACE_SAMPLE_RATE=1.0,
+            METRICS_SLOW_REQUEST_SECONDS=0.0,
+        ):
+            with self.assertLogs("metrics", level="WARNING") as logs:
+                await metrics.MetricsMiddleware(app)(scope, None, send)
+
+        send.assert_awaited_once()
+        self.assertIn("mongo_insert", logs.output[0])
+        self.assertIsNone(metrics._trace.get())
+        self.assertGreaterEqual(
+            metrics.request_seconds.count(
+                method="POST", route="/transactions", status="201"
+            ),
+            1,
+        )
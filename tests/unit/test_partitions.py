@@ -0,0 +1,212 @@
+import unittest
+from collections import Counter
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+
+from benchmarks.synthetic import SyntheticStream
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from repositories.partitioned_transaction_repository import (
+    PartitionedTransactionRepository,
+)
+from repositories.partitions import HashRing, TransactionPartitions, set_partitions
+from services.transaction.get_suspicious_transactions import GetSuspiciousTransactions
+from services.transaction.new_transaction import NewTransaction
+from services.transaction.new_transaction_batch import NewTransactionBatch
+from services.transaction.rebalance_partitions import (
+    IncompleteMove,
+    RebalancePartitions,
+)
+from services.transaction.replay_transactions import ReplayStore
+from tests.unit.test_replay import END, _verdicts
+
+
+def _payloads():
+    stream = SyntheticStream(
+        users=40, interval_seconds=30, small_fraction=0.6, end=END, seed=11
+    )
+    return [NewTransactionPayload(**t) for t in stream.transactions(400)]
+
+
+def _partitions(count: int) -> dict:
+    # Each on its own client, like separate deployments
+    return {f"p{i}": AsyncMongoMockClient()["tests"] for i in range(count)}
+
+
+def _without_ids(suspicious: dict) -> dict:
+    # The same transactions written to different databases get other _ids
+    return {
+        user_id: [{k: v for k, v in t.items() if k != "id"} for t in transactions]
+        for user_id, transactions in suspicious.items()
+    }
+
+
+async def _users(db) -> set:
+    return set(await db["transaction"].distinct("user_id"))
+
+
+@mock.patch("connections.connections.redis")
+class TestPartitions(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.payloads = _payloads()
+        self.user_ids = sorted({p.user_id for p in self.payloads})
+
+    async def _ingest(self, db, payloads):
+        store = ReplayStore()
+        half = len(payloads) // 2
+        for payload in payloads[:half]:
+            await NewTransaction(transaction=payload, database=db, redis=store)()
+        await NewTransactionBatch(
+            transactions=payloads[half:], database=db, redis=store
+        ).create()
+
+    async def _suspicious(self, db) -> dict:
+        return {
+            user_id: await GetSuspiciousTransactions(user_id=user_id, database=db)()
+            for user_id in self.user_ids
+        }
+
+    def test_ring_spreads_users_and_only_moves_them_to_new_partitions(self, _redis):
+        users = [f"user{i}" for i in range(6000)]
+        ring = HashRing(["p0", "p1", "p2"])
+        owners = {user: ring.partition_of(user) for user in users}
+
+        for count in Counter(owners.values()).values():
+            self.assertAlmostEqual(count / len(users), 1 / 3, delta=0.05)
+        # The same in any order and every time
+        self.assertEqual(
+            owners,
+            {user: HashRing(["p2", "p0", "p1"]).partition_of(user) for user in users},
+        )
+
+        grown = HashRing(["p0", "p1", "p2", "p3"])
+        moved = [user for user in users if grown.partition_of(user) != owners[user]]
+        self.assertTrue(all(grown.partition_of(user) == "p3" for user in moved))
+        self.assertAlmostEqual(len(moved) / len(users), 1 / 4, delta=0.05)
+
+    async def test_users_are_routed_to_their_partition(self, _redis):
+        single_db = AsyncMongoMockClient()["tests"]
+        await self._ingest(single_db, self.payloads)
+
+        db = AsyncMongoMockClient()["tests"]
+        databases = _partitions(3)
+        partitions = TransactionPartitions(databases)
+        set_partitions(db, partitions)
+        await self._ingest(db, self.payloads)
+
+        # Same verdicts, each user's transactions all on one partition
+        merged = sorted(
+            [v for partition in databases.values() for v in await _verdicts(partition)]
+        )
+        self.assertEqual(merged, await _verdicts(single_db))
+        self.assertEqual(await db["transaction"].count_documents({}), 0)
+        for name, partition in databases.items():
+            users = await _users(partition)
+            self.assertTrue(users)
+            self.assertEqual({partitions.owner(u) for u in users}, {name})
+        self.assertEqual(
+            _without_ids(await self._suspicious(db)),
+            _without_ids(await self._suspicious(single_db)),
+        )
+
+    async def test_rebalancing_after_adding_a_partition(self, _redis):
+        db = AsyncMongoMockClient()["tests"]
+        databases = _partitions(3)
+        set_partitions(db, TransactionPartitions(databases))
+        half = len(self.payloads) // 2
+        await self._ingest(db, self.payloads[:half])
+        before = await self._suspicious(db)
+
+        # Users moving to p3 are read from both until they've been moved,
+        # new transactions go to p3 straight away
+        databases["p3"] = AsyncMongoMockClient()["tests"]
+        partitions = TransactionPartitions(databases, previous=["p0", "p1", "p2"])
+        set_partitions(db, partitions)
+        self.assertEqual(await self._suspicious(db), before)
+        await self._ingest(db, self.payloads[half:])
+        during = await self._suspicious(db)
+
+        result = await RebalancePartitions(database=db, batch_size=7)()
+
+        moving = [u for u in self.user_ids if partitions.owner(u) == "p3"]
+        self.assertTrue(moving)
+        self.assertEqual(result["users"], len(moving))
+        for name, partition in databases.items():
+            users = await _users(partition)
+            self.assertEqual({partitions.owner(u) for u in users}, {name})
+        self.assertEqual(
+            sum(
+                [await d["transaction"].count_documents({}) for d in databases.values()]
+            ),
+            len(self.payloads),
+        )
+
+        # Nothing left to read from the old partitions
+        set_partitions(db, TransactionPartitions(databases))
+        self.assertEqual(await self._suspicious(db), during)
+        self.assertEqual((await RebalancePartitions(database=db)())["users"], 0)
+
+    async def _grow(self):
+        # Half the payloads on three partitions, then a fourth added
+        db = AsyncMongoMockClient()["tests"]
+        databases = _partitions(3)
+        set_partitions(db, TransactionPartitions(databases))
+        await self._ingest(db, self.payloads[: len(self.payloads) // 2])
+        databases["p3"] = AsyncMongoMockClient()["tests"]
+        partitions = TransactionPartitions(databases, previous=["p0", "p1", "p2"])
+        set_partitions(db, partitions)
+        moving = [u for u in self.user_ids if partitions.owner(u) == "p3"]
+        return db, databases, partitions, moving
+
+    async def test_moves_only_delete_what_was_copied(self, _redis):
+        db, databases, partitions, moving = await self._grow()
+        user_id = moving[0]
+        source = databases[partitions.previous_ring.partition_of(user_id)]
+        kept = await source["transaction"].count_documents({"user_id": user_id})
+
+        # The user already has one of the keys on the new partition
+        await PartitionedTransactionRepository(partitions).ensure_indexes()
+        first = await source["transaction"].find_one({"user_id": user_id})
+        await source["transaction"].update_one(
+            {"_id": first["_id"]}, {"$set": {"idempotency_key": "resent"}}
+        )
+        resent = {k: v for k, v in first.items() if k != "_id"}
+        await databases["p3"]["transaction"].insert_one(
+            {**resent, "idempotency_key": "resent"}
+        )
+
+        with self.assertRaises(IncompleteMove):
+            await RebalancePartitions(database=db)()
+        self.assertEqual(
+            await source["transaction"].count_documents({"user_id": user_id}), kept
+        )
+
+    async def test_user_histories_part_way_through_a_move(self, _redis):
+        db, databases, partitions, moving = await self._grow()
+        repository = PartitionedTransactionRepository(partitions)
+        before = [t async for t in repository.iter_user_histories()]
+
+        # Half of each moving user copied across, nothing deleted yet
+        for user_id in moving:
+            source = repository.repositories[
+                partitions.previous_ring.partition_of(user_id)
+            ]
+            history = [
+                t
+                async for t in source.iter_user_histories(
+                    from_user=user_id, to_user=user_id + "\0"
+                )
+            ]
+            await repository.repositories["p3"].copy_transactions(
+                history[len(history) // 2 :]
+            )
+
+        during = [t async for t in repository.iter_user_histories()]
+        self.assertEqual(
+            [(t["user_id"], t["_id"]) for t in during],
+            [(t["user_id"], t["_id"]) for t in before],
+        )
+        for previous, t in zip(during, during[1:]):
+            if previous["user_id"] == t["user_id"]:
+                self.assertLessEqual(previous["timestamp"], t["timestamp"])
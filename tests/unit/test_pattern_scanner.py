@@ -0,0 +1,186 @@
+import datetime
+import unittest
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+
+from benchmarks.synthetic import SyntheticStream
+from models.db.transaction_model import SCANNER_REASONS
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from repositories.partitions import TransactionPartitions, set_partitions
+from services.rules.pattern_scanner import ScanPatterns
+from services.rules.rule_engine import rule_engine
+from services.rules.rule_plan import DEFAULT_RULE_SET, RulePlan
+from services.transaction.replay_transactions import ReplayTransactions
+from services.transaction.rescore_transactions import RescoreJob
+from services.transaction.risk_summary import GetRiskSummary, RebuildRiskSummaries
+from tests.unit.test_replay import END
+from tests.unit.test_rescore import CHANGED_RULE_SET
+from tests.unit.test_risk_summary import _rounded
+
+SECOND = datetime.timedelta(seconds=1)
+MINUTE = datetime.timedelta(minutes=1)
+SINCE = END - datetime.timedelta(hours=4)
+UNTIL = END + datetime.timedelta(hours=1)
+STRUCTURING_AT = END + datetime.timedelta(minutes=10)
+BURST_AT = END + datetime.timedelta(minutes=20)
+
+
+def _payload(user_id, amount, at, type="DEPOSIT") -> NewTransactionPayload:
+    return NewTransactionPayload(
+        user_id=user_id, amount=amount, currency="USD", timestamp=at, type=type
+    )
+
+
+def _payloads():
+    stream = SyntheticStream(
+        users=40, interval_seconds=30, small_fraction=0.6, end=END, seed=5
+    )
+    noise = [NewTransactionPayload(**t) for t in stream.transactions(400)]
+    structuring = [
+        _payload(f"ring{i}", 9_100 + i * 250, STRUCTURING_AT + i * SECOND)
+        for i in range(4)
+    ]
+    # Under the threshold but alone in their minute, or over it
+    unstructured = [
+        _payload("ring0", 9_999, STRUCTURING_AT + 2 * MINUTE),
+        _payload("ring1", 10_000.5, STRUCTURING_AT + SECOND),
+    ]
+    burst = [
+        _payload(f"user{i}", 50, BURST_AT + i * SECOND, type="TRANSFER")
+        for i in range(12)
+    ]
+    return noise, structuring, unstructured, burst
+
+
+async def _reasons(db) -> dict:
+    return {
+        (t["user_id"], t["timestamp"], t["amount"]): sorted(t["suspicious_reasons"])
+        for t in await db["transaction"].find().to_list(None)
+    }
+
+
+@mock.patch("connections.connections.redis")
+class TestPatternScanner(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.noise, self.structuring, self.unstructured, self.burst = _payloads()
+        self.payloads = self.noise + self.structuring + self.unstructured + self.burst
+        self.user_ids = sorted({p.user_id for p in self.payloads})
+
+    async def _summaries(self, db) -> dict:
+        return {
+            user_id: _rounded(await GetRiskSummary(user_id=user_id, database=db)())
+            for user_id in self.user_ids
+        }
+
+    async def _scan(self, db) -> dict:
+        return await ScanPatterns(
+            since=SINCE, until=UNTIL, database=db, batch_size=50
+        )()
+
+    async def test_scan_flags_structuring_and_bursts(self, _redis):
+        db = AsyncMongoMockClient()["tests"]
+        await ReplayTransactions(transactions=self.payloads, database=db)()
+        before = await _reasons(db)
+
+        result = await self._scan(db)
+
+        self.assertEqual(result["rows"], len(self.payloads))
+        self.assertEqual(
+            result["flagged"],
+            {
+                "STRUCTURING": len(self.structuring),
+                "COORDINATED_BURST": len(self.burst),
+            },
+        )
+        after = await _reasons(db)
+        expected = {}
+        for reason, payloads in [
+            ("STRUCTURING", self.structuring),
+            ("COORDINATED_BURST", self.burst),
+        ]:
+            for p in payloads:
+                expected[(p.user_id, p.timestamp, p.amount)] = reason
+        for key, reasons in after.items():
+            if key in expected:
+                self.assertEqual(reasons, sorted(before[key] + [expected[key]]), key)
+            else:
+                self.assertEqual(reasons, before[key], key)
+        self.assertEqual(
+            await db["transaction"].count_documents(
+                {"suspicious_reasons": [], "is_suspicious": True}
+            ),
+            0,
+        )
+
+        # The summaries were added to as if the reasons had been there all
+        # along, and scanning again adds nothing
+        summaries = await self._summaries(db)
+        rescan = await self._scan(db)
+        self.assertEqual(rescan["flagged"], {})
+        self.assertEqual(rescan["updated"], 0)
+        self.assertEqual(await self._summaries(db), summaries)
+        await RebuildRiskSummaries(database=db)()
+        self.assertEqual(await self._summaries(db), summaries)
+
+    async def test_rescoring_keeps_the_scanners_reasons(self, _redis):
+        db = AsyncMongoMockClient()["tests"]
+        await ReplayTransactions(transactions=self.payloads, database=db)()
+        await self._scan(db)
+        scanned = await _reasons(db)
+
+        # Nothing for the same rules to change
+        unchanged = await RescoreJob(rule_set=DEFAULT_RULE_SET, database=db)()
+        self.assertEqual(unchanged["updated"], 0)
+
+        # The rules' reasons follow the new rules, the scanner's stay
+        changed = await RescoreJob(rule_set=CHANGED_RULE_SET, database=db)()
+        self.assertGreater(changed["updated"], 0)
+        rescored_db = AsyncMongoMockClient()["tests"]
+        with mock.patch.object(rule_engine, "plan", RulePlan(CHANGED_RULE_SET)):
+            await ReplayTransactions(transactions=self.payloads, database=rescored_db)()
+        rescored = await _reasons(rescored_db)
+        for key, reasons in (await _reasons(db)).items():
+            kept = [r for r in scanned[key] if r in SCANNER_REASONS]
+            self.assertEqual(reasons, sorted(rescored[key] + kept), key)
+        self.assertEqual(
+            await db["transaction"].count_documents(
+                {"suspicious_reasons": {"$in": SCANNER_REASONS}}
+            ),
+            len(self.structuring) + len(self.burst),
+        )
+
+    async def test_scan_across_partitions(self, _redis):
+        single_db = AsyncMongoMockClient()["tests"]
+        await ReplayTransactions(transactions=self.payloads, database=single_db)()
+        await self._scan(single_db)
+
+        db = AsyncMongoMockClient()["tests"]
+        databases = {f"p{i}": AsyncMongoMockClient()["tests"] for i in range(3)}
+        set_partitions(db, TransactionPartitions(databases))
+        await ReplayTransactions(transactions=self.payloads, database=db)()
+        # Part way through adding a partition, users being moved are read
+        # from both but only counted once
+        databases["p3"] = AsyncMongoMockClient()["tests"]
+        partitions = TransactionPartitions(databases, previous=["p0", "p1", "p2"])
+        set_partitions(db, partitions)
+        moving = [u for u in self.user_ids if partitions.owner(u) == "p3"]
+        self.assertTrue(moving)
+        for user_id in moving:
+            previous = partitions.owners(user_id)[1]
+            documents = (
+                await databases[previous]["transaction"]
+                .find({"user_id": user_id})
+                .to_list(None)
+            )
+            await databases["p3"]["transaction"].insert_many(documents)
+
+        result = await self._scan(db)
+
+        self.assertEqual(result["rows"], len(self.payloads))
+        merged = {}
+        for partition in databases.values():
+            merged.update(await _reasons(partition))
+        self.assertEqual(merged, await _reasons(single_db))
+        self.assertEqual(await self._summaries(db), await self._summaries(single_db))
@@ -0,0 +1,112 @@
+import datetime
+import unittest
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+
+import metrics
+from models.db.transaction_model import SuspiciousReasonsType
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from repositories.transaction_repository import TransactionRepository
+from services.rules.process_rules import ProcessRules, settings
+
+
+class TestProcessRules(unittest.IsolatedAsyncioTestCase):
+
+    def _payload(self, amount: str, type: str) -> NewTransactionPayload:
+        return NewTransactionPayload(
+            user_id="user1234",
+            amount=amount,
+            currency="USD",
+            timestamp=datetime.datetime.utcnow(),
+            type=type,
+        )
+
+    @mock.patch("connections.connections.redis")
+    async def test_rules_that_cannot_fire_are_skipped(self, _redis):
+        _redis.mget.return_value = [None, None]
+        db = AsyncMongoMockClient()["tests"]
+
+        process_rules = ProcessRules(
+            transaction=self._payload(amount="500", type="DEPOSIT"), database=db
+        )
+        with mock.patch.object(process_rules, "count_windows") as _count_windows:
+            self.assertEqual(await process_rules(), [])
+            _count_windows.assert_not_called()
+
+        _redis.mget.assert_awaited_once_with(
+            "small_transactionsuser1234", "rapid_transfersuser1234"
+        )
+        self.assertEqual(list(process_rules.timings), ["redis_flags"])
+
+    @mock.patch("connections.connections.redis")
+    async def test_rules_run_together_and_keep_reason_order(self, _redis):
+        _redis.mget.return_value = [None, b"1"]
+        db = AsyncMongoMockClient()["tests"]
+
+        process_rules = ProcessRules(
+            transaction=self._payload(amount="10001", type="TRANSFER"), database=db
+        )
+        reasons = await process_rules()
+
+        self.assertEqual(
+            reasons,
+            [
+                SuspiciousReasonsType.HIGH_VOLUME_TRANSACTION,
+                SuspiciousReasonsType.RAPID_TRANSFERS,
+            ],
+        )
+        _redis.get.assert_not_called()
+        # Rapid transfers is flagged so there's nothing to count
+        self.assertEqual(list(process_rules.timings), ["redis_flags"])
+
+    @mock.patch("connections.connections.redis")
+    async def test_rules_count_in_mongo_up_to_threshold(self, _redis):
+        _redis.mget.return_value = [None, None]
+        db = AsyncMongoMockClient()["tests"]
+        for i in range(5):
+            await db["transaction"].insert_one(
+                {
+                    "user_id": "user1234",
+                    "amount": 50.0,
+                    "timestamp": datetime.datetime.utcnow(),
+                    "type": "TRANSFER",
+                }
+            )
+
+        with mock.patch.object(
+            settings, "RULE_WINDOW_COUNTERS_ENABLED", False
+        ), mock.patch.object(
+            TransactionRepository,
+            "get_latest_in_windows",
+            side_effect=TransactionRepository.get_latest_in_windows,
+            autospec=True,
+        ) as _count:
+            process_rules = ProcessRules(
+                transaction=self._payload(amount="50", type="TRANSFER"), database=db
+            )
+            timed = {
+                name: metrics.rule_seconds.count(rule=name)
+                for name in ("small_transactions", "rapid_transfers")
+            }
+            reasons = await process_rules()
+
+        self.assertEqual(
+            reasons,
+            [
+                SuspiciousReasonsType.FREQUENT_SMALL_TRANSACTIONS,
+                SuspiciousReasonsType.RAPID_TRANSFERS,
+            ],
+        )
+        # Both windows are counted by one query, each stopping at its threshold
+        _count.assert_called_once()
+        windows = _count.call_args.kwargs["windows"]
+        self.assertEqual(sorted(w.limit for w in windows), [2, 4])
+        # Each rule is timed, both at the one query
+        for name, count in timed.items():
+            self.assertEqual(metrics.rule_seconds.count(rule=name), count + 1)
+        latest = await TransactionRepository(db=db).get_latest_in_windows(
+            user_id="user1234",
+            windows=[windows[0]._replace(limit=3)],
+        )
+        self.assertEqual(len(latest[windows[0].name]), 3)
@@ -0,0 +1,244 @@
+import asyncio
+import datetime
+import unittest
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+from redis.exceptions import NoScriptError
+
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from repositories.transaction_repository import TransactionRepository
+from services.rules.process_rules import settings
+from services.rules.redis_windows import RedisWindows, redis_windows_for
+from services.rules.rule_plan import DEFAULT_RULE_SET, RulePlan
+from services.transaction.new_transaction import NewTransaction
+from services.transaction.new_transaction_batch import NewTransactionBatch
+from services.transaction.replay_transactions import ReplayStore, ReplayTransactions
+from tests.unit.conftest import PipelineStore
+from tests.unit.test_replay import _payloads, _verdicts
+
+PLAN = RulePlan(DEFAULT_RULE_SET)
+
+
+class WindowStore(PipelineStore):
+    """
+    The sorted sets and hashes the Redis windows use, with their scripts done
+    by hand. Scripts have to be sent with EVAL once before EVALSHA finds
+    them, like a Redis that has just started.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.sets = {}
+        self.hashes = {}
+        self.scripts = set()
+
+    async def evalsha(self, sha, numkeys, *keys_and_args):
+        # Gives way to other requests like a round trip would
+        await asyncio.sleep(0)
+        if sha not in self.scripts:
+            raise NoScriptError("NOSCRIPT")
+        keys, args = keys_and_args[:numkeys], keys_and_args[numkeys:]
+        if sha == RedisWindows.EVALUATE.sha:
+            return self._evaluate(keys, args)
+        return self._load(keys, args)
+
+    async def eval(self, script, numkeys, *keys_and_args):
+        self.scripts.add(
+            next(
+                s.sha
+                for s in [RedisWindows.EVALUATE, RedisWindows.LOAD]
+                if s.source == script
+            )
+        )
+        return await self.evalsha(
+            (
+                RedisWindows.EVALUATE.sha
+                if script == RedisWindows.EVALUATE.source
+                else RedisWindows.LOAD.sha
+            ),
+            numkeys,
+            *keys_and_args,
+        )
+
+    def _evaluate(self, keys, args):
+        at, member, late, _, flags = args[:5]
+        since_hash = self.hashes.get(keys[0], {})
+        result = [self._values.get(key) for key in keys[1 : 1 + flags]]
+        windows = []
+        for w, key in enumerate(keys[1 + flags :]):
+            name, window, threshold = args[5 + 3 * w : 8 + 3 * w]
+            if name not in since_hash:
+                if member:
+                    self.sets.setdefault(key, {})[member] = at
+                windows.append([b"missing"])
+                continue
+            since = since_hash[name]
+            members = self.sets.setdefault(key, {})
+            scores = sorted(
+                (
+                    s
+                    for m, s in members.items()
+                    if m != member and at - window <= s <= at
+                ),
+                reverse=True,
+            )[:threshold]
+            status = (
+                b"late" if at - window < since and len(scores) < threshold else b"ok"
+            )
+            if member:
+                members[member] = at
+                cut = max(members.values()) - window - late
+                if cut > since:
+                    for m in [m for m, s in members.items() if s < cut]:
+                        del members[m]
+                    since_hash[name] = cut
+            windows.append([status] + [str(s).encode() for s in scores])
+        return result + [windows]
+
+    def _load(self, keys, args):
+        since_hash = self.hashes.setdefault(keys[0], {})
+        position = 1
+        for key in keys[1:]:
+            name, since, count = args[position : position + 3]
+            position += 3
+            members = self.sets.setdefault(key, {})
+            for _ in range(count):
+                score, member = args[position : position + 2]
+                members[member] = score
+                position += 2
+            if since_hash.get(name, float("-inf")) < since:
+                since_hash[name] = since
+        return 1
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.sets.pop(key, None)
+            self.hashes.pop(key, None)
+
+    async def zadd(self, key, mapping):
+        self.sets.setdefault(key, {}).update(mapping)
+
+    async def zrem(self, key, *members):
+        for member in members:
+            self.sets.get(key, {}).pop(member, None)
+
+
+@mock.patch.object(settings, "RULE_WINDOW_STORE", "redis")
+@mock.patch("connections.connections.redis")
+class TestRedisWindows(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.payloads = _payloads()
+        self.user_ids = sorted({p.user_id for p in self.payloads})
+
+    async def _counted_in_mongo(self, payloads):
+        db = AsyncMongoMockClient()["tests"]
+        store = ReplayStore()
+        with mock.patch.object(settings, "RULE_WINDOW_COUNTERS_ENABLED", False):
+            for payload in payloads:
+                await NewTransaction(transaction=payload, database=db, redis=store)()
+        return await _verdicts(db)
+
+    async def _ingest(self, db, store, payloads):
+        for start in range(0, len(payloads), 10):
+            await asyncio.gather(
+                *[
+                    NewTransaction(transaction=payload, database=db, redis=store)()
+                    for payload in payloads[start : start + 10]
+                ]
+            )
+
+    async def test_windows_count_like_mongo(self, _redis):
+        db = AsyncMongoMockClient()["tests"]
+        store = WindowStore()
+        with mock.patch.object(
+            TransactionRepository,
+            "get_latest_in_windows",
+            autospec=True,
+            side_effect=TransactionRepository.get_latest_in_windows,
+        ) as _latest:
+            await self._ingest(db, store, self.payloads)
+
+        self.assertEqual(
+            await _verdicts(db), await self._counted_in_mongo(self.payloads)
+        )
+        # Mongo was only read to load each user's windows, by the first few
+        # of their transactions that came in together
+        loaded = [call.kwargs["user_id"] for call in _latest.call_args_list]
+        self.assertEqual(sorted(set(loaded)), self.user_ids)
+        self.assertLessEqual(len(loaded), 10)
+
+    async def test_flushed_windows_are_loaded_from_mongo(self, _redis):
+        db = AsyncMongoMockClient()["tests"]
+        half = len(self.payloads) // 2
+        store = WindowStore()
+        await self._ingest(db, store, self.payloads[:half])
+
+        # The windows are gone, the next transaction of each user loads them
+        # again. The flags are kept, losing them changes verdicts whichever
+        # way the windows are counted
+        flushed = WindowStore()
+        flushed._values = store._values
+        await self._ingest(db, flushed, self.payloads[half : half + 50])
+
+        # Or they're all loaded up front
+        rebuilt = WindowStore()
+        rebuilt._values = store._values
+        windows = redis_windows_for(PLAN.windows, rebuilt)
+        await windows.rebuild(
+            TransactionRepository(db=db),
+            self.user_ids,
+            at=self.payloads[half + 50].timestamp,
+        )
+        with mock.patch.object(
+            TransactionRepository, "get_latest_in_windows"
+        ) as _latest:
+            await self._ingest(db, rebuilt, self.payloads[half + 50 :])
+        _latest.assert_not_called()
+
+        self.assertEqual(
+            await _verdicts(db), await self._counted_in_mongo(self.payloads)
+        )
+
+    async def test_batches_and_late_transactions(self, _redis):
+        db = AsyncMongoMockClient()["tests"]
+        store = WindowStore()
+        half = len(self.payloads) // 2
+        await self._ingest(db, store, self.payloads[:10])
+        # Written in a batch, so added to the windows after being written
+        await NewTransactionBatch(
+            transactions=self.payloads[10:half], database=db, redis=store
+        ).create()
+
+        # Older than what's kept once the windows have been trimmed, counted
+        # in Mongo instead
+        last = self.payloads[half - 1]
+        late = [
+            NewTransactionPayload(
+                **{
+                    **last.model_dump(),
+                    "amount": 10.0,
+                    "timestamp": last.timestamp - datetime.timedelta(minutes=m),
+                }
+            )
+            for m in [130, 125, 120]
+        ]
+        with mock.patch.object(settings, "RULE_WINDOW_REDIS_LATE_SECONDS", 0):
+            await self._ingest(db, store, self.payloads[half:] + late)
+
+        self.assertEqual(
+            await _verdicts(db),
+            await self._counted_in_mongo(self.payloads + late),
+        )
+
+    async def test_replays_leave_the_windows_alone(self, _redis):
+        db = AsyncMongoMockClient()["tests"]
+        # The replay's own store has no windows to add to, nor does it need
+        # them, and the live Redis isn't touched
+        await ReplayTransactions(transactions=self.payloads, database=db)()
+        self.assertEqual(_redis.mock_calls, [])
+
+        self.assertEqual(
+            await _verdicts(db), await self._counted_in_mongo(self.payloads)
+        )
@@ -0,0 +1,126 @@
+import datetime
+import random
+import unittest
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+
+from benchmarks.synthetic import SyntheticStream
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from repositories.transaction_repository import TransactionRepository
+from services.rules.process_rules import ProcessRules
+from services.rules.rule_plan import DEFAULT_RULE_SET, RulePlan, encode_flag
+from services.rules.window_counters import WindowCounters
+from services.transaction.new_transaction import NewTransaction
+from services.transaction.replay_transactions import ReplayStore, ReplayTransactions
+
+PLAN = RulePlan(DEFAULT_RULE_SET)
+RAPID_TRANSFERS_RULE = PLAN.window_of(PLAN.windowed_rules[1])
+
+# Long enough ago that the clock can't be what decides the windows
+END = datetime.datetime(2020, 3, 1, 12, 0)
+
+
+def _payloads(count: int = 300):
+    stream = SyntheticStream(
+        users=5, interval_seconds=30, small_fraction=0.6, end=END, seed=7
+    )
+    return [NewTransactionPayload(**t) for t in stream.transactions(count)]
+
+
+async def _verdicts(db):
+    transactions = await db["transaction"].find().to_list(None)
+    return sorted(
+        (t["user_id"], t["timestamp"], t["amount"], tuple(t["suspicious_reasons"]))
+        for t in transactions
+    )
+
+
+class TestReplay(unittest.IsolatedAsyncioTestCase):
+
+    @mock.patch("connections.connections.redis")
+    async def test_replay_matches_live_ingestion(self, _redis):
+        payloads = _payloads()
+
+        live_db = AsyncMongoMockClient()["tests"]
+        live_store = ReplayStore()
+        for payload in payloads:
+            await NewTransaction(
+                transaction=payload, database=live_db, redis=live_store
+            )()
+
+        # Out of order and in batches, it's the timestamps that count
+        shuffled = list(payloads)
+        random.Random(3).shuffle(shuffled)
+        replay_db = AsyncMongoMockClient()["tests"]
+        result = await ReplayTransactions(
+            transactions=shuffled, database=replay_db, batch_size=64
+        )()
+
+        live = await _verdicts(live_db)
+        self.assertEqual(await _verdicts(replay_db), live)
+        self.assertEqual(result["transactions"], len(payloads))
+        self.assertEqual(result["suspicious"], sum(1 for v in live if v[3]))
+        # Both windowed rules fired and flags ran out inside the replay
+        reasons = {reason for v in live for reason in v[3]}
+        self.assertIn("FREQUENT_SMALL_TRANSACTIONS", reasons)
+        self.assertIn("RAPID_TRANSFERS", reasons)
+        _redis.mget.assert_not_called()
+
+    async def test_flags_hold_only_within_their_range(self):
+        db = AsyncMongoMockClient()["tests"]
+        store = ReplayStore()
+        await store.set(
+            "rapid_transfersuser1234",
+            encode_flag((END, END + datetime.timedelta(minutes=5))),
+        )
+
+        async def reasons(minutes: int):
+            return await ProcessRules(
+                transaction=NewTransactionPayload(
+                    user_id="user1234",
+                    amount="500",
+                    currency="USD",
+                    timestamp=END + datetime.timedelta(minutes=minutes),
+                    type="DEPOSIT",
+                ),
+                database=db,
+                redis=store,
+            )()
+
+        self.assertEqual(await reasons(-1), [])
+        self.assertEqual(await reasons(2), ["RAPID_TRANSFERS"])
+        self.assertEqual(await reasons(5), [])
+
+    async def test_late_transactions_are_counted_in_mongo(self):
+        db = AsyncMongoMockClient()["tests"]
+        repo = TransactionRepository(db=db)
+        for minutes in [0, 1, 2, 10]:
+            await db["transaction"].insert_one(
+                {
+                    "user_id": "user1234",
+                    "amount": 200.0,
+                    "currency": "USD",
+                    "timestamp": END + datetime.timedelta(minutes=minutes),
+                    "type": "TRANSFER",
+                }
+            )
+        counters = WindowCounters(rules=PLAN.windows)
+
+        at = END + datetime.timedelta(minutes=11)
+        self.assertEqual(
+            await counters.count(repo, "user1234", RAPID_TRANSFERS_RULE, at), 1
+        )
+        with mock.patch.object(
+            repo, "get_latest_in_windows", side_effect=repo.get_latest_in_windows
+        ) as _latest:
+            # Older than what's held for the user, so it has to go to Mongo
+            late = END + datetime.timedelta(minutes=3)
+            self.assertEqual(
+                await counters.count(repo, "user1234", RAPID_TRANSFERS_RULE, late), 2
+            )
+            self.assertEqual(_latest.call_count, 1)
+            self.assertEqual(
+                await counters.count(repo, "user1234", RAPID_TRANSFERS_RULE, at), 1
+            )
+            self.assertEqual(_latest.call_count, 1)
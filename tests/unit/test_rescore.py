@@ -0,0 +1,119 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+
+from models.db.rule_model import RuleSetModel
+from services.rules.rule_engine import rule_engine
+from services.rules.rule_plan import DEFAULT_RULE_SET, RulePlan
+from services.transaction.replay_transactions import ReplayStore, ReplayTransactions
+from services.transaction.rescore_transactions import (
+    RescoreJob,
+    RescoreTransactions,
+)
+from services.transaction.risk_summary import GetRiskSummary, RebuildRiskSummaries
+from services.transaction.suspicious_transactions_cache import (
+    SuspiciousTransactionsCache,
+)
+from tests.unit.test_replay import _payloads, _verdicts
+from tests.unit.test_risk_summary import _rounded
+
+# Rapid transfers from the second transfer rather than the third
+CHANGED_RULE_SET = RuleSetModel(
+    rules=[
+        *DEFAULT_RULE_SET.rules[:2],
+        DEFAULT_RULE_SET.rules[2].model_copy(update={"threshold": 1}),
+    ]
+)
+
+
+async def _replayed(rule_set: RuleSetModel):
+    db = AsyncMongoMockClient()["tests"]
+    with mock.patch.object(rule_engine, "plan", RulePlan(rule_set)):
+        await ReplayTransactions(transactions=_payloads(), database=db)()
+    return db
+
+
+@mock.patch("connections.connections.redis")
+class TestRescore(unittest.IsolatedAsyncioTestCase):
+
+    async def test_rescoring_matches_ingesting_with_the_new_rules(self, _redis):
+        db = await _replayed(DEFAULT_RULE_SET)
+
+        unchanged = await RescoreJob(rule_set=DEFAULT_RULE_SET, database=db)()
+        self.assertEqual(unchanged["scanned"], 300)
+        self.assertEqual(unchanged["updated"], 0)
+
+        changed = await RescoreJob(
+            rule_set=CHANGED_RULE_SET, database=db, users_per_range=2
+        )()
+        self.assertEqual(changed["ranges"], 3)
+        self.assertEqual(changed["scanned"], 300)
+        self.assertGreater(changed["updated"], 0)
+        self.assertEqual(
+            await _verdicts(db), await _verdicts(await _replayed(CHANGED_RULE_SET))
+        )
+
+    async def test_resumes_from_the_checkpoint(self, _redis):
+        db = await _replayed(DEFAULT_RULE_SET)
+        rescore = RescoreTransactions.__call__
+        calls = []
+
+        async def fail_second_range(self):
+            calls.append(self.from_user)
+            if calls == [None, self.from_user]:
+                raise RuntimeError("Worker lost")
+            return await rescore(self)
+
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, "rescore.json")
+            job = RescoreJob(
+                rule_set=CHANGED_RULE_SET,
+                database=db,
+                checkpoint=checkpoint,
+                users_per_range=2,
+            )
+            with mock.patch.object(
+                RescoreTransactions, "__call__", fail_second_range
+            ), self.assertRaises(RuntimeError):
+                await job()
+
+            # Only the ranges that didn't finish are run again
+            with mock.patch.object(RescoreTransactions, "__call__", fail_second_range):
+                result = await job()
+            # The first range isn't run again
+            self.assertEqual(len(calls), 4)
+            self.assertNotIn(None, calls[2:])
+            self.assertEqual(result["scanned"], 300)
+
+            with self.assertRaises(ValueError):
+                await RescoreJob(
+                    rule_set=DEFAULT_RULE_SET, database=db, checkpoint=checkpoint
+                )()
+
+        self.assertEqual(
+            await _verdicts(db), await _verdicts(await _replayed(CHANGED_RULE_SET))
+        )
+
+    async def test_changed_users_are_brought_up_to_date(self, _redis):
+        db = await _replayed(DEFAULT_RULE_SET)
+        await RebuildRiskSummaries(database=db)()
+        user_ids = sorted({p.user_id for p in _payloads()})
+        cache = SuspiciousTransactionsCache(redis=ReplayStore())
+        for user_id in user_ids:
+            await cache.set(user_id, 0, b"[]")
+
+        await RescoreTransactions(
+            plan=RulePlan(CHANGED_RULE_SET), database=db, cache=cache
+        )()
+
+        expected = await _replayed(CHANGED_RULE_SET)
+        for user_id in user_ids:
+            self.assertEqual(
+                _rounded(await GetRiskSummary(user_id=user_id, database=db)()),
+                _rounded(await GetRiskSummary(user_id=user_id, database=expected)()),
+            )
+            # Every user has a verdict changed by the new rules
+            self.assertIsNone((await cache.get(user_id))[1])
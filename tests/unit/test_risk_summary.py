@@ -0,0 +1,95 @@
+import unittest
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+
+from services.transaction.new_transaction import NewTransaction
+from services.transaction.replay_transactions import ReplayStore, ReplayTransactions
+from services.transaction.risk_summary import GetRiskSummary, RebuildRiskSummaries
+from tests.unit.test_replay import _payloads
+
+
+def _rounded(summary) -> dict:
+    # Sums of the same amounts in a different order can differ in the last bit
+    summary = summary.model_dump(by_alias=True)
+    for totals in [summary, *summary["days"].values()]:
+        totals["flagged_volume"] = {
+            currency: round(volume, 6)
+            for currency, volume in totals["flagged_volume"].items()
+        }
+    return summary
+
+
+@mock.patch("connections.connections.redis")
+class TestRiskSummary(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.db = AsyncMongoMockClient()["tests"]
+        self.payloads = _payloads()
+        self.user_ids = sorted({p.user_id for p in self.payloads})
+
+    async def _summaries(self):
+        return {
+            user_id: _rounded(await GetRiskSummary(user_id=user_id, database=self.db)())
+            for user_id in self.user_ids
+        }
+
+    async def test_summaries_count_the_suspicious_transactions(self, _redis):
+        # Half one at a time, half in batches
+        half = len(self.payloads) // 2
+        store = ReplayStore()
+        for payload in self.payloads[:half]:
+            await NewTransaction(transaction=payload, database=self.db, redis=store)()
+        await ReplayTransactions(
+            transactions=self.payloads[half:], database=self.db, batch_size=32
+        )()
+
+        transactions = await self.db["transaction"].find().to_list(None)
+        summaries = await self._summaries()
+        for user_id, summary in summaries.items():
+            suspicious = [
+                t
+                for t in transactions
+                if t["user_id"] == user_id and t["is_suspicious"]
+            ]
+            self.assertEqual(summary["suspicious_transactions"], len(suspicious))
+            self.assertAlmostEqual(
+                sum(summary["flagged_volume"].values()),
+                sum(t["amount"] for t in suspicious),
+                places=6,
+            )
+            self.assertEqual(
+                sum(day["suspicious_transactions"] for day in summary["days"].values()),
+                len(suspicious),
+            )
+            for reason, count in summary["reasons"].items():
+                self.assertEqual(
+                    count,
+                    len([t for t in suspicious if reason in t["suspicious_reasons"]]),
+                )
+        self.assertGreater(
+            sum(s["suspicious_transactions"] for s in summaries.values()), 0
+        )
+
+        # Rebuilding from the transactions gives the same summaries, and drops
+        # ones for users with nothing suspicious left
+        await self.db["user_risk_summary"].update_many(
+            {}, {"$inc": {"suspicious_transactions": 5}}
+        )
+        await self.db["user_risk_summary"].insert_one(
+            {"_id": "nobody", "suspicious_transactions": 1}
+        )
+        result = await RebuildRiskSummaries(database=self.db, batch_size=2)()
+
+        self.assertEqual(await self._summaries(), summaries)
+        self.assertEqual(result["users"], len(summaries))
+        self.assertEqual(result["deleted"], 1)
+
+    async def test_unknown_users_have_an_empty_summary(self, _redis):
+        summary = await GetRiskSummary(user_id="nobody", database=self.db)()
+
+        self.assertEqual(
+            summary.to_json_bytes(),
+            b'{"user_id":"nobody","suspicious_transactions":0,"flagged_volume":{},'
+            b'"reasons":{},"days":{}}',
+        )
@@ -0,0 +1,172 @@
+import datetime
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+from pydantic import ValidationError
+
+from config import Settings
+from models.db.rule_model import RuleModel, RuleSetModel, TransactionFilter
+from models.db.transaction_model import SuspiciousReasonsType
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from repositories.rule_repository import RuleRepository
+from repositories.transaction_repository import TransactionRepository
+from services.rules.process_rules import ProcessRules, settings
+from services.rules.rule_engine import RuleEngine
+from services.rules.rule_plan import DEFAULT_RULE_SET, RulePlan
+
+
+def _windowed_rule(name: str, threshold: int, **filter) -> RuleModel:
+    return RuleModel(
+        name=name,
+        reason=SuspiciousReasonsType.FREQUENT_SMALL_TRANSACTIONS,
+        filter=TransactionFilter(**filter),
+        window_minutes=60,
+        threshold=threshold,
+    )
+
+
+class TestRuleEngine(unittest.IsolatedAsyncioTestCase):
+
+    def test_rules_sharing_a_window_share_a_count(self):
+        plan = RulePlan(
+            RuleSetModel(
+                rules=[
+                    _windowed_rule("small_a", 4, amount_lte=100),
+                    _windowed_rule("small_b", 6, amount_lte=100),
+                    _windowed_rule("small_usd", 2, amount_lte=100, currencies=["USD"]),
+                    _windowed_rule("any", 0),
+                ]
+            )
+        )
+
+        self.assertEqual(len(plan.windows), 2)
+        self.assertIs(plan.window_of(plan.rules[0]), plan.window_of(plan.rules[1]))
+        self.assertEqual(plan.window_of(plan.rules[1]).threshold, 6)
+        self.assertIsNone(plan.window_of(plan.rules[3]))
+
+        now = datetime.datetime.utcnow()
+        reasons, fired = plan.evaluate(
+            50, "DEPOSIT", "GBP", set(), {plan.windows[0].name: [now] * 5}
+        )
+        self.assertEqual(reasons, [SuspiciousReasonsType.FREQUENT_SMALL_TRANSACTIONS])
+        self.assertEqual([rule.name for rule in fired], ["small_a", "any"])
+
+    def test_invalid_rules_are_rejected(self):
+        with self.assertRaises(ValidationError):
+            RuleModel(name="x", reason="RAPID_TRANSFERS", threshold=2)
+        with self.assertRaises(ValidationError):
+            RuleSetModel(rules=[_windowed_rule("x", 1), _windowed_rule("x", 2)])
+
+    @mock.patch("connections.connections.redis")
+    async def test_more_rules_dont_add_round_trips(self, _redis):
+        rules = [
+            _windowed_rule(f"rule{i}", i + 1, amount_lte=100 * i) for i in range(10)
+        ]
+        plan = RulePlan(RuleSetModel(rules=rules))
+        _redis.mget.return_value = [None] * 10
+        db = AsyncMongoMockClient()["tests"]
+        for _ in range(3):
+            await db["transaction"].insert_one(
+                {
+                    "user_id": "user1234",
+                    "amount": 50.0,
+                    "currency": "USD",
+                    "timestamp": datetime.datetime.utcnow(),
+                    "type": "DEPOSIT",
+                }
+            )
+
+        with mock.patch.object(
+            settings, "RULE_WINDOW_COUNTERS_ENABLED", False
+        ), mock.patch.object(
+            TransactionRepository,
+            "get_latest_in_windows",
+            side_effect=TransactionRepository.get_latest_in_windows,
+            autospec=True,
+        ) as _count:
+            process_rules = ProcessRules(
+                transaction=NewTransactionPayload(
+                    user_id="user1234",
+                    amount="50",
+                    currency="USD",
+                    timestamp=datetime.datetime.utcnow(),
+                    type="DEPOSIT",
+                ),
+                database=db,
+                plan=plan,
+            )
+            reasons = await process_rules()
+
+        _redis.mget.assert_awaited_once()
+        _count.assert_called_once()
+        # rule1 and rule2 need 2 and 3 earlier transactions and there are 3
+        self.assertEqual(reasons, [SuspiciousReasonsType.FREQUENT_SMALL_TRANSACTIONS])
+        self.assertEqual(
+            sorted(call.args[0] for call in _redis.set.await_args_list),
+            ["rule1user1234", "rule2user1234"],
+        )
+
+    async def test_reloads_from_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "rules.json")
+            engine = RuleEngine(Settings(RULES_SOURCE="file", RULES_FILE=path))
+            with open(path, "w") as f:
+                f.write(DEFAULT_RULE_SET.model_dump_json())
+
+            self.assertTrue(await engine.load())
+            self.assertFalse(await engine.load())
+            default_plan = engine.plan
+
+            rule_set = json.loads(DEFAULT_RULE_SET.model_dump_json())
+            rule_set["rules"][2]["threshold"] = 3
+            with open(path, "w") as f:
+                json.dump(rule_set, f)
+            os.utime(path, ns=(0, 1))
+            self.assertTrue(await engine.load())
+            self.assertIsNot(engine.plan, default_plan)
+            self.assertEqual(engine.plan.windows[1].threshold, 3)
+
+            # Broken rules leave the loaded ones in place
+            plan = engine.plan
+            with open(path, "w") as f:
+                f.write('{"rules": [{"name": "x"}]}')
+            os.utime(path, ns=(0, 2))
+            with self.assertRaises(ValidationError):
+                await engine.load()
+            self.assertIs(engine.plan, plan)
+
+    async def test_reloads_from_mongo_when_version_changes(self):
+        db = AsyncMongoMockClient()["tests"]
+        engine = RuleEngine(Settings(RULES_SOURCE="mongo"))
+        self.assertFalse(await engine.load(db))
+        self.assertEqual(len(engine.plan.rules), 3)
+
+        rule_repo = RuleRepository(db=db)
+        saved = await rule_repo.save_rules(DEFAULT_RULE_SET.rules[:1])
+        self.assertEqual(saved.version, 1)
+        self.assertTrue(await engine.load(db))
+        self.assertEqual(engine.plan.version, 1)
+        self.assertEqual(engine.plan.rules, DEFAULT_RULE_SET.rules[:1])
+        self.assertEqual(engine.plan.windows, [])
+        self.assertFalse(await engine.load(db))
+
+        await rule_repo.save_rules(DEFAULT_RULE_SET.rules)
+        self.assertTrue(await engine.load(db))
+        self.assertEqual(engine.plan.version, 2)
+        self.assertEqual(len(engine.plan.windows), 2)
+
+    async def test_shipped_rules_file_matches_the_defaults(self):
+        engine = RuleEngine(
+            Settings(
+                RULES_SOURCE="file",
+                RULES_FILE=os.path.join(
+                    os.path.dirname(__file__), "..", "..", "rules.json"
+                ),
+            )
+        )
+        await engine.load()
+        self.assertEqual(engine.plan.rules, DEFAULT_RULE_SET.rules)
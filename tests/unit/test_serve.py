@@ -0,0 +1,93 @@
+import io
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+from fastapi.responses import JSONResponse
+
+from commands import ingest_worker
+from commands.serve import worker_count
+from config import Settings
+from connections import Connections
+from main import remodemo_app
+from routers.responses import FastJSONResponse
+
+
+class TestServe(unittest.IsolatedAsyncioTestCase):
+
+    def test_responses_render_like_json_response(self):
+        content = {
+            "user_id": "usér1234",
+            "amount": 10.5,
+            "suspicious_reasons": ["RAPID_TRANSFERS"],
+            "next": None,
+        }
+
+        self.assertEqual(FastJSONResponse(content).body, JSONResponse(content).body)
+        self.assertIs(remodemo_app().router.default_response_class, FastJSONResponse)
+
+    def test_children_make_their_own_clients(self):
+        connections = Connections(
+            settings=Settings(), mongo_client=mock.Mock(), redis=mock.Mock()
+        )
+        parent_redis = connections.redis
+
+        connections.after_fork()
+
+        self.assertIsNone(connections._mongo_client)
+        self.assertIsNone(connections._redis)
+        parent_redis.aclose.assert_not_called()
+
+    def test_worker_count(self):
+        shared = Settings(
+            RULE_WINDOW_STORE="redis", USER_LOCKS="redis", SUSPICIOUS_FEED="redis"
+        )
+        self.assertEqual(worker_count(3, shared), 3)
+        self.assertGreaterEqual(worker_count(0, shared), 1)
+
+    def test_process_local_state_runs_one_worker(self):
+        for local in (
+            Settings(
+                RULE_WINDOW_STORE="process", USER_LOCKS="redis", SUSPICIOUS_FEED="off"
+            ),
+            Settings(
+                RULE_WINDOW_STORE="redis", USER_LOCKS="process", SUSPICIOUS_FEED="off"
+            ),
+            Settings(
+                RULE_WINDOW_STORE="redis", USER_LOCKS="redis", SUSPICIOUS_FEED="process"
+            ),
+        ):
+            with redirect_stdout(io.StringIO()):
+                self.assertEqual(worker_count(0, local), 1)
+            self.assertEqual(worker_count(1, local), 1)
+            with self.assertRaises(SystemExit):
+                worker_count(4, local)
+        # Windows counted in Mongo are shared already
+        self.assertEqual(
+            worker_count(
+                4,
+                Settings(
+                    RULE_WINDOW_COUNTERS_ENABLED=False,
+                    USER_LOCKS="redis",
+                    SUSPICIOUS_FEED="off",
+                ),
+            ),
+            4,
+        )
+
+    async def test_ingest_workers_need_shared_state(self):
+        shared = {
+            "RULE_WINDOW_STORE": "redis",
+            "USER_LOCKS": "redis",
+            "SUSPICIOUS_FEED": "redis",
+        }
+        for name in shared:
+            with mock.patch.multiple(
+                ingest_worker.settings, **{**shared, name: "process"}
+            ), mock.patch.object(
+                ingest_worker.rule_engine, "start"
+            ) as _start, self.assertRaises(
+                SystemExit
+            ):
+                await ingest_worker.main(workers=1, consumer="test")
+            _start.assert_not_called()
@@ -0,0 +1,292 @@
+import asyncio
+import datetime
+import json
+import unittest
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+
+from models.db.transaction_model import (
+    SuspiciousReasonsType,
+    TransactionModel,
+    TransactionType,
+)
+from services.transaction.get_suspicious_transactions import GetSuspiciousTransactions
+from services.transaction.new_transaction import NewTransaction
+from services.transaction.new_transaction_batch import NewTransactionBatch
+from services.transaction.replay_transactions import ReplayStore, ReplayTransactions
+from services.transaction.suspicious_feed import SuspiciousFeed
+from tests.unit.conftest import PipelineStore
+from tests.unit.test_replay import END, _payloads
+
+
+class FeedStore(PipelineStore):
+    """
+    The stream commands the feed uses, with XREAD blocking until something is
+    added or `block` runs out.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.entries = []
+        self._sequence = 0
+        self._added = asyncio.Condition()
+
+    async def xadd(self, stream, fields, maxlen=None, approximate=True):
+        self._sequence += 1
+        id = f"1700000000000-{self._sequence}".encode()
+        self.entries.append(
+            (id, {name.encode(): _bytes(value) for name, value in fields.items()})
+        )
+        if maxlen is not None:
+            del self.entries[:-maxlen]
+        async with self._added:
+            self._added.notify_all()
+        return id
+
+    def _after(self, last):
+        return [e for e in self.entries if _order(e[0]) > _order(last)]
+
+    async def xrange(self, stream, min="-", max="+", count=None):
+        entries = [e for e in self.entries if min == "-" or _order(e[0]) >= _order(min)]
+        return entries[:count]
+
+    async def xrevrange(self, stream, max="+", min="-", count=None):
+        return self.entries[::-1][:count]
+
+    async def xread(self, streams, count=None, block=None):
+        [(stream, last)] = streams.items()
+        async with self._added:
+            try:
+                await asyncio.wait_for(
+                    self._added.wait_for(lambda: self._after(last)), block / 1000
+                )
+            except asyncio.TimeoutError:
+                return []
+        return [[stream.encode(), self._after(last)[:count]]]
+
+
+def _bytes(value) -> bytes:
+    return value if isinstance(value, bytes) else str(value).encode()
+
+
+def _order(id):
+    id = id.decode() if isinstance(id, bytes) else id
+    return tuple(int(part) for part in id.split("-"))
+
+
+def _transactions(count: int, user_id: str = "user1234"):
+    return [
+        TransactionModel(
+            user_id=user_id,
+            amount=20_000.0 + i,
+            currency="USD",
+            timestamp=END + datetime.timedelta(seconds=i),
+            type=TransactionType.DEPOSIT,
+            is_suspicious=True,
+            suspicious_reasons=[SuspiciousReasonsType.HIGH_VOLUME_TRANSACTION],
+        )
+        for i in range(count)
+    ]
+
+
+async def _collect(feed, subscription, count=None, released=None, into=None):
+    # Events until `count`, or until the subscription ends. Waits for
+    # `released` after the first one, like a subscriber that's stopped reading.
+    events = [] if into is None else into
+    async for event in feed.events(subscription, heartbeat_seconds=0.05):
+        if event is None:
+            continue
+        events.append(event)
+        if released is not None and len(events) == 1:
+            await released.wait()
+        if len(events) == count:
+            break
+    return events
+
+
+async def _subscribed(feed, count: int):
+    while feed.subscribers < count:
+        await asyncio.sleep(0.01)
+
+
+def _amounts(events) -> list:
+    return [json.loads(e.data)["amount"] for e in events]
+
+
+@mock.patch("connections.connections.redis")
+class TestSuspiciousFeed(unittest.IsolatedAsyncioTestCase):
+
+    async def test_new_suspicious_transactions_are_published(self, _redis):
+        db = AsyncMongoMockClient()["tests"]
+        feed = SuspiciousFeed(mode="process")
+        payloads = _payloads()
+        user_id = payloads[0].user_id
+        everyone, one_user = [], []
+        collecting = [
+            asyncio.create_task(_collect(feed, feed.subscribe(), into=everyone)),
+            asyncio.create_task(
+                _collect(feed, feed.subscribe(user_ids=[user_id]), into=one_user)
+            ),
+        ]
+        await _subscribed(feed, 2)
+
+        store = ReplayStore()
+        half = len(payloads) // 2
+        for payload in payloads[:half]:
+            await NewTransaction(
+                transaction=payload, database=db, redis=store, feed=feed
+            )()
+        await NewTransactionBatch(
+            transactions=payloads[half:], database=db, redis=store, feed=feed
+        ).create()
+        await asyncio.sleep(0.05)
+        for task in collecting:
+            task.cancel()
+        await asyncio.gather(*collecting, return_exceptions=True)
+        self.assertEqual(feed.subscribers, 0)
+
+        # A page, which is read past the (mocked) cache
+        suspicious = {
+            user: json.loads(
+                await GetSuspiciousTransactions(
+                    user_id=user, database=db, limit=1000
+                ).as_json()
+            )
+            for user in {p.user_id for p in payloads}
+        }
+        self.assertTrue(suspicious[user_id])
+        self.assertEqual(
+            sorted(json.loads(e.data)["id"] for e in everyone),
+            sorted(t["id"] for ts in suspicious.values() for t in ts),
+        )
+        self.assertEqual([json.loads(e.data) for e in one_user], suspicious[user_id])
+
+    async def test_replays_publish_nothing(self, _redis):
+        db = AsyncMongoMockClient()["tests"]
+        feed = SuspiciousFeed(mode="process")
+        events = []
+        collecting = asyncio.create_task(_collect(feed, feed.subscribe(), into=events))
+        await _subscribed(feed, 1)
+
+        with mock.patch(
+            "services.transaction.new_transaction_batch.suspicious_feed", feed
+        ):
+            result = await ReplayTransactions(transactions=_payloads(), database=db)()
+        await asyncio.sleep(0.05)
+        collecting.cancel()
+        await asyncio.gather(collecting, return_exceptions=True)
+
+        self.assertGreater(result["suspicious"], 0)
+        self.assertEqual(events, [])
+
+    async def test_subscribers_receive_every_event(self, _redis):
+        feed = SuspiciousFeed(mode="process")
+        transactions = _transactions(5) + _transactions(3, user_id="other")
+        everyone = asyncio.create_task(_collect(feed, feed.subscribe(), count=8))
+        one_user = asyncio.create_task(
+            _collect(feed, feed.subscribe(user_ids=["other"]), count=3)
+        )
+        await _subscribed(feed, 2)
+
+        await feed.publish(transactions)
+        # Not suspicious, not sent
+        await feed.publish(
+            [_transactions(1)[0].model_copy(update={"is_suspicious": False})]
+        )
+
+        everyone, one_user = await asyncio.wait_for(
+            asyncio.gather(everyone, one_user), 1
+        )
+        self.assertEqual(_amounts(everyone), [t.amount for t in transactions])
+        self.assertEqual([e.id for e in everyone], [str(i) for i in range(1, 9)])
+        self.assertEqual(_amounts(one_user), [t.amount for t in transactions[5:]])
+        self.assertEqual(
+            everyone[0].to_server_sent_event(),
+            b"id: 1\nevent: transaction\ndata: "
+            + transactions[0].to_json_bytes()
+            + b"\n\n",
+        )
+        self.assertEqual(feed.subscribers, 0)
+
+    async def test_resuming_after_the_last_event(self, _redis):
+        feed = SuspiciousFeed(mode="process", backlog=5)
+        transactions = _transactions(10)
+        await feed.publish(transactions)
+
+        # Still in the backlog
+        events = await asyncio.wait_for(
+            _collect(feed, feed.subscribe(last_id="7"), count=3), 1
+        )
+        self.assertEqual([e.id for e in events], ["8", "9", "10"])
+
+        # Further back than the backlog, told so before the ones it has
+        resumed = asyncio.create_task(
+            _collect(feed, feed.subscribe(last_id="2"), count=7)
+        )
+        await _subscribed(feed, 1)
+        await feed.publish(_transactions(1))
+        events = await asyncio.wait_for(resumed, 1)
+        self.assertEqual(events[0].event, "gap")
+        self.assertEqual([e.id for e in events[1:]], ["6", "7", "8", "9", "10", "11"])
+
+        with self.assertRaises(ValueError):
+            feed.subscribe(last_id="not-an-id")
+
+    async def test_slow_subscribers_are_dropped(self, _redis):
+        feed = SuspiciousFeed(mode="process", buffer=2)
+        released = asyncio.Event()
+        slow = asyncio.create_task(_collect(feed, feed.subscribe(), released=released))
+        keeping_up = asyncio.create_task(_collect(feed, feed.subscribe(), count=6))
+        await _subscribed(feed, 2)
+
+        for transaction in _transactions(6):
+            await feed.publish([transaction])
+            await asyncio.sleep(0.01)
+        released.set()
+
+        slow, keeping_up = await asyncio.wait_for(asyncio.gather(slow, keeping_up), 1)
+        # The one it was holding, the two buffered, then told it was dropped
+        self.assertEqual([e.id for e in slow[:-1]], ["1", "2", "3"])
+        self.assertEqual(slow[-1].event, "dropped")
+        self.assertEqual([e.id for e in keeping_up], [str(i) for i in range(1, 7)])
+
+        # Reconnecting carries on from the last one it got
+        events = await asyncio.wait_for(
+            _collect(feed, feed.subscribe(last_id=slow[-2].id), count=3), 1
+        )
+        self.assertEqual([e.id for e in events], ["4", "5", "6"])
+
+    async def test_redis_feed_reaches_every_worker(self, _redis):
+        store = FeedStore()
+        writer = SuspiciousFeed(mode="redis", redis=store, backlog=4, block_ms=50)
+        reader = SuspiciousFeed(mode="redis", redis=store, backlog=4, block_ms=50)
+        transactions = _transactions(3)
+
+        live = asyncio.create_task(_collect(reader, reader.subscribe(), count=3))
+        await _subscribed(reader, 1)
+        await writer.publish(transactions)
+        events = await asyncio.wait_for(live, 1)
+        self.assertEqual(_amounts(events), [t.amount for t in transactions])
+        # No subscribers left, so the worker stops reading the stream
+        self.assertIsNone(reader._reader)
+
+        # Resumed on another worker
+        await writer.publish(_transactions(2))
+        events = await asyncio.wait_for(
+            _collect(writer, writer.subscribe(last_id=events[1].id), count=3), 1
+        )
+        self.assertEqual([_order(e.id)[1] for e in events], [3, 4, 5])
+
+        events = await asyncio.wait_for(
+            _collect(writer, writer.subscribe(last_id=events[0].id), count=2), 1
+        )
+        self.assertEqual([_order(e.id)[1] for e in events], [4, 5])
+
+        # The first is gone from the stream
+        events = await asyncio.wait_for(
+            _collect(reader, reader.subscribe(last_id="1700000000000-1"), count=5),
+            1,
+        )
+        self.assertEqual(events[0].event, "gap")
+        self.assertEqual([_order(e.id)[1] for e in events[1:]], [2, 3, 4, 5])
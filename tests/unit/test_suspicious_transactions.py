@@ -0,0 +1,106 @@
+import datetime
+import json
+import unittest
+
+from mongomock_motor import AsyncMongoMockClient
+
+from models.db.transaction_model import TransactionModel
+from repositories.transaction_repository import TransactionRepository
+from services.transaction.get_suspicious_transactions import GetSuspiciousTransactions
+
+
+class TestSuspiciousTransactions(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.db = AsyncMongoMockClient()["tests"]
+        now = datetime.datetime(2024, 11, 18, 13, 25, 49)
+        # Pairs share a timestamp so pages have to break ties on _id
+        await self.db["transaction"].insert_many(
+            [
+                {
+                    "user_id": "user1234",
+                    "amount": 10001.0,
+                    "currency": "USD",
+                    "timestamp": now
+                    + datetime.timedelta(seconds=i // 2, microseconds=i * 1001),
+                    "type": "DEPOSIT",
+                    "is_suspicious": i != 3,
+                    "suspicious_reasons": (
+                        ["HIGH_VOLUME_TRANSACTION"] if i != 3 else []
+                    ),
+                }
+                for i in range(7)
+            ]
+        )
+
+    async def test_pages_follow_on_from_the_cursor(self):
+        everything = await GetSuspiciousTransactions(
+            user_id="user1234", database=self.db
+        )()
+
+        pages = []
+        after = None
+        while True:
+            get_suspicious_transactions = GetSuspiciousTransactions(
+                user_id="user1234", database=self.db, limit=2, after=after
+            )
+            pages.append(await get_suspicious_transactions())
+            after = get_suspicious_transactions.next_cursor
+            if after is None:
+                break
+
+        self.assertEqual(len(everything), 6)
+        self.assertEqual([len(page) for page in pages], [2, 2, 2, 0])
+        self.assertEqual([t for page in pages for t in page], everything)
+
+    async def test_stream_writes_one_transaction_per_line(self):
+        everything = await GetSuspiciousTransactions(
+            user_id="user1234", database=self.db
+        )()
+
+        lines = [
+            line
+            async for line in GetSuspiciousTransactions(
+                user_id="user1234", database=self.db
+            ).stream()
+        ]
+
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(all(line.endswith(b"\n") for line in lines))
+        self.assertEqual(
+            [json.loads(line)["id"] for line in lines], [t["id"] for t in everything]
+        )
+
+    async def test_documents_serialize_like_the_models(self):
+        await self.db["transaction"].insert_one(
+            {
+                "user_id": "user1234",
+                "amount": 75.5,
+                "currency": "EUR",
+                "timestamp": datetime.datetime(2024, 11, 19),
+                "type": "TRANSFER",
+                "is_suspicious": True,
+                "suspicious_reasons": [
+                    "FREQUENT_SMALL_TRANSACTIONS",
+                    "RAPID_TRANSFERS",
+                ],
+                "idempotency_key": "left-out",
+            }
+        )
+        repo = TransactionRepository(db=self.db)
+
+        documents = await repo.get_suspicious_documents_for_user("user1234")
+        models = await repo.get_suspicious_transactions_for_user("user1234")
+
+        self.assertEqual(
+            TransactionModel.stored_list_to_json_bytes(documents),
+            TransactionModel.list_to_json_bytes(models),
+        )
+        self.assertEqual(
+            [TransactionModel.stored_to_json_dict(d) for d in documents],
+            [m.to_dict_json() for m in models],
+        )
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            GetSuspiciousTransactions(user_id="user1234", after="not-a-cursor")
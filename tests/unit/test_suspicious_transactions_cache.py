@@ -0,0 +1,102 @@
+import datetime
+import json
+import unittest
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from services.transaction.get_suspicious_transactions import GetSuspiciousTransactions
+from services.transaction.new_transaction import NewTransaction
+from services.transaction.suspicious_transactions_cache import (
+    SuspiciousTransactionsCache,
+)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.store = {}
+
+    async def get(self, key):
+        return self.store.get(key)
+
+    async def mget(self, *keys):
+        return [self.store.get(key) for key in keys]
+
+    async def set(self, key, value, ex=None):
+        self.store[key] = value
+
+    async def incr(self, key):
+        self.store[key] = int(self.store.get(key, 0)) + 1
+        return self.store[key]
+
+
+class TestSuspiciousTransactionsCache(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.db = AsyncMongoMockClient()["tests"]
+
+    async def _new_transaction(self, amount: str):
+        await NewTransaction(
+            transaction=NewTransactionPayload(
+                user_id="user1234",
+                amount=amount,
+                currency="USD",
+                timestamp=datetime.datetime.utcnow(),
+                type="DEPOSIT",
+            ),
+            database=self.db,
+        )()
+
+    async def _get(self, cache: SuspiciousTransactionsCache) -> list:
+        return json.loads(
+            await GetSuspiciousTransactions(
+                user_id="user1234", database=self.db, cache=cache
+            ).as_json()
+        )
+
+    async def test_read_through_and_invalidated_on_suspicious_insert(self):
+        cache = SuspiciousTransactionsCache(redis=self.redis)
+        other_worker = SuspiciousTransactionsCache(redis=self.redis)
+
+        with mock.patch("connections.connections.redis", self.redis), mock.patch(
+            "services.transaction.new_transaction.suspicious_transactions_cache",
+            cache,
+        ):
+            await self._new_transaction(amount="10001")
+            self.assertEqual(len(await self._get(cache)), 1)
+            self.assertEqual(len(await self._get(cache)), 1)
+            self.assertEqual(len(await self._get(other_worker)), 1)
+
+            # Not suspicious so the cached list is still right
+            await self._new_transaction(amount="500")
+            self.assertEqual(len(await self._get(cache)), 1)
+
+            await self._new_transaction(amount="10002")
+            self.assertEqual(len(await self._get(other_worker)), 2)
+            self.assertEqual(len(await self._get(cache)), 2)
+
+        self.assertEqual(
+            cache.stats(),
+            {
+                "hits_local": 2,
+                "hits_redis": 1,
+                "misses": 1,
+                "evictions": 0,
+                "invalidations": 2,
+                "entries": 1,
+            },
+        )
+        self.assertEqual(other_worker.hits_redis, 1)
+        self.assertEqual(other_worker.misses, 1)
+
+    async def test_least_recently_used_entries_are_evicted(self):
+        cache = SuspiciousTransactionsCache(redis=self.redis, max_entries=2)
+
+        for user_id in ["user1", "user2", "user1", "user3"]:
+            version, _ = await cache.get(user_id)
+            await cache.set(user_id, version, b"[]")
+
+        self.assertEqual(list(cache._local), ["user1", "user3"])
+        self.assertEqual(cache.evictions, 1)
@@ -1,7 +1,9 @@
 import datetime
+import json
 import unittest
 from unittest import mock
 
+from fastapi.encoders import jsonable_encoder
 from mongomock_motor import AsyncMongoMockClient
 
 from models.db.transaction_model import (
@@ -15,10 +17,10 @@ from services.transaction.new_transaction import NewTransaction
 
 class TestTransaction(unittest.IsolatedAsyncioTestCase):
 
-    @mock.patch("services.rules.process_rules.redis")
+    @mock.patch("connections.connections.redis")
     async def test_new_transaction(self, _redis):
         # Ignore caching for now
-        _redis.get.return_value = None
+        _redis.mget.return_value = [None, None]
 
         db = AsyncMongoMockClient()["tests"]
 
@@ -43,9 +45,9 @@ class TestTransaction(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(transaction_model.is_suspicious, False)
         self.assertEqual(transaction_model.suspicious_reasons, [])
 
-    @mock.patch("services.rules.process_rules.redis")
+    @mock.patch("connections.connections.redis")
     async def test_new_transaction_above_high_value(self, _redis):
-        _redis.get.return_value = None
+        _redis.mget.return_value = [None, None]
 
         db = AsyncMongoMockClient()["tests"]
 
@@ -73,9 +75,9 @@ class TestTransaction(unittest.IsolatedAsyncioTestCase):
             [SuspiciousReasonsType.HIGH_VOLUME_TRANSACTION],
         )
 
-    @mock.patch("services.rules.process_rules.redis")
+    @mock.patch("connections.connections.redis")
     async def test_new_transaction_under_high_value(self, _redis):
-        _redis.get.return_value = None
+        _redis.mget.return_value = [None, None]
 
         db = AsyncMongoMockClient()["tests"]
 
@@ -100,9 +102,9 @@ class TestTransaction(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(transaction_model.is_suspicious, False)
         self.assertEqual(transaction_model.suspicious_reasons, [])
 
-    @mock.patch("services.rules.process_rules.redis")
+    @mock.patch("connections.connections.redis")
     async def test_new_transaction_rapid_transfers(self, _redis):
-        _redis.get.return_value = None
+        _redis.mget.return_value = [None, None]
 
         db = AsyncMongoMockClient()["tests"]
 
@@ -144,9 +146,9 @@ class TestTransaction(unittest.IsolatedAsyncioTestCase):
             new_trans_model.suspicious_reasons, [SuspiciousReasonsType.RAPID_TRANSFERS]
         )
 
-    @mock.patch("services.rules.process_rules.redis")
+    @mock.patch("connections.connections.redis")
     async def test_new_transaction_frequent_small(self, _redis):
-        _redis.get.return_value = None
+        _redis.mget.return_value = [None, None]
 
         db = AsyncMongoMockClient()["tests"]
 
@@ -187,10 +189,10 @@ class TestTransaction(unittest.IsolatedAsyncioTestCase):
             [SuspiciousReasonsType.FREQUENT_SMALL_TRANSACTIONS],
         )
 
-    @mock.patch("services.rules.process_rules.redis")
+    @mock.patch("connections.connections.redis")
     async def test_new_transaction_frequent_small_cache(self, _redis):
         # Return True from the redis query
-        _redis.get.side_effect = [
+        _redis.mget.return_value = [
             True,
             False,
         ]  # Will return True for frequent small and False for rapid
@@ -214,9 +216,9 @@ class TestTransaction(unittest.IsolatedAsyncioTestCase):
             [SuspiciousReasonsType.FREQUENT_SMALL_TRANSACTIONS],
         )
 
-    @mock.patch("services.rules.process_rules.redis")
+    @mock.patch("connections.connections.redis")
     async def test_new_transaction_rapid_transactions_cache(self, _redis):
-        _redis.get.side_effect = [
+        _redis.mget.return_value = [
             False,
             True,
         ]  # Will return False for frequent small and True for rapid
@@ -240,9 +242,9 @@ class TestTransaction(unittest.IsolatedAsyncioTestCase):
             [SuspiciousReasonsType.RAPID_TRANSFERS],
         )
 
-    @mock.patch("services.rules.process_rules.redis")
+    @mock.patch("connections.connections.redis")
     async def test_multiple_suspicious_reasons(self, _redis):
-        _redis.get.return_value = None
+        _redis.mget.return_value = [None, None]
 
         db = AsyncMongoMockClient()["tests"]
 
@@ -286,3 +288,33 @@ class TestTransaction(unittest.IsolatedAsyncioTestCase):
                 SuspiciousReasonsType.RAPID_TRANSFERS,
             ],
         )
+
+    @mock.patch("connections.connections.redis")
+    async def test_new_transaction_matches_stored_document(self, _redis):
+        _redis.mget.return_value = [None, None]
+
+        db = AsyncMongoMockClient()["tests"]
+
+        new_transaction_payload = NewTransactionPayload(
+            user_id="user1234",
+            amount="10001",
+            currency="USD",
+            timestamp="2024-11-18T13:25:49.123456+01:00",
+            type="TRANSFER",
+        )
+
+        with mock.patch.object(db["transaction"].__class__, "find_one") as _find_one:
+            new_trans = await NewTransaction(
+                transaction=new_transaction_payload, database=db
+            ).create()
+            _find_one.assert_not_called()
+
+        stored = TransactionModel(**await db["transaction"].find_one())
+        self.assertEqual(new_trans, stored)
+        self.assertEqual(
+            new_trans.timestamp, datetime.datetime(2024, 11, 18, 12, 25, 49, 123000)
+        )
+        self.assertEqual(
+            json.loads(new_trans.to_json_bytes()),
+            json.loads(json.dumps(jsonable_encoder(stored.to_dict_json()))),
+        )
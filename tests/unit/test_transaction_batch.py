@@ -0,0 +1,121 @@
+import datetime
+import unittest
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+
+from models.db.transaction_model import SuspiciousReasonsType
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from services.transaction.new_transaction import NewTransaction
+from services.transaction.new_transaction_batch import NewTransactionBatch
+
+
+def _fake_redis(_redis):
+    # Keep flags between calls so the cached verdicts behave like redis would
+    store = {}
+    _redis.mget.side_effect = lambda *keys: [store.get(key) for key in keys]
+    _redis.set.side_effect = lambda key, value, ex=None: store.__setitem__(key, value)
+
+
+class TestTransactionBatch(unittest.IsolatedAsyncioTestCase):
+
+    def _payloads(self):
+        now = datetime.datetime.utcnow()
+        payloads = []
+        for i in range(6):
+            payloads.append(
+                NewTransactionPayload(
+                    user_id="user1234",
+                    amount="50",
+                    currency="USD",
+                    timestamp=now - datetime.timedelta(minutes=9 * (6 - i)),
+                    type="WITHDRAWAL",
+                )
+            )
+            payloads.append(
+                NewTransactionPayload(
+                    user_id="user5678",
+                    amount="10001" if i == 4 else "200",
+                    currency="USD",
+                    timestamp=now - datetime.timedelta(seconds=20 * (6 - i)),
+                    type="TRANSFER",
+                )
+            )
+        return payloads
+
+    @mock.patch("connections.connections.redis")
+    async def test_new_transaction_batch_matches_sequential(self, _redis):
+        _fake_redis(_redis)
+        sequential_db = AsyncMongoMockClient()["tests"]
+        sequential = []
+        for payload in self._payloads():
+            sequential.append(
+                await NewTransaction(transaction=payload, database=sequential_db)()
+            )
+
+        _fake_redis(_redis)
+        batch_db = AsyncMongoMockClient()["tests"]
+        batch = await NewTransactionBatch(
+            transactions=self._payloads(), database=batch_db
+        )()
+
+        self.assertEqual(len(batch), len(sequential))
+        for batch_item, sequential_item in zip(batch, sequential):
+            self.assertEqual(batch_item["user_id"], sequential_item["user_id"])
+            self.assertEqual(
+                batch_item["is_suspicious"], sequential_item["is_suspicious"]
+            )
+            self.assertEqual(
+                batch_item["suspicious_reasons"],
+                sequential_item["suspicious_reasons"],
+            )
+
+        self.assertEqual(
+            [r["suspicious_reasons"] for r in batch if r["user_id"] == "user1234"],
+            [[]] * 4 + [["FREQUENT_SMALL_TRANSACTIONS"]] * 2,
+        )
+        self.assertEqual(
+            await batch_db["transaction"].count_documents({}), len(self._payloads())
+        )
+
+    @mock.patch("connections.connections.redis")
+    async def test_new_transaction_batch_counts_existing_history(self, _redis):
+        _redis.mget.return_value = [None, None]
+
+        db = AsyncMongoMockClient()["tests"]
+        now = datetime.datetime.utcnow()
+
+        await NewTransaction(
+            transaction=NewTransactionPayload(
+                user_id="user1234",
+                amount="10000",
+                currency="USD",
+                timestamp=now - datetime.timedelta(seconds=40),
+                type="TRANSFER",
+            ),
+            database=db,
+        )()
+
+        batch = await NewTransactionBatch(
+            transactions=[
+                NewTransactionPayload(
+                    user_id="user1234",
+                    amount="10000",
+                    currency="USD",
+                    timestamp=now - datetime.timedelta(seconds=20 * (1 - i)),
+                    type="TRANSFER",
+                )
+                for i in range(2)
+            ],
+            database=db,
+        )()
+
+        self.assertEqual(batch[0]["is_suspicious"], False)
+        self.assertEqual(
+            batch[1]["suspicious_reasons"], [SuspiciousReasonsType.RAPID_TRANSFERS]
+        )
+
+    async def test_new_transaction_batch_empty(self):
+        db = AsyncMongoMockClient()["tests"]
+
+        self.assertEqual(await NewTransactionBatch(transactions=[], database=db)(), [])
@@ -0,0 +1,129 @@
+import asyncio
+import datetime
+import unittest
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from services.rules.process_rules import settings
+from services.transaction.new_transaction import NewTransaction
+from services.transaction.replay_transactions import ReplayStore
+from services.transaction.user_locks import (
+    NoUserLocks,
+    ProcessUserLocks,
+    RedisUserLocks,
+    UserLockTimeout,
+)
+
+USERS = ["user1", "user2", "user3"]
+PER_USER = 12
+
+
+class SlowStore(ReplayStore):
+    """
+    Gives way to other requests on every command, like a real round trip, and
+    supports what the Redis locks need.
+    """
+
+    async def mget(self, *keys):
+        await asyncio.sleep(0)
+        return await super().mget(*keys)
+
+    async def set(self, key, value, ex=None, px=None, nx=False):
+        await asyncio.sleep(0)
+        if nx and key in self._values:
+            return None
+        await super().set(key, value)
+        return True
+
+    async def eval(self, script, numkeys, key, token):
+        if self._values.get(key) == token.encode():
+            del self._values[key]
+            return 1
+        return 0
+
+
+def _payloads(step=datetime.timedelta(milliseconds=1)):
+    start = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+    return [
+        NewTransactionPayload(
+            user_id=user_id,
+            amount="50",
+            currency="USD",
+            timestamp=start + i * step,
+            type="TRANSFER",
+        )
+        for i in range(PER_USER)
+        for user_id in USERS
+    ]
+
+
+async def _ingest(payloads, locks_for, concurrently: bool):
+    db = AsyncMongoMockClient()["tests"]
+    store = SlowStore()
+    requests = [
+        NewTransaction(
+            transaction=payload, database=db, redis=store, locks=locks_for(i)
+        )()
+        for i, payload in enumerate(payloads)
+    ]
+    if concurrently:
+        return await asyncio.gather(*requests)
+    return [await request for request in requests]
+
+
+def _flags(results):
+    return [(t["user_id"], t["suspicious_reasons"]) for t in results]
+
+
+@mock.patch("connections.connections.redis")
+class TestUserLocks(unittest.IsolatedAsyncioTestCase):
+
+    async def test_concurrent_writes_count_exactly_with_process_locks(self, _redis):
+        payloads = _payloads()
+        sequential = await _ingest(payloads, lambda _: NoUserLocks(), False)
+        self.assertIn(
+            ["FREQUENT_SMALL_TRANSACTIONS", "RAPID_TRANSFERS"],
+            [t["suspicious_reasons"] for t in sequential],
+        )
+
+        # Without the locks every request counts before any of them writes
+        racing = await _ingest(payloads, lambda _: NoUserLocks(), True)
+        self.assertNotEqual(_flags(racing), _flags(sequential))
+
+        locks = ProcessUserLocks()
+        for counters_enabled in [True, False]:
+            with mock.patch.object(
+                settings, "RULE_WINDOW_COUNTERS_ENABLED", counters_enabled
+            ):
+                locked = await _ingest(payloads, lambda _: locks, True)
+            self.assertEqual(_flags(locked), _flags(sequential))
+        self.assertEqual(len(locks), 0)
+
+    async def test_redis_locks_serialize_across_workers(self, _redis):
+        # Polling Redis doesn't keep the order requests arrived in, so each
+        # user's transactions share a timestamp and only how many came first
+        # decides a verdict
+        payloads = _payloads(step=datetime.timedelta(0))
+        sequential = await _ingest(payloads, lambda _: NoUserLocks(), False)
+
+        # Two workers sharing a Redis, each with its own process locks
+        shared = SlowStore()
+        workers = [RedisUserLocks(redis=shared, poll_seconds=0.001) for _ in range(2)]
+        with mock.patch.object(settings, "RULE_WINDOW_COUNTERS_ENABLED", False):
+            locked = await _ingest(payloads, lambda i: workers[i % 2], True)
+
+        self.assertEqual(sorted(_flags(locked)), sorted(_flags(sequential)))
+        self.assertEqual(shared._values, {})
+
+    async def test_waiting_too_long_times_out(self, _redis):
+        locks = ProcessUserLocks(timeout_seconds=0.01)
+        async with locks.hold(["user1"]):
+            with self.assertRaises(UserLockTimeout):
+                async with locks.hold(["user2", "user1"]):
+                    pass
+            # Other users aren't held up
+            async with locks.hold(["user2"]):
+                pass
+        self.assertEqual(len(locks), 0)
@@ -0,0 +1,122 @@
+import datetime
+import unittest
+from unittest import mock
+
+from mongomock_motor import AsyncMongoMockClient
+
+from models.db.transaction_model import TransactionModel
+from models.payloads.new_transaction_payload import NewTransactionPayload
+from repositories.transaction_repository import TransactionRepository
+from services.rules.process_rules import get_window_counters
+from services.rules.rule_plan import DEFAULT_RULE_SET, RulePlan
+from services.rules.window_counters import WindowCounters
+from services.transaction.new_transaction import NewTransaction
+
+
+PLAN = RulePlan(DEFAULT_RULE_SET)
+WINDOW_RULES = PLAN.windows
+RAPID_TRANSFERS_RULE = PLAN.window_of(PLAN.windowed_rules[1])
+
+
+class TestWindowCounters(unittest.IsolatedAsyncioTestCase):
+
+    async def _insert_transfer(self, db, seconds_ago: int, user_id="user1234"):
+        await db["transaction"].insert_one(
+            {
+                "user_id": user_id,
+                "amount": 200.0,
+                "currency": "USD",
+                "timestamp": datetime.datetime.utcnow()
+                - datetime.timedelta(seconds=seconds_ago),
+                "type": "TRANSFER",
+                "is_suspicious": False,
+                "suspicious_reasons": [],
+            }
+        )
+
+    async def test_count_warms_from_mongo(self):
+        db = AsyncMongoMockClient()["tests"]
+        repo = TransactionRepository(db=db)
+        await self._insert_transfer(db, seconds_ago=30)
+        await self._insert_transfer(db, seconds_ago=60)
+        await self._insert_transfer(db, seconds_ago=600)  # Outside 5 minutes
+
+        counters = WindowCounters(rules=WINDOW_RULES)
+
+        self.assertEqual(
+            await counters.count(repo, "user1234", RAPID_TRANSFERS_RULE), 2
+        )
+        self.assertEqual(
+            await counters.count(repo, "user5678", RAPID_TRANSFERS_RULE), 0
+        )
+
+    async def test_record_updates_loaded_users_only(self):
+        db = AsyncMongoMockClient()["tests"]
+        repo = TransactionRepository(db=db)
+        counters = WindowCounters(rules=WINDOW_RULES)
+        self.assertEqual(
+            await counters.count(repo, "user1234", RAPID_TRANSFERS_RULE), 0
+        )
+
+        with mock.patch.object(repo, "get_latest_in_windows") as _latest:
+            for user_id in ["user1234", "user5678"]:
+                counters.record(
+                    TransactionModel(
+                        user_id=user_id,
+                        amount=200,
+                        currency="USD",
+                        timestamp=datetime.datetime.now(datetime.timezone.utc),
+                        type="TRANSFER",
+                        is_suspicious=False,
+                        suspicious_reasons=[],
+                    )
+                )
+            self.assertEqual(
+                await counters.count(repo, "user1234", RAPID_TRANSFERS_RULE), 1
+            )
+            _latest.assert_not_called()
+
+        self.assertEqual(len(counters), 1)
+
+    async def test_least_recently_used_users_are_evicted(self):
+        db = AsyncMongoMockClient()["tests"]
+        repo = TransactionRepository(db=db)
+        counters = WindowCounters(rules=WINDOW_RULES, max_users=2)
+
+        for user_id in ["user1", "user2", "user1", "user3"]:
+            await counters.count(repo, user_id, RAPID_TRANSFERS_RULE)
+
+        self.assertEqual(list(counters._users), ["user1", "user3"])
+
+    @mock.patch("connections.connections.redis")
+    async def test_new_transaction_only_queries_on_first_lookup(self, _redis):
+        _redis.mget.return_value = [None, None]
+        db = AsyncMongoMockClient()["tests"]
+        repo = TransactionRepository
+
+        with mock.patch.object(
+            repo,
+            "get_latest_in_windows",
+            side_effect=repo.get_latest_in_windows,
+            autospec=True,
+        ) as _latest:
+            for i in range(5):
+                new_trans = await NewTransaction(
+                    transaction=NewTransactionPayload(
+                        user_id="user1234",
+                        amount="50",
+                        currency="USD",
+                        timestamp=datetime.datetime.utcnow(),
+                        type="TRANSFER",
+                    ),
+                    database=db,
+                )()
+
+        # Both windows are loaded together on the first lookup, every other
+        # lookup is answered in memory
+        self.assertEqual(_latest.call_count, 1)
+        self.assertEqual(
+            new_trans["suspicious_reasons"],
+            ["FREQUENT_SMALL_TRANSACTIONS", "RAPID_TRANSFERS"],
+        )
+        self.assertIs(get_window_counters(db), get_window_counters(db))